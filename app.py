@@ -1,15 +1,36 @@
 import streamlit as st
-import base64
-from PIL import Image
-import io
-from prompts import SYSTEM_PROMPT_ANALYZER, SYSTEM_PROMPT_BANANA_ENGINEER, SYSTEM_PROMPT_REFINE_ENGINEER
-from utils import encode_image, call_gemini_vision, call_gemini_vision_markdown, call_gemini, generate_image, refine_design_with_vision, generate_design_project_pdf, create_before_after_comparison
+from prompts import SYSTEM_PROMPT_ANALYZER, SYSTEM_PROMPT_RECOMMENDATIONS, SYSTEM_PROMPT_SHOPPING_LIST, SYSTEM_PROMPT_DESIGN_PACKAGE
+from utils import stream_gemini_vision, stream_gemini_vision_markdown, stream_gemini_design_package, generate_design_project_pdf, create_before_after_comparison
 import os
 import json
+import functools
+import uuid
+import logging
 from dotenv import load_dotenv
-from database import SessionLocal, Project, DesignVariant, Recommendation, init_db
+from database import db_session, Project, DesignVariant, Recommendation, init_db
+from blob_store import put_bytes
+from image_pipeline import normalize_image, get_derivative, detect_mime
+from source_images import intern_image, acquire_image, release_image, start_image_gc
+from image_memory import get_image_memory
+from image_value import ImageValue, as_image
+from compositor import create_project_comparisons
+from prefetch import speculate
+from design_package import DESIGN_PACKAGE_MODE, SHOPPING_CATEGORIES, format_shopping_list
+from shopping_items import replace_project_items, load_project_items, get_project_budget, get_material_report
+from project_list import get_project_list, get_project_summary, invalidate_project_list
+from generation import MAX_VARIANTS_PER_REQUEST, build_variant_specs
+from lineage import (
+    ORIGIN_GENERATE, ORIGIN_REGENERATE, ORIGIN_REFINE, ORIGIN_RESTORE,
+    child_lineage, describe_entry, dump_lineage, load_lineage, refine_context
+)
+from jobs import get_job_queue, JOB_SUCCEEDED, FINISHED_STATUSES, JOB_STAGE_LABELS
+from telemetry import pipeline_stage
 from datetime import datetime, timedelta
 
+logger = logging.getLogger("ai_designer.app")
+
+JOB_UI_REFRESH_SECONDS = float(os.getenv("JOB_UI_REFRESH_SECONDS", "2"))
+
 def get_moscow_time():
     """Возвращает текущее время по Москве (UTC+3)"""
     return datetime.utcnow() + timedelta(hours=3)
@@ -18,6 +39,7 @@ load_dotenv()
 
 try:
     init_db()
+    start_image_gc()
 except Exception as e:
     st.warning(f"⚠️ База данных недоступна: {str(e)}. Функции сохранения проектов могут не работать.")
 
@@ -202,8 +224,8 @@ if 'images' not in st.session_state:
     st.session_state.images = []
 if 'selected_image_idx' not in st.session_state:
     st.session_state.selected_image_idx = None
-if 'uploaded_image_b64' not in st.session_state:
-    st.session_state.uploaded_image_b64 = None
+if 'uploaded_image_hash' not in st.session_state:
+    st.session_state.uploaded_image_hash = None
 if 'room_type' not in st.session_state:
     st.session_state.room_type = None
 if 'purpose' not in st.session_state:
@@ -214,6 +236,8 @@ if 'saved_recommendations' not in st.session_state:
     st.session_state.saved_recommendations = None
 if 'saved_shopping_list' not in st.session_state:
     st.session_state.saved_shopping_list = None
+if 'saved_shopping_items' not in st.session_state:
+    st.session_state.saved_shopping_items = []
 if 'saved_budget' not in st.session_state:
     st.session_state.saved_budget = {}
 if 'last_selected_project' not in st.session_state:
@@ -226,85 +250,468 @@ if 'username' not in st.session_state:
     st.session_state.username = None
 if 'theme' not in st.session_state:
     st.session_state.theme = 'dark'
+if 'project_dirty' not in st.session_state:
+    st.session_state.project_dirty = set()
+if 'recommendation_dirty' not in st.session_state:
+    st.session_state.recommendation_dirty = set()
+if 'removed_variant_ids' not in st.session_state:
+    st.session_state.removed_variant_ids = []
+if 'image_session_id' not in st.session_state:
+    st.session_state.image_session_id = uuid.uuid4().hex
+
+def get_session_image(image_hash: str) -> ImageValue:
+    """Изображение по хешу. В сессии хранятся только хеши, байты — в общем ограниченном кеше image_memory
+    с бюджетом на сессию и на процесс"""
+    return get_image_memory().get(st.session_state.image_session_id, image_hash)
+
+def release_session_images():
+    """Отпускает изображения сессии в общем кеше (смена проекта, новый анализ)"""
+    get_image_memory().release_session(st.session_state.image_session_id)
+
+def intern_legacy_image_url(image_url: str) -> str:
+    """Переносит изображение старого варианта (data URL или внешняя ссылка) в хранилище блобов и возвращает хеш"""
+    try:
+        image = as_image(image_url)
+        return put_bytes(image.bytes, image.hash)
+    except Exception as e:
+        logger.warning("Не удалось перенести изображение варианта в хранилище: %s", e)
+        return None
+
+PROJECT_FIELDS = ('room_type', 'purpose', 'analysis', 'uploaded_image_hash')
+VARIANT_COLUMNS = {
+    'hash': 'image_hash',
+    'prompt': 'prompt',
+    'iterations': 'iterations',
+    'styles': 'styles',
+    'main_color': 'main_color',
+    'additional_preferences': 'additional_preferences'
+}
+RECOMMENDATION_FIELDS = {'content': 'saved_recommendations', 'shopping_list': 'saved_shopping_list', 'budget_data': 'saved_budget'}
+
+def new_variant(image_hash: str, prompt: str, iterations: int, styles: str = None, main_color: str = None, additional_preferences: str = None,
+                origin: str = ORIGIN_GENERATE, delta: str = None, parent_id: int = None, lineage: list = None) -> dict:
+    """Создаёт запись варианта дизайна, которая ещё не сохранена в БД (без хеша — ожидает фоновое задание).
+    
+    origin — как получен вариант (lineage.ORIGIN_*), delta — пожелание доработки, lineage — предки от корня до родителя."""
+    return {
+        'id': None,
+        'hash': image_hash,
+        'prompt': prompt,
+        'iterations': iterations,
+        'styles': styles,
+        'main_color': main_color,
+        'additional_preferences': additional_preferences,
+        'origin': origin,
+        'delta': delta,
+        'parent_id': parent_id,
+        'lineage': lineage or [],
+        'status': 'ready' if image_hash else 'pending',
+        'job_id': None,
+        'dirty': set()
+    }
+
+def submit_variant_jobs(requests: list):
+    """Ставит генерацию вариантов в фоновую очередь.
+    
+    requests — список пар (запись из new_variant без хеша, (kind, payload)). Записи сразу сохраняются
+    в БД как ожидающие, чтобы результат задания привязался к строке DesignVariant даже после перезагрузки страницы.
+    """
+    for entry, _ in requests:
+        st.session_state.images.append(entry)
+    auto_save_project()
+    job_queue = get_job_queue()
+    for entry, (kind, payload) in requests:
+        entry['job_id'] = job_queue.submit(
+            kind,
+            payload,
+            user_id=st.session_state.user_id,
+            project_id=st.session_state.current_project_id,
+            variant_id=entry['id']
+        )
+
+def restore_ancestor(img_data: dict, depth: int):
+    """Добавляет предка варианта (img_data['lineage'][depth]) новым вариантом без генерации: изображение
+    уже в хранилище блобов. От восстановленной версии можно дорабатывать новую ветку."""
+    ancestor = img_data['lineage'][depth]
+    existing_ids = {other['id'] for other in st.session_state.images if other.get('id') is not None}
+    st.session_state.images.append(new_variant(
+        ancestor['hash'],
+        ancestor['prompt'],
+        ancestor.get('iterations') or 0,
+        styles=img_data.get('styles'),
+        main_color=img_data.get('main_color'),
+        additional_preferences=img_data.get('additional_preferences'),
+        origin=ORIGIN_RESTORE,
+        parent_id=ancestor.get('id') if ancestor.get('id') in existing_ids else None,
+        lineage=img_data['lineage'][:depth + 1]
+    ))
+    auto_save_project()
+
+def get_uploaded_image() -> ImageValue:
+    """Исходное фото: в сессии хранится только хеш из таблицы images, данные читаются по требованию"""
+    return get_session_image(st.session_state.uploaded_image_hash)
+
+def get_variant_image(img_data: dict) -> ImageValue:
+    """Изображение готового варианта по его хешу"""
+    return get_session_image(img_data['hash'])
+
+def refresh_pending_variants() -> bool:
+    """Подтягивает статус фоновых заданий в записи вариантов. Возвращает True, если что-то завершилось."""
+    pending = [img for img in st.session_state.images if img.get('status') == 'pending' and img.get('job_id')]
+    if not pending:
+        return False
+    
+    jobs = get_job_queue().get_many([img['job_id'] for img in pending])
+    finished = False
+    for img_data in pending:
+        job = jobs.get(img_data['job_id'])
+        if job is None:
+            continue
+        img_data['progress'] = job['progress']
+        img_data['stage'] = job['stage']
+        if job['status'] == JOB_SUCCEEDED:
+            img_data['hash'] = job['result_hash']
+            img_data['prompt'] = job['result_prompt']
+            img_data['status'] = 'ready'
+            if img_data.get('id') is not None and job['variant_id'] != img_data['id']:
+                img_data['dirty'].update({'hash', 'prompt'})
+            finished = True
+        elif job['status'] in FINISHED_STATUSES:
+            img_data['status'] = 'failed'
+            img_data['error'] = job['error'] or "Задание отменено"
+            finished = True
+    
+    if finished:
+        auto_save_project()
+    return finished
+
+@st.fragment(run_every=JOB_UI_REFRESH_SECONDS)
+def render_pending_variants():
+    """Периодически опрашивает очередь и показывает прогресс фоновых генераций"""
+    if refresh_pending_variants():
+        st.rerun()
+    
+    for idx, img_data in enumerate(st.session_state.images):
+        if img_data.get('status') == 'pending':
+            stage = JOB_STAGE_LABELS.get(img_data.get('stage') or 'queued', "В работе")
+            st.progress((img_data.get('progress') or 0) / 100, text=f"⏳ Вариант {idx + 1}: {stage}")
+
+def mark_project_dirty(*fields):
+    """Помечает поля проекта как изменённые для следующего автосохранения"""
+    st.session_state.project_dirty.update(fields)
+
+def mark_recommendation_dirty(*fields):
+    """Помечает поля рекомендаций как изменённые для следующего автосохранения"""
+    st.session_state.recommendation_dirty.update(fields)
+
+def reset_change_tracking():
+    """Сбрасывает отслеживание изменений (после загрузки проекта или начала нового)"""
+    st.session_state.project_dirty = set()
+    st.session_state.recommendation_dirty = set()
+    st.session_state.removed_variant_ids = []
+
+def build_recommendations_request() -> str:
+    """Текст запроса рекомендаций по материалам для выбранного дизайна"""
+    return f"""Тип помещения: {st.session_state.room_type}
+Цель: {st.session_state.purpose}
 
-def get_design_image_bytes(design_url: str) -> bytes:
-    """Вспомогательная функция для извлечения байтов изображения из URL"""
-    if design_url.startswith('data:image'):
-        header, encoded = design_url.split(',', 1)
-        return base64.b64decode(encoded)
-    else:
-        import requests
-        response = requests.get(design_url, timeout=10)
-        return response.content
+Анализ исходного помещения:
+{st.session_state.analysis}
+
+ПЕРВОЕ ИЗОБРАЖЕНИЕ (слева): исходное помещение
+ВТОРОЕ ИЗОБРАЖЕНИЕ (справа): финальный дизайн
+
+Сравни эти два изображения и дай рекомендации ТОЛЬКО по измененным элементам."""
+
+def build_shopping_list_request(room_type: str, recommendations: str) -> str:
+    """Текст запроса списка покупок для выбранного дизайна (без обращения к сессии — строится и в потоке предвыборки)"""
+    return f"""Тип помещения: {room_type}
+
+Рекомендации по материалам:
+{recommendations if recommendations else 'Используй анализ изображения'}
+
+ПЕРВОЕ ИЗОБРАЖЕНИЕ (слева): исходное помещение
+ВТОРОЕ ИЗОБРАЖЕНИЕ (справа): финальный дизайн
+
+Сравни эти два изображения и создай список покупок ТОЛЬКО для измененных элементов."""
+
+def build_design_package_request() -> str:
+    """Текст комбинированного запроса: рекомендации, список покупок и бюджет одним ответом"""
+    return f"""Тип помещения: {st.session_state.room_type}
+Цель: {st.session_state.purpose}
+
+Анализ исходного помещения:
+{st.session_state.analysis}
+
+ПЕРВОЕ ИЗОБРАЖЕНИЕ (слева): исходное помещение
+ВТОРОЕ ИЗОБРАЖЕНИЕ (справа): финальный дизайн
+
+Сравни эти два изображения и верни рекомендации, список покупок и бюджет ТОЛЬКО по измененным элементам."""
+
+def build_selection_request() -> str:
+    """Запрос, с которого начинается генерация для выбранного дизайна: комбинированный или только рекомендации"""
+    return build_design_package_request() if DESIGN_PACKAGE_MODE == "combined" else build_recommendations_request()
+
+def apply_design_package(recommendations: str, shopping_list: str, budget: dict, items: list):
+    """Сохраняет в сессию результат комбинированного запроса; позиции списка покупок сохраняются в shopping_items"""
+    st.session_state.saved_recommendations = recommendations
+    st.session_state.saved_shopping_list = shopping_list
+    st.session_state.saved_shopping_items = items
+    st.session_state.saved_budget = budget or {}
+    mark_recommendation_dirty('content', 'shopping_items')
+
+def set_markdown_shopping_list(shopping_list: str):
+    """Сохраняет в сессию список покупок текстом (раздельный режим); позиции проекта при сохранении удаляются"""
+    st.session_state.saved_shopping_list = shopping_list
+    st.session_state.saved_shopping_items = []
+    st.session_state.saved_budget = {}
+    mark_recommendation_dirty('shopping_list', 'shopping_items')
+
+def render_shopping_items(items: list):
+    """Список покупок таблицей по позициям, в порядке категорий"""
+    order = {category: index for index, category in enumerate(SHOPPING_CATEGORIES)}
+    st.dataframe(
+        [
+            {
+                "Категория": item['category'],
+                "Наименование": item['name'],
+                "Артикул": item['sku'],
+                "Описание": item['description'],
+                "Кол-во": item['quantity'],
+                "Ед.": item['unit'],
+                "Цена за ед., руб": round(item['unit_price_rub']),
+                "Сумма, руб": round(item['quantity'] * item['unit_price_rub']),
+            }
+            for item in sorted(items, key=lambda item: order.get(item['category'], len(order)))
+        ],
+        hide_index=True,
+        use_container_width=True
+    )
+
+def render_budget(budget: dict):
+    """Итог бюджета и суммы по категориям"""
+    st.subheader("💰 Бюджет")
+    st.metric("Итого по списку покупок", f"~{budget['total_rub']:,} руб".replace(",", " "))
+    by_category = budget.get('by_category') or {}
+    if by_category:
+        st.table([
+            {"Категория": category, "Сумма, руб": f"{amount:,}".replace(",", " ")}
+            for category, amount in by_category.items()
+        ])
+
+def render_material_report(report: list):
+    """Сводка материалов по всем проектам пользователя"""
+    st.dataframe(
+        [
+            {
+                "Категория": row['category'],
+                "Наименование": row['name'],
+                "Артикул": row['sku'],
+                "Кол-во": row['quantity'],
+                "Ед.": row['unit'],
+                "Сумма, руб": row['total_rub'],
+                "Проектов": row['projects'],
+            }
+            for row in report
+        ],
+        hide_index=True,
+        use_container_width=True
+    )
+
+def regenerate_design_package(variant: dict):
+    """Заново формирует рекомендации, список покупок и бюджет одним комбинированным запросом: позиции списка
+    согласованы с рекомендациями, поэтому в комбинированном режиме они обновляются вместе"""
+    with st.spinner("🛒 Пересоздаю рекомендации, список покупок и бюджет..."):
+        try:
+            package = {}
+            with pipeline_stage("design_package"):
+                for _ in stream_gemini_design_package(
+                    SYSTEM_PROMPT_DESIGN_PACKAGE,
+                    build_design_package_request(),
+                    get_variant_image(variant),
+                    get_uploaded_image(),
+                    package
+                ):
+                    pass
+            apply_design_package(package['recommendations'], package['shopping_list'], package['budget'],
+                                 package['items'])
+            auto_save_project()
+            st.rerun()
+        except Exception as e:
+            st.error(f"Ошибка при создании списка: {str(e)}")
+
+def prefetch_selection(variant: dict, recommendations: str = None):
+    """Запускает в фоне (или оставляет идущей) генерацию рекомендаций и списка покупок для варианта.
+    Задача для другого варианта или других рекомендаций отменяется."""
+    st.session_state.prefetch = speculate(
+        st.session_state.get('prefetch'),
+        variant['hash'],
+        st.session_state.uploaded_image_hash,
+        build_selection_request(),
+        functools.partial(build_shopping_list_request, st.session_state.room_type),
+        recommendations
+    )
+    return st.session_state.prefetch
+
+def get_matching_prefetch(variant: dict, recommendations: str = None):
+    """Фоновая задача, подходящая к выбранному варианту, или None"""
+    task = st.session_state.get('prefetch')
+    if task is not None and task.matches(
+        variant['hash'],
+        st.session_state.uploaded_image_hash,
+        build_selection_request(),
+        recommendations
+    ):
+        return task
+    return None
+
+def cancel_prefetch():
+    """Отменяет фоновую генерацию рекомендаций (смена проекта, новый анализ)"""
+    task = st.session_state.get('prefetch')
+    if task is not None:
+        task.cancel()
+    st.session_state.prefetch = None
 
 def auto_save_project():
+    """Сохраняет в БД только изменения с прошлого сохранения, одной транзакцией"""
     if not st.session_state.auto_save_enabled or not st.session_state.analysis or not st.session_state.user_id:
         return
     
-    db = SessionLocal()
-    try:
-        moscow_time = get_moscow_time()
-        project_name = f"Проект {moscow_time.strftime('%d.%m.%Y %H:%M')}"
-        if st.session_state.current_project_id:
-            project = db.query(Project).filter(
-                Project.id == st.session_state.current_project_id,
-                Project.user_id == st.session_state.user_id
-            ).first()
-            if project:
-                project.room_type = st.session_state.room_type
-                project.purpose = st.session_state.purpose
-                project.analysis = st.session_state.analysis
-                project.uploaded_image_b64 = st.session_state.uploaded_image_b64
-                project.updated_at = moscow_time
-                
-                db.query(DesignVariant).filter(DesignVariant.project_id == project.id).delete()
-        else:
-            project = Project(
-                name=project_name,
-                user_id=st.session_state.user_id,
-                room_type=st.session_state.room_type,
-                purpose=st.session_state.purpose,
-                analysis=st.session_state.analysis,
-                uploaded_image_b64=st.session_state.uploaded_image_b64
-            )
-            db.add(project)
-            db.flush()
-            st.session_state.current_project_id = project.id
-        
-        for img_data in st.session_state.images:
-            variant = DesignVariant(
-                project_id=project.id,
-                image_url=img_data['url'],
-                prompt=img_data['prompt'],
-                iterations=img_data['iterations']
-            )
-            db.add(variant)
-        
-        if st.session_state.saved_recommendations or st.session_state.saved_shopping_list or st.session_state.get('saved_budget'):
-            existing_rec = db.query(Recommendation).filter(Recommendation.project_id == project.id).first()
-            budget_json = json.dumps(st.session_state.get('saved_budget', {})) if st.session_state.get('saved_budget') else None
-            if existing_rec:
-                if st.session_state.saved_recommendations:
-                    existing_rec.content = st.session_state.saved_recommendations
-                if st.session_state.saved_shopping_list:
-                    existing_rec.shopping_list = st.session_state.saved_shopping_list
-                if budget_json:
-                    existing_rec.budget_data = budget_json
+    with pipeline_stage("autosave") as stage:
+        save_project_changes(stage)
+
+def save_project_changes(stage: dict):
+    """Тело auto_save_project: ошибка сохранения логируется и отмечается в записи этапа телеметрии"""
+    with db_session() as db:
+        try:
+            for img_data in st.session_state.images:
+                img_data.setdefault('id', None)
+                img_data.setdefault('dirty', set())
+            
+            moscow_time = get_moscow_time()
+            project = None
+            previous_image_hash = None
+            if st.session_state.current_project_id:
+                project = db.query(Project).filter(
+                    Project.id == st.session_state.current_project_id,
+                    Project.user_id == st.session_state.user_id
+                ).first()
+                if project is not None:
+                    previous_image_hash = project.uploaded_image_hash
+            
+            if project is None:
+                project = Project(
+                    name=f"Проект {moscow_time.strftime('%d.%m.%Y %H:%M')}",
+                    user_id=st.session_state.user_id
+                )
+                db.add(project)
+                project_dirty = set(PROJECT_FIELDS)
+                recommendation_dirty = set(RECOMMENDATION_FIELDS) | {'shopping_items'}
+                removed_variant_ids = []
+                for img_data in st.session_state.images:
+                    img_data['id'] = None
             else:
-                rec = Recommendation(
+                project_dirty = set(st.session_state.project_dirty)
+                recommendation_dirty = set(st.session_state.recommendation_dirty)
+                removed_variant_ids = list(st.session_state.removed_variant_ids)
+            
+            new_variants = [img_data for img_data in st.session_state.images if img_data['id'] is None]
+            changed_variants = [img_data for img_data in st.session_state.images if img_data['id'] is not None and img_data['dirty']]
+            
+            if not (project_dirty or removed_variant_ids or new_variants or changed_variants or recommendation_dirty):
+                return
+            
+            for field in project_dirty:
+                setattr(project, field, st.session_state.get(field))
+            if 'uploaded_image_hash' in project_dirty:
+                project.uploaded_image_b64 = None
+                if previous_image_hash != project.uploaded_image_hash:
+                    release_image(db, previous_image_hash)
+                    acquire_image(db, project.uploaded_image_hash)
+            project.updated_at = moscow_time
+            db.flush()
+            
+            if removed_variant_ids:
+                db.query(DesignVariant).filter(
+                    DesignVariant.project_id == project.id,
+                    DesignVariant.id.in_(removed_variant_ids)
+                ).delete(synchronize_session=False)
+            
+            inserted = []
+            for img_data in new_variants:
+                variant = DesignVariant(
                     project_id=project.id,
-                    content=st.session_state.saved_recommendations or "",
-                    shopping_list=st.session_state.saved_shopping_list,
-                    budget_data=budget_json
+                    image_hash=img_data['hash'],
+                    prompt=img_data['prompt'] or "",
+                    iterations=img_data['iterations'],
+                    styles=img_data.get('styles'),
+                    main_color=img_data.get('main_color'),
+                    additional_preferences=img_data.get('additional_preferences'),
+                    parent_id=img_data.get('parent_id'),
+                    origin=img_data.get('origin'),
+                    delta=img_data.get('delta'),
+                    lineage=dump_lineage(img_data.get('lineage'))
                 )
-                db.add(rec)
-        
-        db.commit()
-    except Exception as e:
-        print(f"Ошибка при автосохранении: {e}")
-        db.rollback()
-    finally:
-        db.close()
+                db.add(variant)
+                inserted.append((img_data, variant))
+            
+            for img_data in changed_variants:
+                values = {VARIANT_COLUMNS[field]: img_data[field] for field in img_data['dirty']}
+                if 'hash' in img_data['dirty']:
+                    values['image_url'] = None
+                db.query(DesignVariant).filter(
+                    DesignVariant.id == img_data['id'],
+                    DesignVariant.project_id == project.id
+                ).update(values, synchronize_session=False)
+            
+            shopping_items = st.session_state.saved_shopping_items
+            shopping_items_dirty = 'shopping_items' in recommendation_dirty
+            recommendation_dirty.discard('shopping_items')
+            budget = None
+            if shopping_items_dirty:
+                replace_project_items(db, project.id, shopping_items)
+                if shopping_items:
+                    db.flush()
+                    budget = get_project_budget(db, project.id)
+            
+            recommendation_values = {
+                'content': st.session_state.saved_recommendations,
+                'shopping_list': None if shopping_items else st.session_state.saved_shopping_list,
+                'budget_data': json.dumps(st.session_state.saved_budget) if st.session_state.get('saved_budget') and not shopping_items else None
+            }
+            recommendation_dirty = {field for field in recommendation_dirty if recommendation_values[field]}
+            if shopping_items_dirty and shopping_items:
+                # список покупок и бюджет проекта теперь в shopping_items, старый текст не нужен
+                recommendation_dirty |= {'shopping_list', 'budget_data'}
+            if recommendation_dirty:
+                existing_rec = db.query(Recommendation).filter(Recommendation.project_id == project.id).first()
+                if existing_rec:
+                    for field in recommendation_dirty:
+                        setattr(existing_rec, field, recommendation_values[field])
+                else:
+                    db.add(Recommendation(
+                        project_id=project.id,
+                        content=recommendation_values['content'] or "",
+                        shopping_list=recommendation_values['shopping_list'],
+                        budget_data=recommendation_values['budget_data']
+                    ))
+            
+            db.commit()
+            invalidate_project_list(st.session_state.user_id)
+            
+            st.session_state.current_project_id = project.id
+            if budget is not None:
+                st.session_state.saved_budget = budget
+            for img_data, variant in inserted:
+                img_data['id'] = variant.id
+            for img_data in st.session_state.images:
+                img_data['dirty'] = set()
+            reset_change_tracking()
+        except Exception as e:
+            logger.exception("Ошибка при автосохранении")
+            stage['status'] = 'error'
+            stage['error'] = str(e)
+            db.rollback()
 
 st.title("🏠 AI-Дизайнер по ремонту")
 
@@ -347,90 +754,162 @@ st.markdown("Загрузите фото помещения и получите
 with st.sidebar:
     st.header("📋 Управление проектами")
     
-    db = SessionLocal()
-    projects = db.query(Project).filter(Project.user_id == st.session_state.user_id).order_by(Project.updated_at.desc()).all()
+    if 'project_list_pages' not in st.session_state:
+        st.session_state.project_list_pages = 1
     
-    if projects:
-        project_options = ["Новый проект"] + [f"{p.name} ({p.room_type})" for p in projects]
+    project_search = st.text_input("🔍 Поиск проекта", key="project_search", placeholder="Название или тип помещения")
+    if project_search != st.session_state.get('last_project_search', ""):
+        st.session_state.last_project_search = project_search
+        st.session_state.project_list_pages = 1
+    
+    current_summary = None
+    with db_session() as db:
+        projects, has_more_projects = get_project_list(
+            db,
+            st.session_state.user_id,
+            project_search,
+            st.session_state.project_list_pages
+        )
+        if st.session_state.current_project_id and all(p['id'] != st.session_state.current_project_id for p in projects):
+            current_summary = get_project_summary(db, st.session_state.user_id, st.session_state.current_project_id)
+    if current_summary:
+        projects = [current_summary] + projects
+    
+    if projects or project_search:
+        project_labels = {}
+        for p in projects:
+            label = f"{p['name']} ({p['room_type']})"
+            if label in project_labels.values():
+                label = f"{label} #{p['id']}"
+            project_labels[p['id']] = label
+        project_options = [None] + [p['id'] for p in projects]
         
         default_index = 0
-        if st.session_state.current_project_id:
-            for i, p in enumerate(projects):
-                if p.id == st.session_state.current_project_id:
-                    default_index = i + 1
-                    break
+        if st.session_state.current_project_id in project_labels:
+            default_index = project_options.index(st.session_state.current_project_id)
         
         selected_project = st.selectbox(
             "Выберите проект",
             project_options,
             index=default_index,
+            format_func=lambda project_id: "Новый проект" if project_id is None else project_labels[project_id],
             key="project_selector"
         )
         
+        if has_more_projects and st.button("Показать ещё", key="more_projects_btn"):
+            st.session_state.project_list_pages += 1
+            st.rerun()
+        
         if selected_project != st.session_state.last_selected_project:
             st.session_state.last_selected_project = selected_project
             
-            if selected_project != "Новый проект":
-                project_idx = project_options.index(selected_project) - 1
-                project = projects[project_idx]
-                
-                if project.user_id != st.session_state.user_id:
-                    st.error("⛔ Нет доступа к этому проекту")
-                    st.stop()
-                
-                st.session_state.current_project_id = project.id
-                st.session_state.room_type = project.room_type
-                st.session_state.purpose = project.purpose
-                st.session_state.analysis = project.analysis
-                st.session_state.uploaded_image_b64 = project.uploaded_image_b64
-                if project.uploaded_image_b64:
-                    import base64
-                    st.session_state.uploaded_image_bytes = base64.b64decode(project.uploaded_image_b64)
-                st.session_state.auto_save_enabled = True
-                
-                variants = db.query(DesignVariant).filter(DesignVariant.project_id == project.id).all()
-                st.session_state.images = [
-                    {
-                        'url': v.image_url,
-                        'prompt': v.prompt,
-                        'iterations': v.iterations
-                    } for v in variants
-                ]
-                
-                recommendations = db.query(Recommendation).filter(Recommendation.project_id == project.id).first()
-                if recommendations:
-                    st.session_state.saved_recommendations = recommendations.content
-                    st.session_state.saved_shopping_list = recommendations.shopping_list
-                    if recommendations.budget_data:
-                        try:
-                            st.session_state.saved_budget = json.loads(recommendations.budget_data)
-                        except:
+            cancel_prefetch()
+            release_session_images()
+            if selected_project is not None:
+                with db_session() as db:
+                    project = db.query(Project).filter(
+                        Project.id == selected_project,
+                        Project.user_id == st.session_state.user_id
+                    ).first()
+                    
+                    if project is None:
+                        st.error("⛔ Нет доступа к этому проекту")
+                        st.stop()
+                    
+                    st.session_state.current_project_id = project.id
+                    st.session_state.room_type = project.room_type
+                    st.session_state.purpose = project.purpose
+                    st.session_state.analysis = project.analysis
+                    st.session_state.uploaded_image_hash = project.uploaded_image_hash
+                    legacy_image = not project.uploaded_image_hash and project.uploaded_image_b64
+                    if legacy_image:
+                        st.session_state.uploaded_image_hash = intern_image(db, ImageValue.from_b64(project.uploaded_image_b64).bytes)
+                    st.session_state.auto_save_enabled = True
+                    
+                    variants = db.query(DesignVariant).filter(DesignVariant.project_id == project.id).order_by(DesignVariant.id.asc()).all()
+                    variant_jobs = get_job_queue().find_by_variants([v.id for v in variants if not v.image_hash and not v.image_url])
+                    st.session_state.images = []
+                    orphan_variant_ids = []
+                    for v in variants:
+                        img_data = {
+                            'id': v.id,
+                            'hash': v.image_hash,
+                            'prompt': v.prompt,
+                            'iterations': v.iterations,
+                            'styles': v.styles,
+                            'main_color': v.main_color,
+                            'additional_preferences': v.additional_preferences,
+                            'origin': v.origin,
+                            'delta': v.delta,
+                            'parent_id': v.parent_id,
+                            'lineage': load_lineage(v.lineage),
+                            'status': 'ready',
+                            'job_id': None,
+                            'dirty': set()
+                        }
+                        if not img_data['hash'] and v.image_url:
+                            img_data['hash'] = intern_legacy_image_url(v.image_url)
+                            img_data['dirty'].add('hash')
+                        if not img_data['hash']:
+                            job = variant_jobs.get(v.id)
+                            if job is None:
+                                orphan_variant_ids.append(v.id)
+                                continue
+                            img_data['job_id'] = job['id']
+                            img_data['status'] = 'pending'
+                        st.session_state.images.append(img_data)
+                    if orphan_variant_ids:
+                        # Вариант без изображения и без задания генерации уже никогда не будет готов
+                        db.query(DesignVariant).filter(
+                            DesignVariant.project_id == project.id,
+                            DesignVariant.id.in_(orphan_variant_ids)
+                        ).delete(synchronize_session=False)
+                        db.commit()
+                        logger.warning("Удалены варианты без изображения и задания генерации: %s", orphan_variant_ids)
+                    reset_change_tracking()
+                    if legacy_image:
+                        mark_project_dirty('uploaded_image_hash')
+                    
+                    recommendations = db.query(Recommendation).filter(Recommendation.project_id == project.id).first()
+                    shopping_items = load_project_items(db, project.id) if recommendations else []
+                    st.session_state.saved_shopping_items = shopping_items
+                    if recommendations and shopping_items:
+                        st.session_state.saved_recommendations = recommendations.content
+                        st.session_state.saved_shopping_list = format_shopping_list(shopping_items)
+                        st.session_state.saved_budget = get_project_budget(db, project.id)
+                    elif recommendations:
+                        st.session_state.saved_recommendations = recommendations.content
+                        st.session_state.saved_shopping_list = recommendations.shopping_list
+                        if recommendations.budget_data:
+                            try:
+                                st.session_state.saved_budget = json.loads(recommendations.budget_data)
+                            except:
+                                st.session_state.saved_budget = {}
+                        else:
                             st.session_state.saved_budget = {}
                     else:
+                        st.session_state.saved_recommendations = None
+                        st.session_state.saved_shopping_list = None
                         st.session_state.saved_budget = {}
-                else:
-                    st.session_state.saved_recommendations = None
-                    st.session_state.saved_shopping_list = None
-                    st.session_state.saved_budget = {}
-                
-                if len(st.session_state.images) > 0 and recommendations:
-                    st.session_state.selected_variant_idx = 0
-                else:
-                    st.session_state.selected_variant_idx = None
+                    
+                    if len(st.session_state.images) > 0 and recommendations and st.session_state.images[0]['status'] == 'ready':
+                        st.session_state.selected_variant_idx = 0
+                    else:
+                        st.session_state.selected_variant_idx = None
+                    
                 
                 st.rerun()
             else:
-                for key in ['current_project_id', 'room_type', 'purpose', 'analysis', 'uploaded_image_b64', 'uploaded_image_bytes', 'images', 'saved_recommendations', 'saved_shopping_list', 'selected_variant_idx']:
+                for key in ['current_project_id', 'room_type', 'purpose', 'analysis', 'uploaded_image_hash', 'images', 'saved_recommendations', 'saved_shopping_list', 'saved_shopping_items', 'selected_variant_idx']:
                     if key in st.session_state:
-                        if key == 'images':
+                        if key in ('images', 'saved_shopping_items'):
                             st.session_state[key] = []
                         else:
                             st.session_state[key] = None
                 st.session_state.auto_save_enabled = False
+                reset_change_tracking()
                 st.rerun()
     
-    db.close()
-    
     if st.session_state.current_project_id:
         st.divider()
         
@@ -442,35 +921,51 @@ with st.sidebar:
             col1, col2 = st.columns(2)
             with col1:
                 if st.button("✅ Да, удалить", type="primary", key="confirm_delete_yes"):
-                    db = SessionLocal()
-                    try:
-                        project = db.query(Project).filter(
-                            Project.id == st.session_state.current_project_id,
-                            Project.user_id == st.session_state.user_id
-                        ).first()
-                        if project:
-                            db.delete(project)
-                            db.commit()
-                            st.success("✅ Проект удален")
-                            for key in ['current_project_id', 'room_type', 'purpose', 'analysis', 
-                                       'uploaded_image_b64', 'uploaded_image_bytes', 'images', 'saved_recommendations', 
-                                       'saved_shopping_list', 'confirm_delete', 'auto_save_enabled']:
-                                if key in st.session_state:
-                                    if key == 'images':
-                                        st.session_state[key] = []
-                                    else:
-                                        st.session_state[key] = None
-                            st.rerun()
-                    except Exception as e:
-                        db.rollback()
-                        st.error(f"Ошибка при удалении: {str(e)}")
-                    finally:
-                        db.close()
+                    with db_session() as db:
+                        try:
+                            project = db.query(Project).filter(
+                                Project.id == st.session_state.current_project_id,
+                                Project.user_id == st.session_state.user_id
+                            ).first()
+                            if project:
+                                cancel_prefetch()
+                                release_image(db, project.uploaded_image_hash)
+                                db.delete(project)
+                                db.commit()
+                                invalidate_project_list(st.session_state.user_id)
+                                st.success("✅ Проект удален")
+                                for key in ['current_project_id', 'room_type', 'purpose', 'analysis', 
+                                           'uploaded_image_hash', 'images', 'saved_recommendations', 
+                                           'saved_shopping_list', 'saved_shopping_items', 'confirm_delete', 'auto_save_enabled']:
+                                    if key in st.session_state:
+                                        if key in ('images', 'saved_shopping_items'):
+                                            st.session_state[key] = []
+                                        else:
+                                            st.session_state[key] = None
+                                reset_change_tracking()
+                                st.rerun()
+                        except Exception as e:
+                            db.rollback()
+                            st.error(f"Ошибка при удалении: {str(e)}")
             with col2:
                 if st.button("❌ Отмена", key="confirm_delete_no"):
                     st.session_state.confirm_delete = False
                     st.rerun()
     
+    with st.expander("📦 Материалы по всем проектам"):
+        report_category = st.selectbox("Категория", ["Все"] + SHOPPING_CATEGORIES, key="material_report_category")
+        if st.toggle("Показать сводку", key="show_material_report"):
+            with db_session() as db:
+                report = get_material_report(
+                    db,
+                    st.session_state.user_id,
+                    None if report_category == "Все" else report_category
+                )
+            if report:
+                render_material_report(report)
+            else:
+                st.caption("В сохранённых проектах пока нет позиций списка покупок")
+    
     st.divider()
     st.header("📋 Исходные данные")
     
@@ -482,20 +977,24 @@ with st.sidebar:
     
     uploaded_file = st.file_uploader(
         "Загрузите фото помещения",
-        type=["jpg", "jpeg", "png"],
+        type=["jpg", "jpeg", "png", "webp"],
         help="Перетащите файл сюда или нажмите для выбора. Четкое, хорошо освещенное фото"
     )
     
     if uploaded_file:
-        image = Image.open(uploaded_file)
-        st.image(image, caption="Загруженное фото", use_container_width=True)
-        uploaded_file.seek(0)
-        st.session_state.uploaded_image_bytes = uploaded_file.getvalue()
-        st.session_state.uploaded_image_b64 = encode_image(uploaded_file)
-    elif st.session_state.uploaded_image_b64:
-        image_bytes = base64.b64decode(st.session_state.uploaded_image_b64)
-        image = Image.open(io.BytesIO(image_bytes))
-        st.image(image, caption="Загруженное фото", use_container_width=True)
+        if st.session_state.get('uploaded_file_id') != uploaded_file.file_id or not st.session_state.uploaded_image_hash:
+            try:
+                with db_session() as db:
+                    image_hash = intern_image(db, normalize_image(uploaded_file.getvalue()))
+            except Exception as e:
+                st.error(str(e))
+                st.stop()
+            st.session_state.uploaded_file_id = uploaded_file.file_id
+            if image_hash != st.session_state.uploaded_image_hash:
+                st.session_state.uploaded_image_hash = image_hash
+                mark_project_dirty('uploaded_image_hash')
+    if st.session_state.uploaded_image_hash:
+        st.image(get_derivative(st.session_state.uploaded_image_hash, "thumbnail"), caption="Загруженное фото", use_container_width=True)
     
     purpose = st.text_area(
         "Цель использования помещения",
@@ -503,32 +1002,40 @@ with st.sidebar:
         height=100
     )
     
-    has_image = uploaded_file is not None or st.session_state.uploaded_image_b64 is not None
+    has_image = st.session_state.uploaded_image_hash is not None
     analyze_button = st.button("🔍 Начать анализ", type="primary", disabled=not has_image)
 
 if analyze_button and has_image:
     if st.session_state.analysis:
+        cancel_prefetch()
         st.session_state.analysis = None
         st.session_state.images = []
         st.session_state.selected_image_idx = None
         st.session_state.pop('selected_variant_idx', None)
         st.session_state.saved_recommendations = None
         st.session_state.saved_shopping_list = None
+        st.session_state.saved_shopping_items = []
         st.session_state.current_project_id = None
+        reset_change_tracking()
     
     st.session_state.room_type = room_type
     st.session_state.purpose = purpose
     st.session_state.auto_save_enabled = True
+    mark_project_dirty('room_type', 'purpose')
     
+    st.header("📊 Анализ вашего помещения")
     with st.spinner("🔍 Анализирую помещение..."):
         try:
-            analysis = call_gemini_vision(
-                SYSTEM_PROMPT_ANALYZER,
-                f"Тип помещения: {room_type}\nЦель использования: {purpose}",
-                st.session_state.uploaded_image_bytes
-            )
+            with pipeline_stage("analyze"):
+                analysis = st.write_stream(stream_gemini_vision(
+                    SYSTEM_PROMPT_ANALYZER,
+                    f"Тип помещения: {room_type}\nЦель использования: {purpose}",
+                    get_uploaded_image()
+                ))
             st.session_state.analysis = analysis
+            mark_project_dirty('analysis')
             auto_save_project()
+            st.rerun()
         except Exception as e:
             st.error(f"Ошибка при анализе изображения: {str(e)}")
             st.error("Пожалуйста, попробуйте еще раз или проверьте ваш API ключ.")
@@ -568,58 +1075,156 @@ if st.session_state.analysis:
         placeholder="Например: больше зелени, деревянные акценты"
     )
     
+    col1, col2 = st.columns([1, 2])
+    with col1:
+        variant_count = st.number_input(
+            "Количество вариантов",
+            min_value=1,
+            max_value=MAX_VARIANTS_PER_REQUEST,
+            value=1,
+            key="variant_count"
+        )
+    with col2:
+        st.write("")
+        per_style = st.checkbox(
+            "Отдельные варианты для каждого стиля",
+            value=False,
+            disabled=len(styles) < 2,
+            help="Создать варианты для каждого выбранного стиля, чтобы сравнить их между собой",
+            key="per_style_variants"
+        )
+    
     generate_button = st.button("✨ Создать дизайн-проект", type="primary", key="generate_design")
     
     if generate_button:
         if not styles:
             st.error("Выберите хотя бы один стиль")
         else:
-            with st.spinner("🎨 Создаю дизайн-проект..."):
-                try:
-                    dalle_prompt = call_gemini(
-                        SYSTEM_PROMPT_BANANA_ENGINEER,
-                        f"""Room analysis:
-{st.session_state.analysis}
-
-Room type: {st.session_state.room_type}
-Purpose: {st.session_state.purpose}
-Styles: {', '.join(styles)}
-Accent color: {main_color}
-Additional preferences: {additional_preferences if additional_preferences else 'none'}
-
-Create the prompt now.""",
-                        return_json_key="prompt"
+            specs = build_variant_specs(styles, main_color, additional_preferences, int(variant_count), per_style and len(styles) > 1)
+            try:
+                source_hash = st.session_state.uploaded_image_hash
+                submit_variant_jobs([
+                    (
+                        new_variant(
+                            None,
+                            None,
+                            0,
+                            styles=', '.join(spec['styles']),
+                            main_color=spec['main_color'],
+                            additional_preferences=spec['additional_preferences']
+                        ),
+                        ("generate", {
+                            'source_hash': source_hash,
+                            'analysis': st.session_state.analysis,
+                            'room_type': st.session_state.room_type,
+                            'purpose': st.session_state.purpose,
+                            **spec
+                        })
                     )
-                    
-                    image_url = generate_image(st.session_state.uploaded_image_bytes, dalle_prompt)
-                    
-                    st.session_state.images.append({
-                        'url': image_url,
-                        'prompt': dalle_prompt,
-                        'iterations': 0
-                    })
-                    
-                    auto_save_project()
-                    st.success("✅ Дизайн-проект создан!")
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"Ошибка при создании дизайн-проекта: {str(e)}")
-                    st.error("Пожалуйста, попробуйте еще раз или проверьте ваш API ключ.")
+                    for spec in specs
+                ])
+                st.rerun()
+            except Exception as e:
+                st.error(f"Ошибка при создании дизайн-проекта: {str(e)}")
+                st.error("Пожалуйста, попробуйте еще раз или проверьте ваш API ключ.")
 
 if st.session_state.images:
     st.divider()
     st.header("🖼️ Варианты дизайна")
     
+    if any(img_data.get('status') == 'pending' for img_data in st.session_state.images):
+        render_pending_variants()
+    
+    comparisons = {}
+    ready_variants = [img_data for img_data in st.session_state.images if img_data.get('status', 'ready') == 'ready']
+    if ready_variants and st.session_state.uploaded_image_hash:
+        compare_mode = st.toggle("🔀 Сравнение «до / после»", key="compare_mode")
+        if compare_mode:
+            compare_col1, compare_col2 = st.columns([3, 2])
+            with compare_col1:
+                split_position = st.slider("Положение разделителя, %", 0, 100, 50, step=5, key="compare_split")
+            with compare_col2:
+                compare_animate = st.checkbox("Анимированная шторка", key="compare_animate")
+            try:
+                with pipeline_stage("compare"):
+                    comparisons = create_project_comparisons(
+                        st.session_state.uploaded_image_hash,
+                        [img_data['hash'] for img_data in ready_variants],
+                        position=split_position / 100,
+                        animate=compare_animate
+                    )
+            except Exception as e:
+                st.error(f"Ошибка при создании сравнения: {str(e)}")
+    
+    viewed_variant = None
     for idx, img_data in enumerate(st.session_state.images):
+        if img_data.get('status', 'ready') != 'ready':
+            with st.container():
+                st.markdown(f"**Вариант {idx + 1}**")
+                if img_data['status'] == 'pending':
+                    st.caption("⏳ Генерируется в фоне — результат появится автоматически, даже если обновить страницу")
+                    if st.button("✖️ Отменить", key=f"cancel_{idx}"):
+                        if img_data.get('job_id'):
+                            get_job_queue().cancel(img_data['job_id'])
+                        if img_data.get('id') is not None:
+                            st.session_state.removed_variant_ids.append(img_data['id'])
+                        st.session_state.images.pop(idx)
+                        auto_save_project()
+                        st.rerun()
+                else:
+                    st.error(f"Ошибка при генерации: {img_data.get('error')}")
+                    if st.button("🗑️ Убрать", key=f"dismiss_{idx}"):
+                        if img_data.get('id') is not None:
+                            st.session_state.removed_variant_ids.append(img_data['id'])
+                        st.session_state.images.pop(idx)
+                        auto_save_project()
+                        st.rerun()
+                st.divider()
+            continue
+        
         with st.container():
             col1, col2 = st.columns([3, 2])
             
             with col1:
-                st.image(img_data['url'], use_container_width=True)
+                comparison = comparisons.get(img_data.get('hash'))
+                if comparison is not None:
+                    st.image(comparison, caption="Слева — исходное фото, справа — вариант", use_container_width=True)
+                else:
+                    image_placeholder = st.empty()
+                    show_full = st.toggle("🔍 Полный размер", key=f"full_size_{idx}")
+                    if show_full:
+                        viewed_variant = img_data
+                    image_placeholder.image(
+                        get_derivative(img_data['hash'], "preview" if show_full else "thumbnail"),
+                        use_container_width=True
+                    )
+                    if show_full:
+                        original = get_derivative(img_data['hash'], "full")
+                        original_mime = detect_mime(original)
+                        st.download_button(
+                            "💾 Скачать оригинал",
+                            data=original,
+                            file_name=f"design_variant_{idx + 1}.{original_mime.split('/')[-1]}",
+                            mime=original_mime,
+                            key=f"download_original_{idx}"
+                        )
             
             with col2:
                 st.markdown(f"**Вариант {idx + 1}**")
                 st.caption(f"Итераций: {img_data['iterations']}")
+                if img_data.get('styles'):
+                    st.caption(f"Стили: {img_data['styles']}")
+                if img_data.get('delta'):
+                    st.caption(f"Правка: {img_data['delta']}")
+                
+                if img_data.get('lineage'):
+                    with st.expander(f"🌳 История версий ({len(img_data['lineage'])})", expanded=False):
+                        for depth, ancestor in enumerate(img_data['lineage']):
+                            st.image(get_derivative(ancestor['hash'], "thumbnail"), width=160)
+                            st.caption(f"{depth + 1}. {describe_entry(ancestor)}")
+                            if st.button("↩️ Вернуться к этой версии", key=f"restore_{idx}_{depth}", use_container_width=True):
+                                restore_ancestor(img_data, depth)
+                                st.rerun()
                 
                 with st.expander("📝 Редактировать промпт", expanded=False):
                     edited_prompt = st.text_area(
@@ -631,20 +1236,24 @@ if st.session_state.images:
                     )
                     
                     if st.button("🔄 Перегенерировать", key=f"regen_{idx}", use_container_width=True):
-                        with st.spinner("🎨 Генерирую новый вариант..."):
-                            try:
-                                design_image_bytes = get_design_image_bytes(img_data['url'])
-                                new_image_url = generate_image(design_image_bytes, edited_prompt)
-                                st.session_state.images.append({
-                                    'url': new_image_url,
-                                    'prompt': edited_prompt,
-                                    'iterations': img_data['iterations'] + 1
-                                })
-                                auto_save_project()
-                                st.success("✅ Новый вариант создан!")
-                                st.rerun()
-                            except Exception as e:
-                                st.error(f"Ошибка: {str(e)}")
+                        try:
+                            submit_variant_jobs([(
+                                new_variant(
+                                    None,
+                                    edited_prompt,
+                                    img_data['iterations'] + 1,
+                                    styles=img_data.get('styles'),
+                                    main_color=img_data.get('main_color'),
+                                    additional_preferences=img_data.get('additional_preferences'),
+                                    origin=ORIGIN_REGENERATE,
+                                    parent_id=img_data['id'],
+                                    lineage=child_lineage(img_data)
+                                ),
+                                ("regenerate", {'source_hash': img_data['hash'], 'prompt': edited_prompt})
+                            )])
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Ошибка: {str(e)}")
                 
                 st.divider()
                 
@@ -658,29 +1267,31 @@ if st.session_state.images:
                 
                 if st.button("🎨 Применить изменения", type="primary", key=f"apply_changes_{idx}", use_container_width=True):
                     if feedback:
-                        with st.spinner("🎨 Анализирую дизайн и создаю улучшенную версию..."):
-                            try:
-                                refined_prompt = refine_design_with_vision(
-                                    img_data['url'],
+                        try:
+                            base_prompt, history = refine_context(img_data)
+                            submit_variant_jobs([(
+                                new_variant(
+                                    None,
                                     img_data['prompt'],
-                                    feedback,
-                                    SYSTEM_PROMPT_REFINE_ENGINEER
-                                )
-                                
-                                design_image_bytes = get_design_image_bytes(img_data['url'])
-                                new_image_url = generate_image(design_image_bytes, refined_prompt)
-                                
-                                st.session_state.images.append({
-                                    'url': new_image_url,
-                                    'prompt': refined_prompt,
-                                    'iterations': img_data['iterations'] + 1
+                                    img_data['iterations'] + 1,
+                                    styles=img_data.get('styles'),
+                                    main_color=img_data.get('main_color'),
+                                    additional_preferences=img_data.get('additional_preferences'),
+                                    origin=ORIGIN_REFINE,
+                                    delta=feedback,
+                                    parent_id=img_data['id'],
+                                    lineage=child_lineage(img_data)
+                                ),
+                                ("refine", {
+                                    'source_hash': img_data['hash'],
+                                    'prompt': base_prompt,
+                                    'feedback': feedback,
+                                    'history': history
                                 })
-                                
-                                auto_save_project()
-                                st.success("✅ Новый вариант создан!")
-                                st.rerun()
-                            except Exception as e:
-                                st.error(f"Ошибка при доработке дизайна: {str(e)}")
+                            )])
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Ошибка при доработке дизайна: {str(e)}")
                     else:
                         st.warning("Опишите желаемые изменения")
                 
@@ -688,189 +1299,187 @@ if st.session_state.images:
                 
                 if st.button("✅ Выбрать этот дизайн", type="primary", key=f"select_{idx}", use_container_width=True):
                     selected_variant = st.session_state.images[idx]
+                    for other in st.session_state.images:
+                        if other is selected_variant:
+                            continue
+                        if other.get('status') == 'pending' and other.get('job_id'):
+                            get_job_queue().cancel(other['job_id'])
+                        if other.get('id') is not None:
+                            st.session_state.removed_variant_ids.append(other['id'])
                     st.session_state.images = [selected_variant]
                     st.session_state.selected_variant_idx = 0
                     st.session_state.saved_recommendations = None
                     st.session_state.saved_shopping_list = None
+                    st.session_state.saved_shopping_items = []
+                    st.session_state.saved_budget = {}
                     st.session_state.needs_generation = True
                     
-                    if st.session_state.current_project_id:
-                        db = SessionLocal()
-                        try:
-                            db.query(DesignVariant).filter(
-                                DesignVariant.project_id == st.session_state.current_project_id
-                            ).delete()
-                            db.commit()
-                        except Exception as e:
-                            st.error(f"Ошибка удаления вариантов: {str(e)}")
-                            db.rollback()
-                        finally:
-                            db.close()
-                    
                     auto_save_project()
                     st.rerun()
             
             st.divider()
     
+    if (st.session_state.get('selected_variant_idx') is None and ready_variants and st.session_state.analysis
+            and not any(img_data.get('status') == 'pending' for img_data in st.session_state.images)):
+        prefetch_selection(viewed_variant or ready_variants[-1])
+    
     if ('selected_variant_idx' in st.session_state and 
         st.session_state.selected_variant_idx is not None and 
         0 <= st.session_state.selected_variant_idx < len(st.session_state.images)):
         st.divider()
         st.header("📋 Финальные рекомендации")
+        recommendations_placeholder = st.empty()
         
         if st.session_state.get('needs_generation', False):
             st.session_state.needs_generation = False
             
-            selected_design_url = st.session_state.images[st.session_state.selected_variant_idx]['url']
-            design_image_bytes = get_design_image_bytes(selected_design_url)
-            
-            with st.spinner("📝 Формирую рекомендации..."):
-                try:
-                    recommendations = call_gemini_vision_markdown(
-                        """Ты — эксперт по дизайну интерьеров и материалам отделки. 
-
-⚡ КРИТИЧНО: НАЧНИ СРАЗУ СО СПИСКА РЕКОМЕНДАЦИЙ БЕЗ ВВЕДЕНИЯ!
-Не пиши 'Я проанализировал', 'На основе анализа', 'Рассмотрев изображения' и подобные фразы.
-Переходи прямо к рекомендациям — число 1, число 2, и т.д.
-
-Тебе показаны два изображения: 1) исходное помещение, 2) финальный дизайн.
-ВАЖНО: Рекомендуй ТОЛЬКО то, что реально изменилось при переходе от исходного к финальному дизайну.
-Не советуй менять то, что не менялось.
-
-Дай детальные рекомендации по материалам и отделке ТОЛЬКО для новых или измененных элементов:
-1. Отделке стен (если она менялась)
-2. Напольному покрытию (если оно менялось)
-3. Потолку (если он менялся)
-4. Мебели (конкретные рекомендации с размерами только для новой мебели)
-5. Освещению (только для добавленных или замененных светильников)
-6. Декору и аксессуарам (только для добавленных элементов)
-
-Будь конкретным: указывай бренды, артикулы, примерные цены (в рублях).""",
-                        f"""Тип помещения: {st.session_state.room_type}
-Цель: {st.session_state.purpose}
-
-Анализ исходного помещения:
-{st.session_state.analysis}
-
-ПЕРВОЕ ИЗОБРАЖЕНИЕ (слева): исходное помещение
-ВТОРОЕ ИЗОБРАЖЕНИЕ (справа): финальный дизайн
-
-Сравни эти два изображения и дай рекомендации ТОЛЬКО по измененным элементам.""",
-                        design_image_bytes,
-                        st.session_state.uploaded_image_bytes
-                    )
+            selected_variant = st.session_state.images[st.session_state.selected_variant_idx]
+            prefetch_task = get_matching_prefetch(selected_variant)
+            if prefetch_task is None:
+                cancel_prefetch()
+            else:
+                with st.spinner("📝 Формирую рекомендации..."), pipeline_stage("recommend_prefetched"):
+                    recommendations = prefetch_task.wait_recommendations()
+                if recommendations and prefetch_task.budget is not None:
+                    apply_design_package(recommendations, prefetch_task.shopping_list, prefetch_task.budget,
+                                         prefetch_task.shopping_items)
+                    auto_save_project()
+                    st.rerun()
+                if recommendations:
                     st.session_state.saved_recommendations = recommendations
-                    st.session_state.needs_generation = False
+                    mark_recommendation_dirty('content')
                     auto_save_project()
                     st.rerun()
-                except Exception as e:
-                    st.error(f"Ошибка при генерации рекомендаций: {str(e)}")
-                    st.warning("Попробуйте нажать кнопку 'Обновить рекомендации' ниже для повторной генерации")
+            
+            design_image = get_variant_image(st.session_state.images[st.session_state.selected_variant_idx])
+            source_image = get_uploaded_image()
+            
+            with recommendations_placeholder.container():
+                st.subheader("💡 Детальные рекомендации по материалам")
+                stream_placeholder = st.empty()
+                if DESIGN_PACKAGE_MODE == "combined":
+                    with st.spinner("📝 Формирую рекомендации, список покупок и бюджет..."):
+                        try:
+                            package = {}
+                            with pipeline_stage("design_package"), stream_placeholder.container():
+                                st.write_stream(stream_gemini_design_package(
+                                    SYSTEM_PROMPT_DESIGN_PACKAGE,
+                                    build_design_package_request(),
+                                    design_image,
+                                    source_image,
+                                    package
+                                ))
+                            apply_design_package(package['recommendations'], package['shopping_list'], package['budget'],
+                                                 package['items'])
+                            auto_save_project()
+                            st.rerun()
+                        except Exception as e:
+                            logger.warning("Комбинированный запрос не удался, переход к раздельным запросам: %s", e)
+                            # частично выведенные рекомендации не должны остаться над ответом запасного запроса
+                            stream_placeholder.empty()
+                with st.spinner("📝 Формирую рекомендации..."):
+                    try:
+                        with pipeline_stage("recommend"), stream_placeholder.container():
+                            recommendations = st.write_stream(stream_gemini_vision_markdown(
+                                SYSTEM_PROMPT_RECOMMENDATIONS,
+                                build_recommendations_request(),
+                                design_image,
+                                source_image
+                            ))
+                        st.session_state.saved_recommendations = recommendations
+                        st.session_state.needs_generation = False
+                        mark_recommendation_dirty('content')
+                        auto_save_project()
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Ошибка при генерации рекомендаций: {str(e)}")
+                        st.warning("Попробуйте нажать кнопку 'Обновить рекомендации' ниже для повторной генерации")
         
-        st.subheader("💡 Детальные рекомендации по материалам")
-        if st.session_state.saved_recommendations:
-            st.markdown(st.session_state.saved_recommendations)
+        else:
+            with recommendations_placeholder.container():
+                st.subheader("💡 Детальные рекомендации по материалам")
+                if st.session_state.saved_recommendations:
+                    st.markdown(st.session_state.saved_recommendations)
         
         if st.button("📝 Обновить рекомендации", key="get_recommendations"):
-            selected_design_url = st.session_state.images[st.session_state.selected_variant_idx]['url']
-            design_image_bytes = get_design_image_bytes(selected_design_url)
+            design_image = get_variant_image(st.session_state.images[st.session_state.selected_variant_idx])
             
-            with st.spinner("📝 Формирую рекомендации..."):
-                try:
-                    recommendations = call_gemini_vision_markdown(
-                        """Ты — эксперт по дизайну интерьеров и материалам отделки. 
-
-⚡ КРИТИЧНО: НАЧНИ СРАЗУ СО СПИСКА РЕКОМЕНДАЦИЙ БЕЗ ВВЕДЕНИЯ!
-Не пиши 'Я проанализировал', 'На основе анализа', 'Рассмотрев изображения' и подобные фразы.
-Переходи прямо к рекомендациям — число 1, число 2, и т.д.
-
-Тебе показаны два изображения: 1) исходное помещение, 2) финальный дизайн.
-ВАЖНО: Рекомендуй ТОЛЬКО то, что реально изменилось при переходе от исходного к финальному дизайну.
-Не советуй менять то, что не менялось.
-
-Дай детальные рекомендации по материалам и отделке ТОЛЬКО для новых или измененных элементов:
-1. Отделке стен (если она менялась)
-2. Напольному покрытию (если оно менялось)
-3. Потолку (если он менялся)
-4. Мебели (конкретные рекомендации с размерами только для новой мебели)
-5. Освещению (только для добавленных или замененных светильников)
-6. Декору и аксессуарам (только для добавленных элементов)
-
-Будь конкретным: указывай бренды, артикулы, примерные цены (в рублях).""",
-                        f"""Тип помещения: {st.session_state.room_type}
-Цель: {st.session_state.purpose}
-
-Анализ исходного помещения:
-{st.session_state.analysis}
-
-ПЕРВОЕ ИЗОБРАЖЕНИЕ (слева): исходное помещение
-ВТОРОЕ ИЗОБРАЖЕНИЕ (справа): финальный дизайн
-
-Сравни эти два изображения и дай рекомендации ТОЛЬКО по измененным элементам.""",
-                        design_image_bytes,
-                        st.session_state.uploaded_image_bytes
-                    )
-                    
-                    st.session_state.saved_recommendations = recommendations
-                    auto_save_project()
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"Ошибка при формировании рекомендаций: {str(e)}")
-                    st.error("Пожалуйста, попробуйте еще раз или проверьте ваш API ключ.")
+            with recommendations_placeholder.container():
+                st.subheader("💡 Детальные рекомендации по материалам")
+                with st.spinner("📝 Формирую рекомендации..."):
+                    try:
+                        with pipeline_stage("recommend"):
+                            recommendations = st.write_stream(stream_gemini_vision_markdown(
+                                SYSTEM_PROMPT_RECOMMENDATIONS,
+                                build_recommendations_request(),
+                                design_image,
+                                get_uploaded_image()
+                            ))
+                        
+                        st.session_state.saved_recommendations = recommendations
+                        mark_recommendation_dirty('content')
+                        auto_save_project()
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Ошибка при формировании рекомендаций: {str(e)}")
+                        st.error("Пожалуйста, попробуйте еще раз или проверьте ваш API ключ.")
+        
+        if st.session_state.saved_recommendations and not st.session_state.saved_shopping_list:
+            prefetch_selection(
+                st.session_state.images[st.session_state.selected_variant_idx],
+                st.session_state.saved_recommendations
+            )
         
         st.divider()
         st.header("🛒 Список покупок")
         
-        if st.session_state.saved_shopping_list:
-            st.markdown(st.session_state.saved_shopping_list)
+        shopping_list_placeholder = st.empty()
+        if st.session_state.saved_shopping_items:
+            with shopping_list_placeholder.container():
+                render_shopping_items(st.session_state.saved_shopping_items)
+        elif st.session_state.saved_shopping_list:
+            shopping_list_placeholder.markdown(st.session_state.saved_shopping_list)
+        if st.session_state.saved_budget and st.session_state.saved_budget.get('total_rub'):
+            render_budget(st.session_state.saved_budget)
         
-        if st.button("📝 Создать список покупок", key="generate_shopping_list"):
-            selected_design_url = st.session_state.images[st.session_state.selected_variant_idx]['url']
-            design_image_bytes = get_design_image_bytes(selected_design_url)
+        # в комбинированном режиме позиции списка получены вместе с рекомендациями; отдельный текстовый список
+        # заменил бы их и бюджет, поэтому список пересоздаётся тем же комбинированным запросом
+        regenerate_package = DESIGN_PACKAGE_MODE == "combined" and bool(st.session_state.saved_shopping_items)
+        if st.button("🔄 Пересоздать список покупок" if regenerate_package else "📝 Создать список покупок",
+                     key="generate_shopping_list",
+                     help="Рекомендации обновятся вместе со списком" if regenerate_package else None):
+            selected_variant = st.session_state.images[st.session_state.selected_variant_idx]
+            if regenerate_package:
+                with shopping_list_placeholder.container():
+                    regenerate_design_package(selected_variant)
+            else:
+                prefetch_task = get_matching_prefetch(selected_variant, st.session_state.saved_recommendations)
+                if prefetch_task is not None:
+                    with shopping_list_placeholder.container():
+                        with st.spinner("🛒 Создаю список покупок..."), pipeline_stage("shopping_list_prefetched"):
+                            shopping_list = prefetch_task.wait_shopping_list(st.session_state.saved_recommendations)
+                    if shopping_list:
+                        set_markdown_shopping_list(shopping_list)
+                        auto_save_project()
+                        st.rerun()
             
-            with st.spinner("🛒 Создаю список покупок..."):
-                try:
-                    shopping_list = call_gemini_vision_markdown(
-                        """Ты — эксперт по закупкам материалов для ремонта. 
-
-⚡ КРИТИЧНО: НАЧНИ СРАЗУ СО СПИСКА ПОКУПОК БЕЗ ВВЕДЕНИЯ!
-Не пиши 'Я проанализировал', 'На основе анализа', 'Рассмотрев изображения' и подобные фразы.
-Переходи прямо к категориям и товарам.
-
-Тебе показаны два изображения: 1) исходное помещение, 2) финальный дизайн.
-ВАЖНО: Создай список покупок ТОЛЬКО для того, что реально изменилось при переходе от исходного к финальному дизайну.
-Не включай в список то, что не менялось и уже было в помещении.
-
-Создай детальный список покупок ТОЛЬКО ДЛЯ НОВЫХ или ЗАМЕНЕННЫХ элементов с:
-1. Категориями (Отделка стен, Пол, Потолок, Мебель, Освещение, Декор)
-2. Для каждого товара укажи:
-   - Конкретное название товара и артикул (если возможно)
-   - Описание
-   - Количество
-   - Примерная цена в рублях
-
-Формат ответа:
-### Категория
-1. **Название товара (артикул)** - описание
-   - Количество: X шт/м²/л
-   - Цена: ~X руб""",
-                        f"""Тип помещения: {st.session_state.room_type}
-
-Рекомендации по материалам:
-{st.session_state.saved_recommendations if st.session_state.saved_recommendations else 'Используй анализ изображения'}
-
-ПЕРВОЕ ИЗОБРАЖЕНИЕ (слева): исходное помещение
-ВТОРОЕ ИЗОБРАЖЕНИЕ (справа): финальный дизайн
-
-Сравни эти два изображения и создай список покупок ТОЛЬКО для измененных элементов.""",
-                        design_image_bytes,
-                        st.session_state.uploaded_image_bytes
-                    )
-                    st.session_state.saved_shopping_list = shopping_list
-                    auto_save_project()
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"Ошибка при создании списка: {str(e)}")
+                design_image = get_variant_image(selected_variant)
+            
+                with shopping_list_placeholder.container():
+                    with st.spinner("🛒 Создаю список покупок..."):
+                        try:
+                            with pipeline_stage("shopping_list"):
+                                shopping_list = st.write_stream(stream_gemini_vision_markdown(
+                                    SYSTEM_PROMPT_SHOPPING_LIST,
+                                    build_shopping_list_request(st.session_state.room_type, st.session_state.saved_recommendations),
+                                    design_image,
+                                    get_uploaded_image()
+                                ))
+                            set_markdown_shopping_list(shopping_list)
+                            auto_save_project()
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Ошибка при создании списка: {str(e)}")
         
         st.divider()
         
@@ -882,12 +1491,14 @@ if st.session_state.images:
                         st.error("❌ Сначала создайте рекомендации и список покупок")
                     else:
                         with st.spinner("📄 Генерирую PDF..."):
-                            design_url = st.session_state.images[st.session_state.selected_variant_idx]['url']
+                            design_image = get_variant_image(st.session_state.images[st.session_state.selected_variant_idx])
                             pdf_bytes = generate_design_project_pdf(
                                 st.session_state.room_type,
                                 st.session_state.saved_recommendations,
                                 st.session_state.saved_shopping_list,
-                                design_url
+                                design_image,
+                                st.session_state.saved_shopping_items,
+                                st.session_state.saved_budget
                             )
                             
                             moscow_time = get_moscow_time()
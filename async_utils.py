@@ -0,0 +1,204 @@
+import asyncio
+import os
+from gemini_client import get_async_http_client, post_json_async
+from rate_limiter import async_call_with_retry
+from telemetry import model_call, payload_size, record_cache_hit, record_usage
+from image_value import ImageValue, as_image
+from response_cache import RESPONSE_CACHE_ENABLED, get_response_cache, make_cache_key
+from utils import (
+    _analysis_prompt, _extract_analysis, _image_request_body, _image_response, _json_field,
+    _refine_user_text, _refined_prompt
+)
+
+GEMINI_ASYNC_TIMEOUT = float(os.getenv("GEMINI_ASYNC_TIMEOUT", "180"))
+GEMINI_IMAGE_ASYNC_TIMEOUT = float(os.getenv("GEMINI_IMAGE_ASYNC_TIMEOUT", "300"))
+
+# Асинхронные аналоги функций utils.py. Запросы идут в REST API Gemini через httpx.AsyncClient:
+# client.aio в google-genai 1.2.0 выполняет синхронный запрос в asyncio.to_thread, то есть всё равно
+# занимает поток на весь запрос и не прерывает его при отмене.
+#
+# timeout ограничивает весь вызов вместе с повторами и ожиданием лимита запросов. При отмене задачи
+# (task.cancel(), выход из asyncio.timeout снаружи) HTTP-запрос прерывается, а соединение возвращается в пул.
+
+
+def _part(item) -> dict:
+    if isinstance(item, str):
+        return {"text": item}
+    image = as_image(item)
+    return {"inline_data": {"mime_type": image.mime, "data": image.b64}}
+
+
+def _request_body(items: list, temperature: float = 0.7, max_output_tokens: int = None, json_response: bool = False) -> dict:
+    generation_config = {"temperature": temperature}
+    if max_output_tokens:
+        generation_config["maxOutputTokens"] = max_output_tokens
+    if json_response:
+        generation_config["responseMimeType"] = "application/json"
+    return {
+        "contents": [{"parts": [_part(item) for item in items if item]}],
+        "generationConfig": generation_config,
+    }
+
+
+def _response_text(response_data: dict) -> str:
+    """Склеивает текстовые части первого кандидата ответа REST API"""
+    candidates = response_data.get("candidates") or []
+    if not candidates:
+        return None
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    text = ''.join(part.get("text", "") for part in parts if not part.get("thought")).strip()
+    return text or None
+
+
+async def _generate_content(model: str, operation: str, body: dict, request_bytes: int, timeout: float) -> dict:
+    """Один вызов generateContent с лимитами, повторами и телеметрией; возвращает JSON ответа"""
+    with model_call(model, operation, request_bytes) as call:
+        try:
+            async with asyncio.timeout(timeout):
+                response = await async_call_with_retry(
+                    model,
+                    lambda: post_json_async(f"/v1beta/models/{model}:generateContent", body, timeout=timeout)
+                )
+        except TimeoutError:
+            raise Exception(f"Превышено время ожидания ответа {model} ({timeout:g} с)")
+        call['response_bytes'] = len(response.content)
+
+        if response.status_code != 200:
+            raise Exception(f"API вернул ошибку {response.status_code}: {response.text}")
+
+        response_data = response.json()
+        record_usage(call, response_data.get("usageMetadata"))
+    return response_data
+
+
+async def call_gemini_vision_async(system_prompt: str, user_text: str, image_bytes: bytes, model: str = "gemini-2.5-pro",
+                                   temperature: float = 0.7, use_cache: bool = True, timeout: float = None) -> str:
+    """Асинхронный call_gemini_vision: анализ изображения, возвращает поле 'analysis'. Кеш ответов общий с синхронной версией."""
+    try:
+        if not image_bytes:
+            raise Exception("Изображение не загружено. Пожалуйста, загрузите фото помещения.")
+        image = as_image(image_bytes)
+
+        cache = None
+        if use_cache and RESPONSE_CACHE_ENABLED:
+            cache = get_response_cache("vision_analysis")
+            cache_key = make_cache_key("vision_analysis", model, temperature, system_prompt, user_text, image_hash=image.hash)
+            cached = await asyncio.to_thread(cache.get, cache_key)
+            if cached is not None:
+                record_cache_hit(model, "vision_analysis")
+                return cached
+
+        response_data = await _generate_content(
+            model, "vision_analysis",
+            _request_body([image, _analysis_prompt(system_prompt, user_text)], temperature, json_response=True),
+            payload_size(system_prompt, user_text, image.bytes),
+            timeout or GEMINI_ASYNC_TIMEOUT
+        )
+        raw_content = _response_text(response_data)
+
+        if not raw_content:
+            raise Exception("Пустой ответ от Gemini Vision")
+
+        result = _extract_analysis(raw_content)
+
+        if cache is not None:
+            await asyncio.to_thread(cache.set, cache_key, result, model)
+        return result
+
+    except Exception as e:
+        raise Exception(f"Ошибка Gemini Vision: {str(e)}")
+
+
+async def call_gemini_vision_markdown_async(system_prompt: str, user_text: str, image_bytes: bytes,
+                                            second_image_bytes: bytes = None, timeout: float = None) -> str:
+    """Асинхронный call_gemini_vision_markdown: ответ обычным Markdown по одному или двум изображениям"""
+    try:
+        if not image_bytes:
+            raise Exception("Изображение не загружено. Пожалуйста, загрузите фото помещения.")
+        image, second_image = as_image(image_bytes), as_image(second_image_bytes)
+
+        response_data = await _generate_content(
+            "gemini-2.5-pro", "vision_markdown",
+            _request_body([f"{system_prompt}\n\n{user_text}", image, second_image], max_output_tokens=8000),
+            payload_size(system_prompt, user_text, image.bytes, second_image and second_image.bytes),
+            timeout or GEMINI_ASYNC_TIMEOUT
+        )
+        content = _response_text(response_data)
+
+        if not content:
+            raise Exception("Пустой ответ от Gemini Vision")
+
+        return content
+
+    except Exception as e:
+        raise Exception(f"Ошибка Gemini Vision: {str(e)}")
+
+
+async def call_gemini_async(system_prompt: str, user_prompt: str, return_json_key: str = None, timeout: float = None) -> str:
+    """Асинхронный call_gemini: текстовый вызов, при return_json_key возвращает значение ключа из JSON-ответа"""
+    try:
+        full_prompt = f"""{system_prompt}
+
+{user_prompt}"""
+
+        response_data = await _generate_content(
+            "gemini-2.5-pro", "text",
+            _request_body([full_prompt], max_output_tokens=8000, json_response=bool(return_json_key)),
+            payload_size(full_prompt),
+            timeout or GEMINI_ASYNC_TIMEOUT
+        )
+        content = _response_text(response_data)
+
+        if not content:
+            raise Exception("Пустой ответ от Gemini")
+
+        if return_json_key:
+            return _json_field(content, return_json_key)
+
+        return content
+    except Exception as e:
+        raise Exception(f"Ошибка Gemini: {str(e)}")
+
+
+async def generate_image_async(source_image_bytes: bytes, prompt: str, timeout: float = None) -> ImageValue:
+    """Асинхронный generate_image: генерация изображения (gemini-2.5-flash-image), возвращает ImageValue"""
+    try:
+        source_image = as_image(source_image_bytes)
+        response_data = await _generate_content(
+            "gemini-2.5-flash-image", "image_generation",
+            _image_request_body(prompt, source_image.mime, source_image.b64),
+            payload_size(prompt, source_image.b64),
+            timeout or GEMINI_IMAGE_ASYNC_TIMEOUT
+        )
+        return _image_response(response_data)
+
+    except Exception as e:
+        raise Exception(f"Ошибка Gemini Image Generation: {str(e)}")
+
+
+async def refine_design_with_vision_async(design_image, original_prompt: str, user_feedback: str,
+                                          refine_system_prompt: str, timeout: float = None, history: str = None) -> str:
+    """Асинхронный refine_design_with_vision: новый промпт для точечной доработки дизайна"""
+    try:
+        if isinstance(design_image, str) and not design_image.startswith('data:'):
+            response = await get_async_http_client().get(design_image, timeout=10)
+            design_image = response.content
+        image = as_image(design_image)
+
+        user_text = _refine_user_text(original_prompt, user_feedback, history)
+
+        response_data = await _generate_content(
+            "gemini-2.5-pro", "refine",
+            _request_body([image, f"{refine_system_prompt}\n\n{user_text}"], json_response=True),
+            payload_size(refine_system_prompt, user_text, image.bytes),
+            timeout or GEMINI_ASYNC_TIMEOUT
+        )
+        raw_content = _response_text(response_data)
+
+        if not raw_content:
+            raise Exception("Пустой ответ от Gemini Vision при доработке дизайна")
+
+        return _refined_prompt(raw_content)
+
+    except Exception as e:
+        raise Exception(f"Ошибка при доработке дизайна с Gemini Vision: {str(e)}")
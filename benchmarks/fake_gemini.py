@@ -0,0 +1,206 @@
+import base64
+import io
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+
+_MODEL_PATH_RE = re.compile(r'^/v1beta/models/([^:]+):(generateContent|streamGenerateContent)')
+
+_MARKDOWN_SAMPLE = """### Отделка стен
+1. **Краска интерьерная (DLX-1042)** - матовая, светло-серая
+   - Количество: 12 л
+   - Цена: ~8400 руб
+2. **Декоративная штукатурка** - эффект бетона
+   - Количество: 6 м²
+   - Цена: ~5100 руб
+
+"""
+
+
+class FakeGeminiConfig:
+    """Параметры поддельного Gemini: задержка, размеры ответов и доля ошибок"""
+
+    def __init__(self, latency_ms: float = 200, jitter_ms: float = 50, image_latency_ms: float = None,
+                 text_bytes: int = 4000, image_edge: int = 1024, error_rate: float = 0.0,
+                 error_status: int = 503, stream_chunks: int = 8, seed: int = 1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.image_latency_ms = latency_ms * 4 if image_latency_ms is None else image_latency_ms
+        self.text_bytes = text_bytes
+        self.image_edge = image_edge
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stream_chunks = stream_chunks
+        self.random = random.Random(seed)
+
+
+def _markdown(size: int) -> str:
+    repeats = max(1, size // len(_MARKDOWN_SAMPLE.encode('utf-8')))
+    return _MARKDOWN_SAMPLE * repeats
+
+
+def _noise_jpeg(edge: int, seed: int) -> bytes:
+    """Шумное изображение: по размеру JPEG ближе к фотографии, чем однотонная заливка"""
+    rng = random.Random(seed)
+    small = Image.frombytes("RGB", (64, 48), bytes(rng.getrandbits(8) for _ in range(64 * 48 * 3)))
+    img = small.resize((edge, edge * 3 // 4), Image.Resampling.BICUBIC)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+class FakeGeminiServer:
+    """Локальный HTTP-сервер, отвечающий как Gemini REST API (generateContent, streamGenerateContent?alt=sse).
+
+    Используется бенчмарком вместо настоящего API: GEMINI_API_BASE_URL указывает на url сервера.
+    """
+
+    def __init__(self, config: FakeGeminiConfig = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or FakeGeminiConfig()
+        self.stats = {'requests': 0, 'errors_injected': 0, 'bytes_in': 0, 'bytes_out': 0}
+        self._lock = threading.Lock()
+        self._image_cache = {}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                server._handle(self)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-gemini", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _image(self, seed: int) -> bytes:
+        edge = self.config.image_edge
+        image = self._image_cache.get((edge, seed))
+        if image is None:
+            image = _noise_jpeg(edge, seed)
+            self._image_cache[(edge, seed)] = image
+        return image
+
+    def _sleep(self, base_ms: float):
+        jitter = self.config.random.uniform(-self.config.jitter_ms, self.config.jitter_ms)
+        time.sleep(max(0.0, base_ms + jitter) / 1000)
+
+    def _send(self, handler, status: int, body: bytes, content_type: str = "application/json", headers: dict = None):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+        self._count('bytes_out', len(body))
+
+    def _text_response(self, request: dict) -> str:
+        config = request.get("generationConfig") or request.get("generation_config") or {}
+        mime_type = config.get("responseMimeType") or config.get("response_mime_type")
+        markdown = _markdown(self.config.text_bytes)
+        schema = config.get("responseSchema") or config.get("response_schema") or {}
+        if "shopping_items" in (schema.get("properties") or {}):
+            items = [
+                {"category": category, "name": f"Товар {number}", "sku": f"DLX-{number:04d}", "description": "матовый",
+                 "quantity": 2, "unit": "шт", "unit_price_rub": 1500 + number * 100}
+                for number, category in enumerate(["Отделка стен", "Пол", "Мебель", "Освещение", "Декор"] * 4, 1)
+            ]
+            return json.dumps({
+                "recommendations": markdown,
+                "shopping_items": items,
+                "budget": {"total_rub": sum(item["quantity"] * item["unit_price_rub"] for item in items)},
+            }, ensure_ascii=False)
+        if mime_type == "application/json":
+            return json.dumps({
+                "analysis": markdown,
+                "prompt": "Transform the room into a bright scandinavian interior with light oak floor",
+            }, ensure_ascii=False)
+        return markdown
+
+    @staticmethod
+    def _usage(request_bytes: int, text: str) -> dict:
+        prompt_tokens = max(1, request_bytes // 4)
+        output_tokens = max(1, len(text) // 4)
+        return {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens,
+        }
+
+    def _handle(self, handler):
+        length = int(handler.headers.get("Content-Length") or 0)
+        raw = handler.rfile.read(length)
+        self._count('requests')
+        self._count('bytes_in', len(raw))
+
+        match = _MODEL_PATH_RE.match(handler.path)
+        if not match:
+            self._send(handler, 404, b'{"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}}')
+            return
+        model, method = match.groups()
+        request = json.loads(raw or b"{}")
+
+        is_image = "image" in model
+        self._sleep(self.config.image_latency_ms if is_image else self.config.latency_ms)
+
+        if self.config.random.random() < self.config.error_rate:
+            self._count('errors_injected')
+            status = self.config.error_status
+            body = json.dumps({"error": {"code": status, "message": "injected failure", "status": "UNAVAILABLE"}})
+            self._send(handler, status, body.encode(), headers={"Retry-After": "0"})
+            return
+
+        if is_image:
+            image = self._image(self.stats['requests'] % 8)
+            body = {
+                "candidates": [{"content": {"parts": [{"inlineData": {
+                    "mimeType": "image/jpeg",
+                    "data": base64.b64encode(image).decode("ascii"),
+                }}]}}],
+                "usageMetadata": self._usage(len(raw), ""),
+            }
+            self._send(handler, 200, json.dumps(body).encode())
+            return
+
+        text = self._text_response(request)
+        if method == "generateContent":
+            body = {
+                "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}],
+                "usageMetadata": self._usage(len(raw), text),
+            }
+            self._send(handler, 200, json.dumps(body, ensure_ascii=False).encode("utf-8"))
+            return
+
+        chunk_size = max(1, len(text) // self.config.stream_chunks + 1)
+        events = []
+        for start in range(0, len(text), chunk_size):
+            chunk = {"candidates": [{"content": {"parts": [{"text": text[start:start + chunk_size]}], "role": "model"}}]}
+            if start + chunk_size >= len(text):
+                chunk["usageMetadata"] = self._usage(len(raw), text)
+            events.append(f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n".encode("utf-8"))
+        self._send(handler, 200, b"".join(events), content_type="text/event-stream")
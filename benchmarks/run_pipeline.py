@@ -0,0 +1,343 @@
+"""Бенчмарк конвейера дизайн-проекта против локального поддельного Gemini.
+
+Запуск из корня репозитория:
+    python -m benchmarks.run_pipeline --iterations 5
+    python -m benchmarks.run_pipeline --save-baseline
+    python -m benchmarks.run_pipeline --database-url postgresql://bench@localhost/bench_tmp
+
+Меряет задержку каждого этапа (p50/p95), пиковую память Python и объём данных, записанных в БД,
+и сравнивает результат с сохранённым baseline. Память меряется отдельным проходом под tracemalloc,
+чтобы его накладные расходы не искажали задержки.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+_active_stages = []
+_db_bytes = {}
+_samples = {}
+_memory = {}
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера дизайн-проекта")
+    parser.add_argument("--iterations", type=int, default=3, help="повторов каждого этапа")
+    parser.add_argument("--app-runs", type=int, default=1, help="прогонов сквозного сценария в приложении (0 — пропустить)")
+    parser.add_argument("--variants", type=int, default=3, help="вариантов дизайна в сквозном сценарии")
+    parser.add_argument("--latency-ms", type=float, default=200, help="задержка текстовых ответов поддельного Gemini")
+    parser.add_argument("--image-latency-ms", type=float, default=800, help="задержка генерации изображения")
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--text-bytes", type=int, default=4000, help="размер текстовых ответов")
+    parser.add_argument("--image-edge", type=int, default=1024, help="длинная сторона сгенерированных изображений")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--database-url", default=None, help="БД для прогона (по умолчанию временный SQLite)")
+    parser.add_argument("--output", default=None, help="куда записать результаты JSON")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline для сравнения")
+    parser.add_argument("--save-baseline", action="store_true", help="сохранить результаты как baseline")
+    parser.add_argument("--skip-memory", action="store_true", help="не делать проход с замером памяти")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое ухудшение относительно baseline")
+    return parser.parse_args(argv)
+
+
+def _configure_environment(args, fake_url: str, workdir: str):
+    """Окружение должно быть готово до импорта модулей приложения: они читают его при импорте"""
+    os.environ["GEMINI_API_BASE_URL"] = fake_url
+    os.environ["GEMINI_API_KEY"] = "benchmark"
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["BLOB_STORE_BACKEND"] = "local"
+    os.environ["BLOB_STORE_PATH"] = os.path.join(workdir, "blobs")
+    os.environ["RESPONSE_CACHE_ENABLED"] = "0"
+    os.environ["PROMPT_CACHE_ENABLED"] = "false"
+    os.environ.setdefault("GEMINI_BACKOFF_BASE", "0.05")
+    os.environ.setdefault("GEMINI_RATE_LIMITS", "gemini-2.5-pro=6000,gemini-2.5-flash-image=6000")
+    os.environ.setdefault("GEMINI_RATE_BURST", "100")
+    os.environ.setdefault("JOB_POLL_INTERVAL", "0.05")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def _track_db_writes():
+    from sqlalchemy import event
+    from database import engine
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        verb = statement.lstrip().split(None, 1)[0].upper()
+        if verb not in ("INSERT", "UPDATE", "DELETE"):
+            return
+        if tracemalloc.is_tracing():
+            return
+        size = len(statement.encode("utf-8"))
+        rows = parameters if executemany and parameters and isinstance(parameters[0], (list, tuple, dict)) else [parameters]
+        for row in rows:
+            values = row.values() if isinstance(row, dict) else (row or ())
+            for value in values:
+                if isinstance(value, (bytes, bytearray)):
+                    size += len(value)
+                elif value is not None:
+                    size += len(str(value).encode("utf-8"))
+        for stage_name in _active_stages or ["unattributed"]:
+            _db_bytes[stage_name] = _db_bytes.get(stage_name, 0) + size
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+
+
+@contextmanager
+def stage(name: str):
+    """Замеряет время блока (или пиковую память, если включён tracemalloc) и относит к нему записи в БД"""
+    _active_stages.append(name)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if tracing:
+            peak_kb = max(0, tracemalloc.get_traced_memory()[1] - start_memory) / 1024
+            _memory[name] = max(_memory.get(name, 0), peak_kb)
+        else:
+            _samples.setdefault(name, []).append(elapsed_ms)
+        _active_stages.pop()
+
+
+def _room_photo() -> bytes:
+    from benchmarks.fake_gemini import _noise_jpeg
+    return _noise_jpeg(1600, seed=42)
+
+
+def run_library_stages(iterations: int, photo: bytes):
+    """Отдельные функции utils.py, каждая со своим замером"""
+    from generation import build_engineer_prompt
+    from prompts import SYSTEM_PROMPT_ANALYZER, SYSTEM_PROMPT_BANANA_ENGINEER, SYSTEM_PROMPT_RECOMMENDATIONS
+    from utils import (
+        call_gemini_vision,
+        call_gemini,
+        call_gemini_vision_markdown,
+        generate_image,
+        create_before_after_comparison,
+        generate_design_project_pdf,
+    )
+
+    # разовые затраты процесса (ленивые импорты ReportLab, регистрация шрифтов) не относим к первому замеру:
+    # при малом --iterations они сдвигают p50
+    create_before_after_comparison(photo, photo)
+    generate_design_project_pdf("Гостиная", "прогрев", "", photo)
+
+    for iteration in range(iterations):
+        with stage("pipeline_total"):
+            with stage("call_gemini_vision"):
+                analysis = call_gemini_vision(SYSTEM_PROMPT_ANALYZER, f"Гостиная, отдых #{iteration}", photo, use_cache=False)
+            with stage("call_gemini"):
+                prompt = call_gemini(
+                    SYSTEM_PROMPT_BANANA_ENGINEER,
+                    build_engineer_prompt(analysis, "Гостиная", "Отдых", ["Скандинавский"], "Белый", ""),
+                    return_json_key="prompt"
+                )
+            with stage("generate_image"):
+                design = generate_image(photo, prompt)
+            with stage("create_before_after_comparison"):
+                create_before_after_comparison(photo, design)
+            with stage("call_gemini_vision_markdown"):
+                recommendations = call_gemini_vision_markdown(
+                    SYSTEM_PROMPT_RECOMMENDATIONS,
+                    "Рекомендации",
+                    design,
+                    photo
+                )
+            with stage("generate_design_project_pdf"):
+                generate_design_project_pdf("Гостиная", f"{recommendations}\n#{iteration}", recommendations, design)
+
+
+def _wait_for_jobs(at, timeout: float = 120):
+    deadline = time.time() + timeout
+    while any(img.get('status') == 'pending' for img in at.session_state.images):
+        if time.time() > deadline:
+            raise Exception("Фоновые задания не завершились за отведённое время")
+        time.sleep(0.05)
+        at.run()
+
+
+def _click(at, key: str = None, label: str = None):
+    if key:
+        button = at.button(key)
+    else:
+        button = next(button for button in at.button if button.label == label)
+    button.click()
+    at.run()
+    if at.exception:
+        raise Exception(f"Ошибка приложения после нажатия {key or label}: {at.exception[0].message}")
+
+
+def run_app_flow(runs: int, variants: int, photo: bytes):
+    """Сквозной сценарий в самом app.py (AppTest): анализ → варианты → выбор с рекомендациями → список покупок.
+
+    Включает auto_save_project и фоновую очередь, поэтому отражает то, что видит пользователь.
+    """
+    from streamlit.logger import set_log_level
+    from streamlit.testing.v1 import AppTest
+    from database import db_session
+    from source_images import intern_image
+
+    set_log_level("error")
+
+    for run in range(runs):
+        at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=120)
+        at.session_state.user_id = f"bench-{run}"
+        at.session_state.username = f"bench-{run}"
+        with db_session() as db:
+            at.session_state.uploaded_image_hash = intern_image(db, photo)
+        at.run()
+
+        with stage("app_end_to_end"):
+            with stage("app_analysis"):
+                _click(at, label="🔍 Начать анализ")
+            at.multiselect("styles_multiselect").select("Скандинавский")
+            at.number_input("variant_count").set_value(variants)
+            at.run()
+            with stage("app_generate_variants"):
+                _click(at, "generate_design")
+                _wait_for_jobs(at)
+            with stage("app_select_and_recommend"):
+                _click(at, "select_0")
+            with stage("app_shopping_list"):
+                _click(at, "generate_shopping_list")
+
+
+def summarize(fake_stats: dict, args) -> dict:
+    stages = {}
+    for name, samples in _samples.items():
+        latencies = sorted(samples)
+        stages[name] = {
+            'runs': len(latencies),
+            'mean_ms': round(statistics.mean(latencies), 2),
+            'p50_ms': round(statistics.median(latencies), 2),
+            'p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+            'max_ms': round(latencies[-1], 2),
+            'peak_mem_kb': round(_memory.get(name, 0), 1),
+            'db_bytes_written': _db_bytes.get(name, 0),
+        }
+    try:
+        import resource
+        max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        max_rss_kb = None
+    return {
+        'config': {
+            'iterations': args.iterations,
+            'app_runs': args.app_runs,
+            'variants': args.variants,
+            'latency_ms': args.latency_ms,
+            'image_latency_ms': args.image_latency_ms,
+            'text_bytes': args.text_bytes,
+            'image_edge': args.image_edge,
+            'error_rate': args.error_rate,
+            'database': 'sqlite' if not args.database_url else args.database_url.split(':', 1)[0],
+        },
+        'stages': stages,
+        'max_rss_kb': max_rss_kb,
+        'fake_gemini': fake_stats,
+    }
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    """Этапы, ставшие медленнее/тяжелее baseline больше чем на tolerance (мелкие абсолютные колебания игнорируются)"""
+    regressions = []
+    for name, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(name)
+        if not previous:
+            continue
+        for metric, floor in (('p50_ms', 5.0), ('peak_mem_kb', 256.0), ('db_bytes_written', 1024)):
+            old, new = previous.get(metric, 0), current.get(metric, 0)
+            if new > old * (1 + tolerance) and new - old > floor:
+                regressions.append(f"{name}.{metric}: {old} → {new}")
+    return regressions
+
+
+def _print_table(results: dict, baseline: dict = None):
+    print(f"{'этап':<34}{'p50, мс':>10}{'p95, мс':>10}{'память, КБ':>12}{'БД, байт':>12}{'baseline p50':>14}")
+    for name, values in sorted(results['stages'].items()):
+        previous = (baseline or {}).get('stages', {}).get(name, {}).get('p50_ms', '')
+        print(f"{name:<34}{values['p50_ms']:>10}{values['p95_ms']:>10}{values['peak_mem_kb']:>12}"
+              f"{values['db_bytes_written']:>12}{previous:>14}")
+
+
+def main(argv=None) -> int:
+    args = _parse_args(argv)
+    from benchmarks.fake_gemini import FakeGeminiConfig, FakeGeminiServer
+
+    server = FakeGeminiServer(FakeGeminiConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        image_latency_ms=args.image_latency_ms,
+        text_bytes=args.text_bytes,
+        image_edge=args.image_edge,
+        error_rate=args.error_rate,
+    )).start()
+
+    with tempfile.TemporaryDirectory(prefix="ai-designer-bench-") as workdir:
+        _configure_environment(args, server.url, workdir)
+        from database import init_db
+        init_db()
+        _track_db_writes()
+
+        photo = _room_photo()
+        try:
+            run_library_stages(args.iterations, photo)
+            if args.app_runs:
+                run_app_flow(args.app_runs, args.variants, photo)
+            if not args.skip_memory:
+                tracemalloc.start()
+                try:
+                    run_library_stages(1, photo)
+                    if args.app_runs:
+                        run_app_flow(1, args.variants, photo)
+                finally:
+                    tracemalloc.stop()
+        finally:
+            server.stop()
+            from jobs import get_job_queue
+            get_job_queue().stop(timeout=5)
+
+    results = summarize(dict(server.stats), args)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    _print_table(results, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Baseline сохранён в {args.baseline}")
+        return 0
+
+    if baseline:
+        if baseline.get('config') != results['config']:
+            print("Внимание: параметры прогона отличаются от baseline, сравнение может быть некорректным")
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("Регрессии относительно baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("Регрессий относительно baseline нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
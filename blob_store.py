@@ -0,0 +1,162 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+BLOB_STORE_BACKEND = os.getenv("BLOB_STORE_BACKEND", "local")
+BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH", ".blobstore")
+BLOB_STORE_S3_BUCKET = os.getenv("BLOB_STORE_S3_BUCKET")
+BLOB_STORE_S3_PREFIX = os.getenv("BLOB_STORE_S3_PREFIX", "blobs/")
+BLOB_STORE_S3_ENDPOINT_URL = os.getenv("BLOB_STORE_S3_ENDPOINT_URL")
+
+_MIME_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def content_hash(data: bytes) -> str:
+    """SHA-256 содержимого — ключ блоба в хранилище"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def sniff_mime(data: bytes) -> str:
+    """Определяет MIME-тип изображения по сигнатуре файла"""
+    for signature, mime_type in _MIME_SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+class LocalBlobStore:
+    """Хранилище блобов в локальной файловой системе, разложенное по префиксам хеша"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def put(self, data: bytes, key: str = None) -> str:
+        key = key or content_hash(data)
+        path = self._path(key)
+        if os.path.exists(path):
+            return key
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return key
+
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise Exception(f"Блоб {key} не найден в хранилище")
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3BlobStore:
+    """Хранилище блобов в S3-совместимом бакете (AWS S3, MinIO, LocalStack)"""
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str = None, client=None):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise Exception("Для S3-хранилища установите пакет boto3")
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except Exception:
+            return False
+
+    def put(self, data: bytes, key: str = None) -> str:
+        key = key or content_hash(data)
+        if not self.exists(key):
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self._object_key(key),
+                Body=data,
+                ContentType=sniff_mime(data),
+            )
+        return key
+
+    def get(self, key: str) -> bytes:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))
+        except Exception as e:
+            raise Exception(f"Блоб {key} не найден в хранилище: {str(e)}")
+        return response["Body"].read()
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_blob_store():
+    """Возвращает общее для процесса хранилище блобов, выбранное через BLOB_STORE_BACKEND"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if BLOB_STORE_BACKEND == "s3":
+                    if not BLOB_STORE_S3_BUCKET:
+                        raise Exception("BLOB_STORE_S3_BUCKET не задан для S3-хранилища")
+                    _store = S3BlobStore(
+                        BLOB_STORE_S3_BUCKET,
+                        prefix=BLOB_STORE_S3_PREFIX,
+                        endpoint_url=BLOB_STORE_S3_ENDPOINT_URL,
+                    )
+                else:
+                    _store = LocalBlobStore(BLOB_STORE_PATH)
+    return _store
+
+
+def set_blob_store(store):
+    """Подменяет хранилище (например, локальной заглушкой вместо S3)"""
+    global _store
+    with _store_lock:
+        _store = store
+
+
+def put_bytes(data: bytes, key: str = None) -> str:
+    """Сохраняет байты в хранилище и возвращает их хеш (или заданный ключ производного блоба)"""
+    return get_blob_store().put(data, key)
+
+
+def get_bytes(key: str) -> bytes:
+    """Читает байты блоба по хешу"""
+    return get_blob_store().get(key)
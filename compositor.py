@@ -0,0 +1,238 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image, ImageOps
+from blob_store import get_bytes
+
+COMPARE_MAX_EDGE = int(os.getenv("COMPARE_MAX_EDGE", "1024"))
+COMPARE_OUTPUT_FORMAT = os.getenv("COMPARE_OUTPUT_FORMAT", "jpeg").lower()
+COMPARE_QUALITY = int(os.getenv("COMPARE_QUALITY", "82"))
+COMPARE_ANIMATION_FORMAT = os.getenv("COMPARE_ANIMATION_FORMAT", "gif").lower()
+COMPARE_ANIMATION_EDGE = int(os.getenv("COMPARE_ANIMATION_EDGE", "640"))
+COMPARE_ANIMATION_FRAMES = int(os.getenv("COMPARE_ANIMATION_FRAMES", "12"))
+COMPARE_FRAME_DURATION_MS = int(os.getenv("COMPARE_FRAME_DURATION_MS", "80"))
+COMPARE_BASE_CACHE_SIZE = int(os.getenv("COMPARE_BASE_CACHE_SIZE", "32"))
+COMPARE_OUTPUT_CACHE_SIZE = int(os.getenv("COMPARE_OUTPUT_CACHE_SIZE", "64"))
+
+DIVIDER_COLOR = np.array([200, 200, 200], dtype=np.uint8)
+DIVIDER_WIDTH = 2
+
+_EXIF_ORIENTATION = 0x0112
+
+_base_cache = OrderedDict()
+_size_cache = OrderedDict()
+_base_lock = threading.Lock()
+_output_cache = OrderedDict()
+_output_lock = threading.Lock()
+
+
+def _cache_get(cache: OrderedDict, lock, key):
+    with lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def _cache_put(cache: OrderedDict, lock, key, value, limit: int):
+    with lock:
+        cache[key] = value
+        while len(cache) > limit:
+            cache.popitem(last=False)
+
+
+def _fit_size(width: int, height: int, max_edge: int) -> tuple:
+    scale = min(1.0, max_edge / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _decode(data: bytes, size: tuple) -> np.ndarray:
+    """Декодирует изображение сразу в уменьшенном масштабе (draft для JPEG) и обрезает под size без искажения пропорций"""
+    with Image.open(io.BytesIO(data)) as source:
+        rotated = source.getexif().get(_EXIF_ORIENTATION, 1) in (5, 6, 7, 8)
+        source.draft("RGB", size[::-1] if rotated else size)
+        img = ImageOps.exif_transpose(source).convert("RGB")
+        if img.size != size:
+            img = ImageOps.fit(img, size, Image.Resampling.LANCZOS)
+        return np.asarray(img, dtype=np.uint8)
+
+
+def load_base(source_hash: str, size: tuple, data: bytes = None) -> np.ndarray:
+    """Возвращает декодированное и приведённое к size изображение как массив (H, W, 3).
+
+    Массивы кешируются по хешу содержимого и размеру, поэтому повторные сравнения (другая позиция
+    разделителя, кадры анимации, следующий вариант проекта) не декодируют исходники заново.
+    Массивы в кеше доступны только для чтения.
+    """
+    key = (source_hash, size)
+    base = _cache_get(_base_cache, _base_lock, key)
+    if base is not None:
+        return base
+
+    base = _decode(data if data is not None else get_bytes(source_hash), size)
+    base.setflags(write=False)
+    _cache_put(_base_cache, _base_lock, key, base, COMPARE_BASE_CACHE_SIZE)
+    return base
+
+
+def image_size(source_hash: str, data: bytes = None, max_edge: int = None) -> tuple:
+    """Размер кадра сравнения: пропорции изображения (с учётом EXIF-поворота), вписанные в max_edge"""
+    max_edge = max_edge or COMPARE_MAX_EDGE
+    key = (source_hash, max_edge)
+    size = _cache_get(_size_cache, _base_lock, key)
+    if size is not None:
+        return size
+
+    with Image.open(io.BytesIO(data if data is not None else get_bytes(source_hash))) as img:
+        width, height = img.size
+        if img.getexif().get(_EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            width, height = height, width
+    size = _fit_size(width, height, max_edge)
+    _cache_put(_size_cache, _base_lock, key, size, COMPARE_BASE_CACHE_SIZE * 4)
+    return size
+
+
+def compose_split_frames(before: np.ndarray, after: np.ndarray, positions) -> np.ndarray:
+    """Собирает кадры «до/после» для всех позиций разделителя одной операцией.
+
+    before: (H, W, 3); after: (H, W, 3) или пакет (N, H, W, 3); positions — доли ширины от 0 до 1.
+    Возвращает (P, H, W, 3) для одного after или (N, P, H, W, 3) для пакета.
+    """
+    width = before.shape[1]
+    splits = np.clip(np.rint(np.asarray(positions, dtype=np.float32) * width), 0, width).astype(np.int32)
+    left = np.arange(width, dtype=np.int32)[None, :] < splits[:, None]
+
+    after = np.asarray(after)
+    if after.ndim == 4:
+        after = after[:, None]
+    frames = np.where(left[:, None, :, None], before, after)
+
+    half = DIVIDER_WIDTH // 2
+    for index, split in enumerate(splits.tolist()):
+        if 0 < split < width:
+            frames[..., index, :, max(0, split - half):split + half, :] = DIVIDER_COLOR
+    return frames
+
+
+def _encode_frame(frame: np.ndarray, output_format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    img = Image.fromarray(frame)
+    if output_format == "webp":
+        img.save(buffer, format="WEBP", quality=quality, method=4)
+    elif output_format == "png":
+        img.save(buffer, format="PNG", optimize=False)
+    else:
+        img.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def _encode_animation(frames: np.ndarray, output_format: str, quality: int, duration_ms: int) -> bytes:
+    buffer = io.BytesIO()
+    images = [Image.fromarray(frame) for frame in frames]
+    if output_format == "gif":
+        # общая палитра по крайним кадрам шторки: в них целиком «после» и целиком «до»
+        palette_source = Image.fromarray(np.concatenate([frames[0], frames[len(frames) // 2]], axis=1))
+        palette = palette_source.quantize(colors=255, method=Image.Quantize.MEDIANCUT)
+        images = [img.quantize(palette=palette, dither=Image.Dither.NONE) for img in images]
+        images[0].save(buffer, format="GIF", save_all=True, append_images=images[1:],
+                       duration=duration_ms, loop=0, optimize=False)
+    else:
+        images[0].save(buffer, format="WEBP", save_all=True, append_images=images[1:],
+                       duration=duration_ms, loop=0, quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def wipe_positions(frames: int = None) -> list:
+    """Позиции разделителя для анимации шторки: слева направо и обратно"""
+    frames = max(2, frames or COMPARE_ANIMATION_FRAMES)
+    forward = np.linspace(0.0, 1.0, frames // 2 + 1)
+    return np.concatenate([forward, forward[-2:0:-1]]).tolist()
+
+
+def _prepare(before_hash: str, after_hash: str, before_data: bytes, after_data: bytes, max_edge: int):
+    size = image_size(after_hash, after_data, max_edge)
+    return load_base(before_hash, size, before_data), load_base(after_hash, size, after_data)
+
+
+def create_comparison(before_hash: str, after_hash: str, positions=(0.5,), output_format: str = None,
+                      quality: int = None, max_edge: int = None,
+                      before_data: bytes = None, after_data: bytes = None) -> list:
+    """Создаёт сравнения «до/после» для каждой позиции разделителя (доля ширины) и возвращает список
+    закодированных кадров (JPEG по умолчанию, также webp/png). Изображения берутся из хранилища блобов
+    по хешам, либо из переданных байтов."""
+    output_format = output_format or COMPARE_OUTPUT_FORMAT
+    quality = quality or COMPARE_QUALITY
+    key = (before_hash, after_hash, tuple(positions), output_format, quality, max_edge or COMPARE_MAX_EDGE)
+    cached = _cache_get(_output_cache, _output_lock, key)
+    if cached is not None:
+        return cached
+
+    before, after = _prepare(before_hash, after_hash, before_data, after_data, max_edge)
+    frames = compose_split_frames(before, after, positions)
+    encoded = [_encode_frame(frame, output_format, quality) for frame in frames]
+    _cache_put(_output_cache, _output_lock, key, encoded, COMPARE_OUTPUT_CACHE_SIZE)
+    return encoded
+
+
+def create_wipe_animation(before_hash: str, after_hash: str, frames: int = None, output_format: str = None,
+                          quality: int = None, duration_ms: int = None, max_edge: int = None,
+                          before_data: bytes = None, after_data: bytes = None) -> bytes:
+    """Создаёт анимацию шторки «до/после» в размере до COMPARE_ANIMATION_EDGE.
+
+    По умолчанию GIF: st.image показывает анимацию только для GIF, остальные форматы перекодирует
+    в статичный JPEG. WebP (output_format="webp") заметно легче — для скачивания и внешних клиентов.
+    """
+    output_format = output_format or COMPARE_ANIMATION_FORMAT
+    quality = quality or COMPARE_QUALITY
+    max_edge = max_edge or COMPARE_ANIMATION_EDGE
+    duration_ms = duration_ms or COMPARE_FRAME_DURATION_MS
+    positions = tuple(wipe_positions(frames))
+    key = (before_hash, after_hash, positions, output_format, quality, max_edge, duration_ms)
+    cached = _cache_get(_output_cache, _output_lock, key)
+    if cached is not None:
+        return cached
+
+    before, after = _prepare(before_hash, after_hash, before_data, after_data, max_edge)
+    animation = _encode_animation(compose_split_frames(before, after, positions), output_format, quality, duration_ms)
+    _cache_put(_output_cache, _output_lock, key, animation, COMPARE_OUTPUT_CACHE_SIZE)
+    return animation
+
+
+def create_project_comparisons(before_hash: str, after_hashes: list, position: float = 0.5,
+                               animate: bool = False, output_format: str = None, quality: int = None,
+                               max_edge: int = None) -> dict:
+    """Сравнения исходного фото со всеми вариантами проекта за один проход: исходник декодируется один раз
+    на каждый размер кадра, варианты одного размера складываются в пакет и компонуются одной операцией.
+    Возвращает словарь {хеш варианта: байты изображения}."""
+    if animate:
+        return {
+            after_hash: create_wipe_animation(before_hash, after_hash, output_format=output_format,
+                                              quality=quality, max_edge=max_edge)
+            for after_hash in dict.fromkeys(after_hashes)
+        }
+
+    output_format = output_format or COMPARE_OUTPUT_FORMAT
+    quality = quality or COMPARE_QUALITY
+    max_edge = max_edge or COMPARE_MAX_EDGE
+    results = {}
+    groups = {}
+    for after_hash in dict.fromkeys(after_hashes):
+        cached = _cache_get(_output_cache, _output_lock,
+                            (before_hash, after_hash, (position,), output_format, quality, max_edge))
+        if cached is not None:
+            results[after_hash] = cached[0]
+        else:
+            groups.setdefault(image_size(after_hash, max_edge=max_edge), []).append(after_hash)
+
+    for size, hashes in groups.items():
+        before = load_base(before_hash, size)
+        afters = np.stack([load_base(after_hash, size) for after_hash in hashes])
+        for after_hash, frames in zip(hashes, compose_split_frames(before, afters, (position,))):
+            encoded = [_encode_frame(frame, output_format, quality) for frame in frames]
+            _cache_put(_output_cache, _output_lock,
+                       (before_hash, after_hash, (position,), output_format, quality, max_edge),
+                       encoded, COMPARE_OUTPUT_CACHE_SIZE)
+            results[after_hash] = encoded[0]
+    return results
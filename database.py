@@ -1,22 +1,147 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, JSON
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, DateTime, Float, ForeignKey, JSON, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship
+from sqlalchemy.pool import NullPool
+from contextlib import contextmanager
 from datetime import datetime
 import os
+import threading
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "300"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() == "true"
+DB_KEEPALIVES_IDLE = int(os.getenv("DB_KEEPALIVES_IDLE", "30"))
 
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-    pool_recycle=3600,
-    connect_args={"sslmode": "require"} if DATABASE_URL else {}
-)
+_is_postgres = bool(DATABASE_URL and DATABASE_URL.startswith("postgres"))
+
+
+def _engine_options() -> dict:
+    """Параметры пула и подключения.
+
+    Обычный режим (PostgreSQL): небольшой пул на процесс (DB_POOL_SIZE + DB_MAX_OVERFLOW), LIFO, чтобы лишние соединения
+    простаивали и закрывались по DB_POOL_RECYCLE раньше, чем их оборвёт сервер, TCP keepalive и
+    statement_timeout в параметрах подключения.
+    DB_PGBOUNCER=true: соединения держит PgBouncer (transaction pooling), поэтому свой пул не ведётся,
+    а statement_timeout задаётся через SET LOCAL в каждой транзакции — параметры запуска PgBouncer не пропускает.
+    """
+    connect_args = {}
+    if _is_postgres:
+        connect_args = {
+            "sslmode": "require",
+            "keepalives": 1,
+            "keepalives_idle": DB_KEEPALIVES_IDLE,
+            "keepalives_interval": 10,
+            "keepalives_count": 3,
+        }
+        if DB_STATEMENT_TIMEOUT_MS and not DB_PGBOUNCER:
+            connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    if DB_PGBOUNCER:
+        return {"poolclass": NullPool, "connect_args": connect_args}
+    options = {
+        "pool_pre_ping": True,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "connect_args": connect_args,
+    }
+    if _is_postgres:
+        # размеры задаются только для QueuePool: SQLite в памяти работает на SingletonThreadPool,
+        # который эти параметры не принимает
+        options.update({
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_use_lifo": True,
+        })
+    return options
+
+
+engine = create_engine(DATABASE_URL, **_engine_options())
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ScopedSession = scoped_session(SessionLocal)
+
+_pool_stats_lock = threading.Lock()
+_pool_stats = {
+    'connects': 0,
+    'checkouts': 0,
+    'checkins': 0,
+    'invalidations': 0,
+    'checked_out': 0,
+    'peak_checked_out': 0,
+}
+
+
+def _count_pool(key: str, value=1):
+    with _pool_stats_lock:
+        _pool_stats[key] += value
+        if key == 'checked_out':
+            _pool_stats['peak_checked_out'] = max(_pool_stats['peak_checked_out'], _pool_stats['checked_out'])
+
+
+@event.listens_for(engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    _count_pool('connects')
+
+
+@event.listens_for(engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    _count_pool('checkouts')
+    _count_pool('checked_out')
+
+
+@event.listens_for(engine, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    _count_pool('checkins')
+    _count_pool('checked_out', -1)
+
+
+@event.listens_for(engine, "invalidate")
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    _count_pool('invalidations')
+
+
+if _is_postgres and DB_PGBOUNCER and DB_STATEMENT_TIMEOUT_MS:
+    @event.listens_for(SessionLocal, "after_begin")
+    def _set_statement_timeout(session, transaction, connection):
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+
+
+@contextmanager
+def db_session():
+    """Сессия БД текущего запуска скрипта: Streamlit выполняет каждый запуск в своём потоке, и все блоки
+    одного запуска получают один объект Session. При выходе незавершённая транзакция откатывается,
+    а соединение сразу возвращается в пул. Вложенно не используется: внутренний блок закрыл бы внешний."""
+    db = ScopedSession()
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def get_pool_stats() -> dict:
+    """Метрики пула соединений БД: размер, занятые и переполняющие соединения, подключения, разрывы"""
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+    stats['pgbouncer'] = DB_PGBOUNCER
+    pool = engine.pool
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        method = getattr(pool, name, None)
+        stats[f"pool_{name}"] = method() if method is not None else None
+    stats['max_overflow'] = None if DB_PGBOUNCER else DB_MAX_OVERFLOW
+    return stats
+
 Base = declarative_base()
 
 class Project(Base):
     __tablename__ = "projects"
+    __table_args__ = (
+        Index("ix_projects_user_updated", "user_id", "updated_at", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(String, nullable=False, index=True)
@@ -25,23 +150,30 @@ class Project(Base):
     purpose = Column(Text)
     analysis = Column(Text)
     uploaded_image_b64 = Column(Text)
+    uploaded_image_hash = Column(String(64), index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     design_variants = relationship("DesignVariant", back_populates="project", cascade="all, delete-orphan")
     recommendations = relationship("Recommendation", back_populates="project", cascade="all, delete-orphan")
+    shopping_items = relationship("ShoppingItem", back_populates="project", cascade="all, delete-orphan")
 
 class DesignVariant(Base):
     __tablename__ = "design_variants"
     
     id = Column(Integer, primary_key=True, index=True)
     project_id = Column(Integer, ForeignKey("projects.id"))
-    image_url = Column(String, nullable=False)
+    image_url = Column(String)
+    image_hash = Column(String(64), index=True)
     prompt = Column(Text, nullable=False)
     iterations = Column(Integer, default=0)
     styles = Column(String)
     main_color = Column(String)
     additional_preferences = Column(Text)
+    parent_id = Column(Integer, ForeignKey("design_variants.id", ondelete="SET NULL"), index=True)
+    origin = Column(String(16))
+    delta = Column(Text)
+    lineage = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     project = relationship("Project", back_populates="design_variants")
@@ -58,6 +190,78 @@ class Recommendation(Base):
     
     project = relationship("Project", back_populates="recommendations")
 
+class ShoppingItem(Base):
+    """Позиция списка покупок проекта. price_rub — цена за единицу, сумма позиции — quantity * price_rub."""
+    __tablename__ = "shopping_items"
+    __table_args__ = (
+        Index("ix_shopping_items_project_position", "project_id", "position"),
+        Index("ix_shopping_items_category_name", "category", "name"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), nullable=False)
+    position = Column(Integer, nullable=False, default=0)
+    category = Column(String, nullable=False)
+    name = Column(String, nullable=False)
+    sku = Column(String, index=True)
+    description = Column(Text)
+    quantity = Column(Float, nullable=False, default=1.0)
+    unit = Column(String)
+    price_rub = Column(Float, nullable=False, default=0.0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    project = relationship("Project", back_populates="shopping_items")
+
+class ModelResponseCache(Base):
+    __tablename__ = "model_response_cache"
+    
+    key = Column(String(64), primary_key=True)
+    namespace = Column(String, nullable=False, index=True)
+    model = Column(String)
+    value = Column(Text, nullable=False)
+    hit_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
+    last_accessed_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class GenerationJob(Base):
+    __tablename__ = "generation_jobs"
+    __table_args__ = (
+        Index("ix_generation_jobs_status_created", "status", "created_at"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, index=True)
+    project_id = Column(Integer, ForeignKey("projects.id", ondelete="SET NULL"), index=True)
+    variant_id = Column(Integer, index=True)
+    kind = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="queued")
+    progress = Column(Integer, default=0)
+    stage = Column(String)
+    payload = Column(Text, nullable=False)
+    result_hash = Column(String(64))
+    result_prompt = Column(Text)
+    error = Column(Text)
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+class SourceImage(Base):
+    """Исходное фото помещения, общее для всех проектов с тем же содержимым.
+    ref_count — число проектов, ссылающихся на изображение через uploaded_image_hash."""
+    __tablename__ = "images"
+    
+    hash = Column(String(64), primary_key=True)
+    perceptual_hash = Column(String(16), index=True)
+    mime_type = Column(String)
+    width = Column(Integer)
+    height = Column(Integer)
+    size_bytes = Column(Integer)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+
 def init_db():
     try:
         Base.metadata.create_all(bind=engine)
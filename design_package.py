@@ -0,0 +1,135 @@
+import json
+import os
+
+DESIGN_PACKAGE_MODE = os.getenv("DESIGN_PACKAGE_MODE", "combined").lower()
+
+SHOPPING_CATEGORIES = ["Отделка стен", "Пол", "Потолок", "Мебель", "Освещение", "Декор"]
+
+DESIGN_PACKAGE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "recommendations": {"type": "STRING"},
+        "shopping_items": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "category": {"type": "STRING", "enum": SHOPPING_CATEGORIES},
+                    "name": {"type": "STRING"},
+                    "sku": {"type": "STRING"},
+                    "description": {"type": "STRING"},
+                    "quantity": {"type": "NUMBER"},
+                    "unit": {"type": "STRING"},
+                    "unit_price_rub": {"type": "NUMBER"},
+                },
+                "required": ["category", "name", "quantity", "unit", "unit_price_rub"],
+                "property_ordering": ["category", "name", "sku", "description", "quantity", "unit", "unit_price_rub"],
+            },
+        },
+        "budget": {
+            "type": "OBJECT",
+            "properties": {
+                "total_rub": {"type": "NUMBER"},
+                "by_category": {
+                    "type": "ARRAY",
+                    "items": {
+                        "type": "OBJECT",
+                        "properties": {
+                            "category": {"type": "STRING"},
+                            "total_rub": {"type": "NUMBER"},
+                        },
+                        "required": ["category", "total_rub"],
+                    },
+                },
+            },
+            "required": ["total_rub"],
+        },
+    },
+    "required": ["recommendations", "shopping_items", "budget"],
+    "property_ordering": ["recommendations", "shopping_items", "budget"],
+}
+
+
+def _number(value) -> float:
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _format_number(value: float) -> str:
+    return f"{value:g}" if value != int(value) else str(int(value))
+
+
+def normalize_items(items: list) -> list:
+    """Приводит позиции списка покупок к единому виду: числа, пустые строки вместо None, известные категории"""
+    normalized = []
+    for item in items or []:
+        if not isinstance(item, dict) or not item.get("name"):
+            continue
+        category = item.get("category") or "Декор"
+        normalized.append({
+            "category": category if category in SHOPPING_CATEGORIES else "Декор",
+            "name": str(item["name"]).strip(),
+            "sku": str(item.get("sku") or "").strip(),
+            "description": str(item.get("description") or "").strip(),
+            "quantity": _number(item.get("quantity")) or 1.0,
+            "unit": str(item.get("unit") or "шт").strip(),
+            "unit_price_rub": _number(item.get("unit_price_rub")),
+        })
+    return normalized
+
+
+def build_budget(items: list, model_budget: dict = None) -> dict:
+    """Бюджет по позициям списка покупок: суммы считаются из количества и цены, а не берутся у модели.
+    Итог модели используется только если позиций нет."""
+    by_category = {}
+    for item in items:
+        by_category[item["category"]] = by_category.get(item["category"], 0.0) + item["quantity"] * item["unit_price_rub"]
+    total = sum(by_category.values())
+    if not items and model_budget:
+        total = _number(model_budget.get("total_rub"))
+        for entry in model_budget.get("by_category") or []:
+            if isinstance(entry, dict) and entry.get("category"):
+                by_category[entry["category"]] = _number(entry.get("total_rub"))
+    return {
+        "total_rub": round(total),
+        "by_category": {category: round(amount) for category, amount in by_category.items()},
+        "items_count": len(items),
+    }
+
+
+def format_shopping_list(items: list) -> str:
+    """Markdown списка покупок в прежнем формате (### Категория / **Название (артикул)** / Количество / Цена)"""
+    lines = []
+    for category in SHOPPING_CATEGORIES:
+        category_items = [item for item in items if item["category"] == category]
+        if not category_items:
+            continue
+        lines.append(f"### {category}")
+        for number, item in enumerate(category_items, 1):
+            title = f"{item['name']} ({item['sku']})" if item["sku"] else item["name"]
+            description = f" - {item['description']}" if item["description"] else ""
+            lines.append(f"{number}. **{title}**{description}")
+            lines.append(f"   - Количество: {_format_number(item['quantity'])} {item['unit']}")
+            lines.append(f"   - Цена: ~{round(item['unit_price_rub'] * item['quantity'])} руб")
+        lines.append("")
+    return "\n".join(lines).strip()
+
+
+def parse_design_package(raw_content: str) -> dict:
+    """Разбирает JSON-ответ комбинированного запроса: recommendations, items, shopping_list (Markdown) и budget"""
+    try:
+        parsed = json.loads(raw_content)
+    except json.JSONDecodeError as e:
+        raise Exception(f"Не удалось распарсить JSON ответ: {e}")
+    if not isinstance(parsed, dict) or not parsed.get("recommendations"):
+        raise Exception("В ответе нет рекомендаций")
+
+    items = normalize_items(parsed.get("shopping_items"))
+    return {
+        "recommendations": parsed["recommendations"].strip(),
+        "items": items,
+        "shopping_list": format_shopping_list(items),
+        "budget": build_budget(items, parsed.get("budget") if isinstance(parsed.get("budget"), dict) else None),
+    }
@@ -0,0 +1,166 @@
+import asyncio
+import os
+import threading
+import weakref
+from contextlib import contextmanager
+import httpx
+from google import genai
+from google.genai import types
+
+GEMINI_API_BASE_URL = os.getenv("GEMINI_API_BASE_URL", "https://generativelanguage.googleapis.com")
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", "20"))
+GEMINI_KEEPALIVE_EXPIRY = float(os.getenv("GEMINI_KEEPALIVE_EXPIRY", "120"))
+GEMINI_HTTP2 = os.getenv("GEMINI_HTTP2", "1") == "1"
+
+_lock = threading.Lock()
+_genai_clients = {}
+_http_client = None
+_async_http_clients = weakref.WeakKeyDictionary()
+_stats = {
+    'genai_clients_created': 0,
+    'http_clients_created': 0,
+    'async_http_clients_created': 0,
+    'requests_total': 0,
+    'requests_failed': 0,
+    'in_flight': 0,
+    'peak_in_flight': 0,
+}
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def get_api_key() -> str:
+    """Возвращает ключ Gemini API из окружения"""
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        raise Exception("GEMINI_API_KEY не найден. Пожалуйста, добавьте API ключ в настройки.")
+    return api_key
+
+
+def get_genai_client() -> genai.Client:
+    """Возвращает общий для процесса клиент google-genai (один на API ключ)"""
+    api_key = get_api_key()
+    client = _genai_clients.get(api_key)
+    if client is None:
+        with _lock:
+            client = _genai_clients.get(api_key)
+            if client is None:
+                http_options = None
+                if GEMINI_API_BASE_URL != "https://generativelanguage.googleapis.com":
+                    http_options = types.HttpOptions(base_url=GEMINI_API_BASE_URL)
+                client = genai.Client(api_key=api_key, http_options=http_options)
+                _genai_clients[api_key] = client
+                _stats['genai_clients_created'] += 1
+    return client
+
+
+def get_http_client() -> httpx.Client:
+    """Возвращает общий httpx-клиент с пулом keep-alive соединений (HTTP/2, если установлен h2)"""
+    global _http_client
+    if _http_client is None:
+        with _lock:
+            if _http_client is None:
+                _http_client = httpx.Client(
+                    base_url=GEMINI_API_BASE_URL,
+                    http2=GEMINI_HTTP2 and _http2_available(),
+                    limits=_http_limits(),
+                    timeout=httpx.Timeout(120.0, connect=10.0),
+                )
+                _stats['http_clients_created'] += 1
+    return _http_client
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=GEMINI_POOL_SIZE,
+        max_keepalive_connections=GEMINI_POOL_SIZE,
+        keepalive_expiry=GEMINI_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Возвращает httpx.AsyncClient текущего цикла событий: соединения асинхронного клиента привязаны к циклу,
+    поэтому пул общий для всех корутин цикла, а у каждого цикла свой"""
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=GEMINI_API_BASE_URL,
+            http2=GEMINI_HTTP2 and _http2_available(),
+            limits=_http_limits(),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        )
+        _async_http_clients[loop] = client
+        with _lock:
+            _stats['async_http_clients_created'] += 1
+    return client
+
+
+async def close_async_http_client():
+    """Закрывает асинхронный клиент текущего цикла; вызывать перед завершением цикла (asyncio.run)"""
+    client = _async_http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+@contextmanager
+def track_request():
+    """Учитывает запрос к модели в статистике пула"""
+    with _lock:
+        _stats['requests_total'] += 1
+        _stats['in_flight'] += 1
+        _stats['peak_in_flight'] = max(_stats['peak_in_flight'], _stats['in_flight'])
+    try:
+        yield
+    except Exception:
+        with _lock:
+            _stats['requests_failed'] += 1
+        raise
+    finally:
+        with _lock:
+            _stats['in_flight'] -= 1
+
+
+def post_json(path: str, body: dict, timeout: float = 120) -> httpx.Response:
+    """POST JSON в Gemini REST API через общий пул соединений"""
+    with track_request():
+        return get_http_client().post(
+            path,
+            json=body,
+            headers={"x-goog-api-key": get_api_key()},
+            timeout=timeout,
+        )
+
+
+async def post_json_async(path: str, body: dict, timeout: float = 120) -> httpx.Response:
+    """Асинхронный POST JSON в Gemini REST API через пул клиента текущего цикла событий"""
+    with track_request():
+        return await get_async_http_client().post(
+            path,
+            json=body,
+            headers={"x-goog-api-key": get_api_key()},
+            timeout=timeout,
+        )
+
+
+def get_pool_stats() -> dict:
+    """Статистика пула: созданные клиенты, запросы, открытые соединения"""
+    with _lock:
+        stats = dict(_stats)
+    stats['pool_size'] = GEMINI_POOL_SIZE
+    stats['http2'] = GEMINI_HTTP2 and _http2_available()
+    connections = []
+    if _http_client is not None:
+        try:
+            connections = list(_http_client._transport._pool.connections)
+        except AttributeError:
+            pass
+    stats['open_connections'] = len(connections)
+    stats['idle_connections'] = sum(1 for c in connections if c.is_idle())
+    return stats
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+from prompts import SYSTEM_PROMPT_BANANA_ENGINEER
+from response_cache import get_response_cache
+from telemetry import record_cache_hit
+from utils import call_gemini
+
+MAX_VARIANTS_PER_REQUEST = int(os.getenv("MAX_VARIANTS_PER_REQUEST", "8"))
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "true").lower() == "true"
+PROMPT_CACHE_COLOR_LEVELS = int(os.getenv("PROMPT_CACHE_COLOR_LEVELS", "6"))
+
+_PROMPT_VERSION = hashlib.sha256(SYSTEM_PROMPT_BANANA_ENGINEER.encode('utf-8')).hexdigest()
+
+
+def build_engineer_prompt(analysis: str, room_type: str, purpose: str, styles: list, main_color: str, additional_preferences: str) -> str:
+    """Собирает пользовательский промпт для промпт-инженера BANANA"""
+    return f"""Room analysis:
+{analysis}
+
+Room type: {room_type}
+Purpose: {purpose}
+Styles: {', '.join(styles)}
+Accent color: {main_color}
+Additional preferences: {additional_preferences if additional_preferences else 'none'}
+
+Create the prompt now."""
+
+
+def quantize_color(color: str, levels: int = None) -> str:
+    """Приводит цвет #RRGGBB к ближайшему цвету палитры из levels уровней на канал (6 — 216 цветов).
+    При levels < 2 или нераспознанном значении цвет возвращается как есть."""
+    levels = PROMPT_CACHE_COLOR_LEVELS if levels is None else levels
+    value = (color or "").strip().lower()
+    if levels < 2 or len(value) != 7 or not value.startswith("#"):
+        return value
+    try:
+        channels = [int(value[i:i + 2], 16) for i in (1, 3, 5)]
+    except ValueError:
+        return value
+    step = 255 / (levels - 1)
+    return "#" + "".join(f"{round(round(channel / step) * step):02x}" for channel in channels)
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join((text or "").split()).casefold()
+
+
+def engineer_prompt_key(analysis: str, room_type: str, purpose: str, styles: list, main_color: str,
+                        additional_preferences: str, slot: int = 0) -> str:
+    """Ключ кеша промптов: хеш анализа, набор стилей без учёта порядка, цвет с точностью до палитры,
+    тексты без различий в регистре и пробелах, версия системного промпта и номер варианта в запросе"""
+    parts = {
+        'prompt_version': _PROMPT_VERSION,
+        'analysis': hashlib.sha256((analysis or "").encode('utf-8')).hexdigest(),
+        'room_type': _normalize_text(room_type),
+        'purpose': _normalize_text(purpose),
+        'styles': sorted({_normalize_text(style) for style in styles}),
+        'color': quantize_color(main_color),
+        'preferences': _normalize_text(additional_preferences),
+        'slot': slot,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def engineer_prompt(analysis: str, room_type: str, purpose: str, styles: list, main_color: str,
+                    additional_preferences: str, slot: int = 0) -> str:
+    """Промпт для генерации изображения от промпт-инженера BANANA.
+
+    Готовые промпты кешируются по нормализованным входам (engineer_prompt_key), так что повторный запрос
+    с теми же настройками сразу переходит к генерации изображения. slot — номер варианта среди одинаковых
+    заданий одного запроса: у каждого свой промпт, и варианты не становятся копиями друг друга.
+    """
+    cache = None
+    if PROMPT_CACHE_ENABLED:
+        cache = get_response_cache("engineered_prompt")
+        key = engineer_prompt_key(analysis, room_type, purpose, styles, main_color, additional_preferences, slot)
+        cached = cache.get(key)
+        if cached is not None:
+            record_cache_hit("gemini-2.5-pro", "prompt_engineer")
+            return cached
+
+    prompt = call_gemini(
+        SYSTEM_PROMPT_BANANA_ENGINEER,
+        build_engineer_prompt(analysis, room_type, purpose, styles, main_color, additional_preferences),
+        return_json_key="prompt"
+    )
+    if cache is not None:
+        cache.set(key, prompt, "gemini-2.5-pro")
+    return prompt
+
+
+def get_prompt_cache_stats() -> dict:
+    """Попадания, промахи и вытеснения кеша промптов"""
+    return get_response_cache("engineered_prompt").get_stats()
+
+
+def build_variant_specs(styles: list, main_color: str, additional_preferences: str, count: int, per_style: bool) -> list:
+    """Формирует список заданий на генерацию: count вариантов всех стилей вместе или count вариантов каждого стиля отдельно"""
+    style_sets = [[style] for style in styles] if per_style else [list(styles)]
+    specs = [
+        {
+            'styles': style_set,
+            'main_color': main_color,
+            'additional_preferences': additional_preferences,
+            'slot': slot
+        }
+        for style_set in style_sets
+        for slot in range(count)
+    ]
+    return specs[:MAX_VARIANTS_PER_REQUEST]
+
@@ -0,0 +1,284 @@
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from blob_store import LocalBlobStore, get_blob_store, get_bytes
+from image_value import ImageValue
+
+logger = logging.getLogger("ai_designer.image_memory")
+
+IMAGE_MEMORY_BUDGET_MB = float(os.getenv("IMAGE_MEMORY_BUDGET_MB", "256"))
+IMAGE_SESSION_BUDGET_MB = float(os.getenv("IMAGE_SESSION_BUDGET_MB", "24"))
+IMAGE_SPILL_PATH = os.getenv("IMAGE_SPILL_PATH", os.path.join(tempfile.gettempdir(), "ai-designer-spill"))
+IMAGE_SPILL_BUDGET_MB = float(os.getenv("IMAGE_SPILL_BUDGET_MB", "2048"))
+
+_MB = 1024 * 1024
+
+
+def _load_from_store(key: str) -> ImageValue:
+    value = ImageValue(get_bytes(key))
+    value._hash = key
+    return value
+
+
+class ImageMemoryManager:
+    """Единый ограниченный по памяти кеш изображений процесса (ImageValue по хешу содержимого).
+
+    Им пользуются сессии Streamlit (в st.session_state лежат только хеши) и фоновые задачи: задания
+    генерации, предвыборка рекомендаций, исходные фото. Вместе с байтами кешируются вычисленные
+    представления ImageValue, например base64 исходного фото для запросов генерации.
+
+    Два бюджета:
+    - session_budget — сколько удерживает одна сессия; при превышении она отпускает свои самые старые
+      изображения (если они не нужны другим сессиям, они вытесняются из памяти);
+    - budget — общий объём в памяти процесса; при превышении вытесняются самые давно использованные.
+    Обращения без session_id (фоновые задачи) не закрепляют изображение и подчиняются только общему бюджету.
+    Размер записи — ImageValue.nbytes; представления, посчитанные после выдачи, учитываются при следующем обращении.
+
+    Вытесненные изображения сбрасываются на локальный диск (spill_path), если хранилище блобов не локальное:
+    повторное чтение с диска дешевле запроса к S3. Для локального хранилища сам блоб уже на диске.
+    """
+
+    def __init__(self, budget_bytes: int, session_budget_bytes: int, spill_path: str = None,
+                 spill_budget_bytes: int = 0, loader=None):
+        self.budget_bytes = budget_bytes
+        self.session_budget_bytes = session_budget_bytes
+        self.spill_path = spill_path
+        self.spill_budget_bytes = spill_budget_bytes
+        self.loader = loader or _load_from_store
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._owners = {}
+        self._sessions = {}
+        self._spilled = OrderedDict()
+        self._resident_bytes = 0
+        self._spilled_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'loads': 0,
+            'session_evictions': 0,
+            'global_evictions': 0,
+            'spills': 0,
+            'spill_evictions': 0,
+        }
+
+    def _spill_enabled(self) -> bool:
+        return bool(self.spill_path) and self.spill_budget_bytes > 0 and not isinstance(get_blob_store(), LocalBlobStore)
+
+    def _spill_file(self, key: str) -> str:
+        return os.path.join(self.spill_path, key)
+
+    def _resize(self, key: str):
+        """Обновляет учтённый размер записи. Под self._lock."""
+        size = self._entries[key].nbytes
+        self._resident_bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+
+    def _remove(self, key: str, victims: list):
+        """Убирает запись из памяти. Под self._lock."""
+        value = self._entries.pop(key, None)
+        if value is None:
+            return
+        self._resident_bytes -= self._sizes.pop(key, 0)
+        for session_id in self._owners.pop(key, ()):
+            self._sessions[session_id].pop(key, None)
+        victims.append((key, value))
+
+    def _drop_owner(self, session_id: str, key: str, victims: list):
+        """Снимает владение сессии; изображение без владельцев вытесняется из памяти. Под self._lock."""
+        owners = self._owners.get(key)
+        if owners is None:
+            return
+        owners.discard(session_id)
+        if not owners:
+            self._remove(key, victims)
+
+    def _session_bytes(self, session_id: str) -> int:
+        return sum(self._sizes.get(key, 0) for key in self._sessions.get(session_id, ()))
+
+    def _touch(self, session_id: str, key: str, victims: list):
+        """Отмечает использование изображения сессией и соблюдает бюджет сессии. Под self._lock."""
+        if session_id is None:
+            return
+        owned = self._sessions.setdefault(session_id, OrderedDict())
+        owned[key] = None
+        owned.move_to_end(key)
+        self._owners.setdefault(key, set()).add(session_id)
+        while self._session_bytes(session_id) > self.session_budget_bytes and len(owned) > 1:
+            old_key, _ = owned.popitem(last=False)
+            self._stats['session_evictions'] += 1
+            self._drop_owner(session_id, old_key, victims)
+
+    def _enforce_budget(self, victims: list):
+        """Вытесняет самые давно использованные изображения сверх общего бюджета. Под self._lock."""
+        while self._resident_bytes > self.budget_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            self._stats['global_evictions'] += 1
+            self._remove(key, victims)
+
+    def _spill(self, victims: list):
+        if not victims or not self._spill_enabled():
+            return
+        os.makedirs(self.spill_path, exist_ok=True)
+        for key, value in victims:
+            with self._lock:
+                if key in self._spilled:
+                    self._spilled.move_to_end(key)
+                    continue
+            data = value.bytes
+            fd, tmp_path = tempfile.mkstemp(dir=self.spill_path, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, self._spill_file(key))
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                logger.exception("Не удалось сбросить изображение %s на диск", key)
+                continue
+
+            expired = []
+            with self._lock:
+                self._spilled[key] = len(data)
+                self._spilled_bytes += len(data)
+                self._stats['spills'] += 1
+                while self._spilled_bytes > self.spill_budget_bytes and len(self._spilled) > 1:
+                    old_key, old_size = self._spilled.popitem(last=False)
+                    self._spilled_bytes -= old_size
+                    self._stats['spill_evictions'] += 1
+                    expired.append(old_key)
+            for old_key in expired:
+                self._remove_spill_file(old_key)
+
+    def _remove_spill_file(self, key: str):
+        try:
+            os.remove(self._spill_file(key))
+        except FileNotFoundError:
+            pass
+
+    def _read_spilled(self, key: str) -> ImageValue:
+        with self._lock:
+            if key not in self._spilled:
+                return None
+            self._spilled.move_to_end(key)
+        try:
+            with open(self._spill_file(key), "rb") as f:
+                value = ImageValue(f.read())
+        except FileNotFoundError:
+            with self._lock:
+                size = self._spilled.pop(key, None)
+                if size is not None:
+                    self._spilled_bytes -= size
+            return None
+        value._hash = key
+        return value
+
+    def get(self, session_id: str, key: str, loader=None) -> ImageValue:
+        """Изображение по хешу: из памяти, со сброшенной на диск копии или из loader (по умолчанию
+        хранилище блобов). session_id=None — обращение фоновой задачи без закрепления за сессией."""
+        if not key:
+            return None
+        victims = []
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self._resize(key)
+                self._stats['memory_hits'] += 1
+                self._touch(session_id, key, victims)
+                self._enforce_budget(victims)
+        if value is None:
+            value = self._read_spilled(key)
+            if value is not None:
+                with self._lock:
+                    self._stats['disk_hits'] += 1
+            else:
+                value = (loader or self.loader)(key)
+                with self._lock:
+                    self._stats['loads'] += 1
+            value = self._admit(session_id, key, value, victims)
+        self._spill(victims)
+        return value
+
+    def put(self, session_id: str, value: ImageValue) -> ImageValue:
+        """Кладёт в кеш только что полученное изображение (оно уже сохранено в хранилище блобов под value.hash)
+        и возвращает значение из кеша"""
+        victims = []
+        value = self._admit(session_id, value.hash, value, victims)
+        self._spill(victims)
+        return value
+
+    def _admit(self, session_id: str, key: str, value: ImageValue, victims: list) -> ImageValue:
+        with self._lock:
+            value = self._entries.setdefault(key, value)
+            self._entries.move_to_end(key)
+            self._resize(key)
+            self._touch(session_id, key, victims)
+            self._enforce_budget(victims)
+        return value
+
+    def discard(self, key: str):
+        """Забывает изображение (блоб удалён из хранилища)"""
+        with self._lock:
+            self._remove(key, [])
+            size = self._spilled.pop(key, None)
+            if size is not None:
+                self._spilled_bytes -= size
+        if size is not None:
+            self._remove_spill_file(key)
+
+    def release_session(self, session_id: str):
+        """Отпускает все изображения сессии (например, при смене проекта)"""
+        victims = []
+        with self._lock:
+            owned = self._sessions.pop(session_id, OrderedDict())
+            for key in owned:
+                self._drop_owner(session_id, key, victims)
+        self._spill(victims)
+
+    def get_stats(self) -> dict:
+        """Счётчики попаданий и вытеснений и текущий объём в памяти и на диске"""
+        with self._lock:
+            return {
+                **self._stats,
+                'resident_mb': round(self._resident_bytes / _MB, 2),
+                'resident_images': len(self._entries),
+                'spilled_mb': round(self._spilled_bytes / _MB, 2),
+                'spilled_images': len(self._spilled),
+                'sessions': sum(1 for owned in self._sessions.values() if owned),
+                'max_session_mb': round(max(map(self._session_bytes, self._sessions), default=0) / _MB, 2),
+                'budget_mb': round(self.budget_bytes / _MB, 2),
+                'session_budget_mb': round(self.session_budget_bytes / _MB, 2),
+            }
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_image_memory() -> ImageMemoryManager:
+    """Общий для процесса менеджер изображений с бюджетами из IMAGE_MEMORY_BUDGET_MB / IMAGE_SESSION_BUDGET_MB"""
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = ImageMemoryManager(
+                    int(IMAGE_MEMORY_BUDGET_MB * _MB),
+                    int(IMAGE_SESSION_BUDGET_MB * _MB),
+                    IMAGE_SPILL_PATH,
+                    int(IMAGE_SPILL_BUDGET_MB * _MB),
+                )
+    return _manager
+
+
+def load_image_value(image_hash: str) -> ImageValue:
+    """Изображение по хешу для фоновых задач (без закрепления за сессией)"""
+    return get_image_memory().get(None, image_hash)
+
+
+def remember_image_value(value: ImageValue) -> ImageValue:
+    """Кладёт в общий кеш изображение, только что сохранённое в хранилище блобов"""
+    return get_image_memory().put(None, value)
@@ -0,0 +1,167 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageOps
+from blob_store import content_hash, get_blob_store, get_bytes, put_bytes, sniff_mime
+
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "2048"))
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "jpeg").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_NORMALIZE_CACHE_SIZE = int(os.getenv("IMAGE_NORMALIZE_CACHE_SIZE", "32"))
+IMAGE_THUMBNAIL_EDGE = int(os.getenv("IMAGE_THUMBNAIL_EDGE", "480"))
+IMAGE_PREVIEW_EDGE = int(os.getenv("IMAGE_PREVIEW_EDGE", "1280"))
+IMAGE_DERIVATIVE_QUALITY = int(os.getenv("IMAGE_DERIVATIVE_QUALITY", "80"))
+IMAGE_DERIVATIVE_CACHE_SIZE = int(os.getenv("IMAGE_DERIVATIVE_CACHE_SIZE", "128"))
+
+DERIVATIVE_SIZES = {
+    "thumbnail": IMAGE_THUMBNAIL_EDGE,
+    "preview": IMAGE_PREVIEW_EDGE,
+}
+
+_EXIF_ORIENTATION = 0x0112
+
+_normalized_cache = OrderedDict()
+_normalized_lock = threading.Lock()
+_derivative_cache = OrderedDict()
+_derivative_lock = threading.Lock()
+
+
+def detect_mime(data: bytes) -> str:
+    """Определяет MIME-тип изображения по сигнатуре, для остальных форматов — через PIL"""
+    mime_type = sniff_mime(data)
+    if mime_type != "image/jpeg" or data.startswith(b"\xff\xd8\xff"):
+        return mime_type
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return Image.MIME.get(img.format, "image/jpeg")
+    except Exception:
+        return "image/jpeg"
+
+
+def _encode(img: Image.Image, output_format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    if output_format == "webp":
+        img.save(buffer, format="WEBP", quality=quality, method=4)
+    else:
+        img.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def _normalize(data: bytes, max_edge: int, output_format: str, quality: int) -> bytes:
+    with Image.open(io.BytesIO(data)) as source:
+        source_format = source.format
+        needs_rotation = source.getexif().get(_EXIF_ORIENTATION, 1) != 1
+        img = ImageOps.exif_transpose(source) if needs_rotation else source
+        needs_resize = max(img.size) > max_edge
+
+        if source_format == {"webp": "WEBP"}.get(output_format, "JPEG") and not needs_rotation and not needs_resize:
+            return data
+
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+
+        if needs_resize:
+            img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+        encoded = _encode(img, output_format, quality)
+
+    if not needs_rotation and not needs_resize and len(encoded) >= len(data):
+        return data
+    return encoded
+
+
+def normalize_image(data: bytes, max_edge: int = None, output_format: str = None, quality: int = None) -> bytes:
+    """Готовит фото к отправке в модель: применяет EXIF-ориентацию, уменьшает до max_edge по длинной стороне
+    и перекодирует в JPEG/WebP. Результат кешируется по хешу исходных байтов."""
+    max_edge = max_edge or IMAGE_MAX_EDGE
+    output_format = output_format or IMAGE_OUTPUT_FORMAT
+    quality = quality or IMAGE_QUALITY
+
+    key = (hashlib.sha256(data).hexdigest(), max_edge, output_format, quality)
+    with _normalized_lock:
+        cached = _normalized_cache.get(key)
+        if cached is not None:
+            _normalized_cache.move_to_end(key)
+            return cached
+
+    try:
+        normalized = _normalize(data, max_edge, output_format, quality)
+    except Exception as e:
+        raise Exception(f"Не удалось обработать изображение: {str(e)}")
+
+    with _normalized_lock:
+        _normalized_cache[key] = normalized
+        while len(_normalized_cache) > IMAGE_NORMALIZE_CACHE_SIZE:
+            _normalized_cache.popitem(last=False)
+    return normalized
+
+
+def _derivative_key(source_hash: str, size: str) -> str:
+    edge = DERIVATIVE_SIZES[size]
+    return content_hash(f"{source_hash}:{size}:{edge}:{IMAGE_OUTPUT_FORMAT}:{IMAGE_DERIVATIVE_QUALITY}".encode())
+
+
+def _make_derivative(data: bytes, edge: int) -> bytes:
+    with Image.open(io.BytesIO(data)) as source:
+        if max(source.size) <= edge:
+            return data
+        img = source.convert("RGB")
+        img.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+        return _encode(img, IMAGE_OUTPUT_FORMAT, IMAGE_DERIVATIVE_QUALITY)
+
+
+def get_derivative(source_hash: str, size: str = "thumbnail") -> bytes:
+    """Возвращает уменьшенную копию изображения из хранилища блобов: thumbnail, preview или full (оригинал).
+
+    Производные создаются один раз и сохраняются в хранилище под ключом, выведенным из хеша оригинала
+    и параметров размера, плюс держатся в LRU-кеше процесса. Оригинал берётся из общего кеша image_memory.
+    """
+    if size == "full":
+        from image_memory import load_image_value
+        return load_image_value(source_hash).bytes
+    if size not in DERIVATIVE_SIZES:
+        raise Exception(f"Неизвестный размер изображения: {size}")
+
+    key = _derivative_key(source_hash, size)
+    with _derivative_lock:
+        cached = _derivative_cache.get(key)
+        if cached is not None:
+            _derivative_cache.move_to_end(key)
+            return cached
+
+    store = get_blob_store()
+    if store.exists(key):
+        derivative = store.get(key)
+    else:
+        try:
+            derivative = _make_derivative(get_bytes(source_hash), DERIVATIVE_SIZES[size])
+        except Exception as e:
+            raise Exception(f"Не удалось подготовить превью изображения: {str(e)}")
+        put_bytes(derivative, key=key)
+
+    with _derivative_lock:
+        _derivative_cache[key] = derivative
+        while len(_derivative_cache) > IMAGE_DERIVATIVE_CACHE_SIZE:
+            _derivative_cache.popitem(last=False)
+    return derivative
+
+
+def delete_derivatives(source_hash: str):
+    """Удаляет из хранилища и кеша производные изображения вместе с оригиналом.
+
+    Ключи выводятся из текущих IMAGE_THUMBNAIL_EDGE / IMAGE_PREVIEW_EDGE / IMAGE_OUTPUT_FORMAT /
+    IMAGE_DERIVATIVE_QUALITY: производные, созданные при других настройках, так не находятся.
+    """
+    store = get_blob_store()
+    for size in DERIVATIVE_SIZES:
+        key = _derivative_key(source_hash, size)
+        store.delete(key)
+        with _derivative_lock:
+            _derivative_cache.pop(key, None)
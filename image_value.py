@@ -0,0 +1,123 @@
+import base64
+import io
+import httpx
+from PIL import Image
+from blob_store import content_hash
+from gemini_client import get_http_client
+from image_pipeline import detect_mime
+
+
+class ImageValue:
+    """Изображение, которое держит исходные данные один раз и лениво строит остальные представления.
+
+    Создаётся из байтов (bytes/bytearray/memoryview — без копирования), из base64 или data URL
+    (декодируется только при обращении к байтам). bytes, b64, data_url, mime, hash и pil вычисляются
+    при первом обращении и запоминаются, поэтому одно значение можно передавать через несколько
+    вызовов моделей, сравнение и PDF без повторного кодирования. Значение неизменяемо; PIL-изображение
+    общее для всех пользователей, его нельзя менять на месте. Одновременное первое обращение из разных
+    потоков в худшем случае вычислит представление дважды.
+    """
+
+    __slots__ = ('_data', '_b64', '_mime', '_hash', '_pil')
+
+    def __init__(self, data=None, b64: str = None, mime: str = None):
+        if data is None and b64 is None:
+            raise Exception("Пустое изображение")
+        self._data = memoryview(data).toreadonly() if isinstance(data, (bytearray, memoryview)) else data
+        self._b64 = b64
+        self._mime = mime
+        self._hash = None
+        self._pil = None
+
+    @classmethod
+    def from_b64(cls, b64: str, mime: str = None) -> 'ImageValue':
+        return cls(b64=b64, mime=mime)
+
+    @classmethod
+    def from_data_url(cls, data_url: str) -> 'ImageValue':
+        header, encoded = data_url.split(',', 1)
+        mime = header[len('data:'):].split(';', 1)[0]
+        return cls(b64=encoded, mime=mime or None)
+
+    @property
+    def view(self) -> memoryview:
+        """Данные без копирования"""
+        if isinstance(self._data, memoryview):
+            return self._data
+        return memoryview(self.bytes)
+
+    @property
+    def bytes(self) -> bytes:
+        if not isinstance(self._data, bytes):
+            self._data = base64.b64decode(self._b64) if self._data is None else bytes(self._data)
+        return self._data
+
+    @property
+    def b64(self) -> str:
+        if self._b64 is None:
+            self._b64 = base64.b64encode(self._data).decode('ascii')
+        return self._b64
+
+    @property
+    def mime(self) -> str:
+        if self._mime is None:
+            self._mime = detect_mime(self.bytes)
+        return self._mime
+
+    @property
+    def data_url(self) -> str:
+        return f"data:{self.mime};base64,{self.b64}"
+
+    @property
+    def hash(self) -> str:
+        """SHA-256 содержимого — тот же ключ, что в хранилище блобов"""
+        if self._hash is None:
+            self._hash = content_hash(self.bytes)
+        return self._hash
+
+    @property
+    def pil(self) -> Image.Image:
+        """Декодированное изображение (только для чтения)"""
+        if self._pil is None:
+            img = Image.open(io.BytesIO(self.bytes))
+            img.load()
+            self._pil = img
+        return self._pil
+
+    @property
+    def size(self) -> tuple:
+        return self.pil.size
+
+    @property
+    def nbytes(self) -> int:
+        """Сколько памяти занимают уже вычисленные представления (байты, base64, декодированное изображение)"""
+        size = len(self._data) if self._data is not None else 0
+        size += len(self._b64) if self._b64 is not None else 0
+        if self._pil is not None:
+            size += self._pil.width * self._pil.height * len(self._pil.getbands())
+        return size
+
+    def __len__(self) -> int:
+        return len(self._data) if self._data is not None else len(self._b64) * 3 // 4
+
+    def __bool__(self) -> bool:
+        return True
+
+
+def as_image(value) -> ImageValue:
+    """Приводит байты, data URL или внешнюю ссылку к ImageValue; None остаётся None"""
+    if value is None or isinstance(value, ImageValue):
+        return value
+    if isinstance(value, str):
+        if value.startswith('data:'):
+            return ImageValue.from_data_url(value)
+        try:
+            response = get_http_client().get(value, timeout=10)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            raise Exception(f"Не удалось загрузить изображение по ссылке {value}: {e}")
+        return ImageValue(response.content)
+    if not value:
+        return None
+    return ImageValue(value)
+
@@ -0,0 +1,408 @@
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timedelta
+from blob_store import put_bytes
+from generation import engineer_prompt
+from image_pipeline import get_derivative
+from image_memory import load_image_value, remember_image_value
+from prompts import SYSTEM_PROMPT_REFINE_ENGINEER
+from telemetry import pipeline_stage
+from utils import generate_image, refine_design_with_vision
+
+logger = logging.getLogger("ai_designer.jobs")
+
+JOB_BACKEND = os.getenv("JOB_BACKEND", "db" if os.getenv("DATABASE_URL") else "local")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "3"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "600"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "2"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATUSES = (JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED)
+
+JOB_STAGE_LABELS = {
+    "queued": "В очереди",
+    "prompt": "Создаю промпт",
+    "image": "Генерирую изображение",
+    "save": "Сохраняю результат",
+}
+
+
+def execute_job(kind: str, payload: dict, report) -> dict:
+    """Выполняет задание генерации и возвращает {'hash', 'prompt'} готового изображения.
+
+    report(progress, stage) сообщает о прогрессе в процентах и текущем этапе.
+    """
+    if kind == "generate":
+        report(10, "prompt")
+        with pipeline_stage("prompt_engineer"):
+            prompt = engineer_prompt(
+                payload['analysis'],
+                payload['room_type'],
+                payload['purpose'],
+                payload['styles'],
+                payload['main_color'],
+                payload['additional_preferences'],
+                payload.get('slot', 0)
+            )
+    elif kind == "regenerate":
+        prompt = payload['prompt']
+    elif kind == "refine":
+        report(10, "prompt")
+        with pipeline_stage("refine"):
+            prompt = refine_design_with_vision(
+                load_image_value(payload['source_hash']),
+                payload['prompt'],
+                payload['feedback'],
+                SYSTEM_PROMPT_REFINE_ENGINEER,
+                payload.get('history')
+            )
+    else:
+        raise Exception(f"Неизвестный тип задания: {kind}")
+
+    report(40, "image")
+    with pipeline_stage("image_gen"):
+        image = generate_image(load_image_value(payload['source_hash']), prompt)
+    report(90, "save")
+    image_hash = put_bytes(image.bytes, image.hash)
+    remember_image_value(image)
+    get_derivative(image_hash, "thumbnail")
+    return {'hash': image_hash, 'prompt': prompt}
+
+
+def attach_result_to_variant(variant_id: int, result: dict):
+    """Записывает результат задания в строку DesignVariant"""
+    from database import SessionLocal, DesignVariant
+    db = SessionLocal()
+    try:
+        db.query(DesignVariant).filter(DesignVariant.id == variant_id).update(
+            {'image_hash': result['hash'], 'prompt': result['prompt']},
+            synchronize_session=False
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+class _WorkerPool:
+    """Общая логика фоновых воркеров: забрать задание, выполнить, сохранить результат"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._threads = []
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _worker_loop(self):
+        """Цикл воркера; ошибка одного шага (например, временная ошибка БД) не останавливает поток"""
+        while not self._stop.is_set():
+            try:
+                job = self._claim_next()
+                if job is None:
+                    self._wait_for_work()
+                    continue
+                self._run(job)
+            except Exception:
+                logger.exception("Ошибка очереди заданий")
+                self._stop.wait(JOB_POLL_INTERVAL)
+
+    def _run(self, job: dict):
+        job_id = job['id']
+        try:
+            result = execute_job(job['kind'], job['payload'], lambda progress, stage: self._update(job_id, progress=progress, stage=stage))
+            if job.get('variant_id') is not None:
+                attach_result_to_variant(job['variant_id'], result)
+            self._update(
+                job_id,
+                status=JOB_SUCCEEDED,
+                progress=100,
+                stage=None,
+                result_hash=result['hash'],
+                result_prompt=result['prompt'],
+                finished_at=datetime.utcnow()
+            )
+        except Exception as e:
+            try:
+                self._update(job_id, status=JOB_FAILED, error=str(e), finished_at=datetime.utcnow())
+            except Exception:
+                logger.exception("Не удалось отметить задание %s как failed", job_id)
+
+
+class LocalJobQueue(_WorkerPool):
+    """Очередь заданий в памяти процесса (для тестов и запуска без БД)"""
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        super().__init__(workers)
+        self._jobs = {}
+        self._pending = queue.Queue()
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    def submit(self, kind: str, payload: dict, user_id: str = None, project_id: int = None, variant_id: int = None) -> int:
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            self._jobs[job_id] = {
+                'id': job_id,
+                'user_id': user_id,
+                'project_id': project_id,
+                'variant_id': variant_id,
+                'kind': kind,
+                'status': JOB_QUEUED,
+                'progress': 0,
+                'stage': "queued",
+                'payload': payload,
+                'result_hash': None,
+                'result_prompt': None,
+                'error': None,
+                'created_at': datetime.utcnow(),
+                'finished_at': None,
+            }
+        self._pending.put(job_id)
+        self.start()
+        return job_id
+
+    def get(self, job_id: int):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def get_many(self, job_ids: list) -> dict:
+        return {job_id: job for job_id in job_ids if (job := self.get(job_id)) is not None}
+
+    def find_by_variants(self, variant_ids: list) -> dict:
+        with self._lock:
+            latest = {}
+            for job in self._jobs.values():
+                if job['variant_id'] in variant_ids:
+                    latest[job['variant_id']] = dict(job)
+            return latest
+
+    def cancel(self, job_id: int) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job and job['status'] == JOB_QUEUED:
+                job['status'] = JOB_CANCELLED
+                job['finished_at'] = datetime.utcnow()
+                return True
+            return False
+
+    def _claim_next(self):
+        try:
+            job_id = self._pending.get(timeout=JOB_POLL_INTERVAL)
+        except queue.Empty:
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or job['status'] != JOB_QUEUED:
+                return None
+            job['status'] = JOB_RUNNING
+            return dict(job)
+
+    def _wait_for_work(self):
+        pass
+
+    def _update(self, job_id: int, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+
+class DatabaseJobQueue(_WorkerPool):
+    """Очередь заданий в таблице generation_jobs: переживает перезапуски скрипта и процесса.
+
+    Задания забираются оптимистичной блокировкой (UPDATE ... WHERE status = 'queued'),
+    поэтому несколько процессов приложения могут обрабатывать одну очередь.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        super().__init__(workers)
+
+    @staticmethod
+    def _to_dict(job) -> dict:
+        return {
+            'id': job.id,
+            'user_id': job.user_id,
+            'project_id': job.project_id,
+            'variant_id': job.variant_id,
+            'kind': job.kind,
+            'status': job.status,
+            'progress': job.progress or 0,
+            'stage': job.stage,
+            'payload': json.loads(job.payload),
+            'result_hash': job.result_hash,
+            'result_prompt': job.result_prompt,
+            'error': job.error,
+            'created_at': job.created_at,
+            'finished_at': job.finished_at,
+        }
+
+    def submit(self, kind: str, payload: dict, user_id: str = None, project_id: int = None, variant_id: int = None) -> int:
+        from database import SessionLocal, GenerationJob
+        db = SessionLocal()
+        try:
+            job = GenerationJob(
+                user_id=user_id,
+                project_id=project_id,
+                variant_id=variant_id,
+                kind=kind,
+                status=JOB_QUEUED,
+                stage="queued",
+                payload=json.dumps(payload, ensure_ascii=False)
+            )
+            db.add(job)
+            db.commit()
+            job_id = job.id
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        self.start()
+        return job_id
+
+    def get(self, job_id: int):
+        return self.get_many([job_id]).get(job_id)
+
+    def get_many(self, job_ids: list) -> dict:
+        from database import SessionLocal, GenerationJob
+        if not job_ids:
+            return {}
+        db = SessionLocal()
+        try:
+            jobs = db.query(GenerationJob).filter(GenerationJob.id.in_(job_ids)).all()
+            return {job.id: self._to_dict(job) for job in jobs}
+        finally:
+            db.close()
+
+    def find_by_variants(self, variant_ids: list) -> dict:
+        from database import SessionLocal, GenerationJob
+        if not variant_ids:
+            return {}
+        db = SessionLocal()
+        try:
+            jobs = db.query(GenerationJob).filter(GenerationJob.variant_id.in_(variant_ids)).order_by(GenerationJob.id.asc()).all()
+            return {job.variant_id: self._to_dict(job) for job in jobs}
+        finally:
+            db.close()
+
+    def cancel(self, job_id: int) -> bool:
+        from database import SessionLocal, GenerationJob
+        db = SessionLocal()
+        try:
+            updated = db.query(GenerationJob).filter(
+                GenerationJob.id == job_id,
+                GenerationJob.status == JOB_QUEUED
+            ).update({'status': JOB_CANCELLED, 'finished_at': datetime.utcnow()}, synchronize_session=False)
+            db.commit()
+            return updated == 1
+        finally:
+            db.close()
+
+    def _claim_next(self):
+        from database import SessionLocal, GenerationJob
+        db = SessionLocal()
+        try:
+            self._requeue_stale(db)
+            candidates = [
+                row.id for row in db.query(GenerationJob.id)
+                .filter(GenerationJob.status == JOB_QUEUED)
+                .order_by(GenerationJob.created_at.asc(), GenerationJob.id.asc())
+                .limit(self.workers * 2)
+            ]
+            for job_id in candidates:
+                claimed = db.query(GenerationJob).filter(
+                    GenerationJob.id == job_id,
+                    GenerationJob.status == JOB_QUEUED
+                ).update({
+                    'status': JOB_RUNNING,
+                    'started_at': datetime.utcnow(),
+                    'attempts': GenerationJob.attempts + 1
+                }, synchronize_session=False)
+                db.commit()
+                if claimed == 1:
+                    return self._to_dict(db.query(GenerationJob).filter(GenerationJob.id == job_id).one())
+            return None
+        finally:
+            db.close()
+
+    def _requeue_stale(self, db):
+        from database import GenerationJob
+        stale_before = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+        stale = db.query(GenerationJob).filter(
+            GenerationJob.status == JOB_RUNNING,
+            GenerationJob.started_at < stale_before
+        ).all()
+        for job in stale:
+            if (job.attempts or 0) < JOB_MAX_ATTEMPTS:
+                job.status = JOB_QUEUED
+                job.stage = "queued"
+            else:
+                job.status = JOB_FAILED
+                job.error = "Задание прервано: превышено время выполнения"
+                job.finished_at = datetime.utcnow()
+        if stale:
+            db.commit()
+
+    def _wait_for_work(self):
+        self._stop.wait(JOB_POLL_INTERVAL)
+
+    def _update(self, job_id: int, **fields):
+        from database import SessionLocal, GenerationJob
+        db = SessionLocal()
+        try:
+            db.query(GenerationJob).filter(GenerationJob.id == job_id).update(fields, synchronize_session=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Возвращает общую для процесса очередь заданий (JOB_BACKEND: db или local)"""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = DatabaseJobQueue() if JOB_BACKEND == "db" else LocalJobQueue()
+    _queue.start()
+    return _queue
+
+
+def set_job_queue(job_queue):
+    """Подменяет очередь заданий (например, LocalJobQueue в тестах)"""
+    global _queue
+    with _queue_lock:
+        _queue = job_queue
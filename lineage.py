@@ -0,0 +1,108 @@
+import json
+import os
+
+LINEAGE_MAX_DEPTH = int(os.getenv("LINEAGE_MAX_DEPTH", "30"))
+REFINE_HISTORY_MAX_DELTAS = int(os.getenv("REFINE_HISTORY_MAX_DELTAS", "5"))
+REFINE_HISTORY_MAX_CHARS = int(os.getenv("REFINE_HISTORY_MAX_CHARS", "1200"))
+REFINE_BASE_PROMPT_MAX_CHARS = int(os.getenv("REFINE_BASE_PROMPT_MAX_CHARS", "4000"))
+
+ORIGIN_GENERATE = "generate"
+ORIGIN_REGENERATE = "regenerate"
+ORIGIN_REFINE = "refine"
+ORIGIN_RESTORE = "restore"
+
+# варианты, промпт которых описывает дизайн целиком; от ближайшего такого предка отсчитываются правки
+BASE_ORIGINS = (ORIGIN_GENERATE, ORIGIN_REGENERATE)
+
+ORIGIN_LABELS = {
+    ORIGIN_GENERATE: "Создан",
+    ORIGIN_REGENERATE: "Перегенерирован по промпту",
+    ORIGIN_REFINE: "Доработка",
+    ORIGIN_RESTORE: "Возврат к версии",
+}
+
+_ENTRY_FIELDS = ('id', 'hash', 'prompt', 'delta', 'origin', 'iterations')
+
+# Родословная варианта — список его предков от корня до родителя. Каждая запись хранит всё, что нужно,
+# чтобы вернуться к предку без генерации: хеш изображения в хранилище блобов и промпт. Записи копируются
+# в потомка, поэтому история переживает удаление строк предков (например, при выборе дизайна).
+
+
+def lineage_entry(variant: dict) -> dict:
+    """Запись о варианте для родословной его потомков"""
+    return {field: variant.get(field) for field in _ENTRY_FIELDS}
+
+
+def child_lineage(parent: dict) -> list:
+    """Родословная потомка parent. Длиннее LINEAGE_MAX_DEPTH цепочка не растёт: корень сохраняется,
+    выпадают самые старые промежуточные предки."""
+    chain = list(parent.get('lineage') or []) + [lineage_entry(parent)]
+    if len(chain) > LINEAGE_MAX_DEPTH:
+        chain = chain[:1] + chain[len(chain) - LINEAGE_MAX_DEPTH + 1:]
+    return chain
+
+
+def dump_lineage(lineage: list) -> str:
+    return json.dumps(lineage, ensure_ascii=False) if lineage else None
+
+
+def load_lineage(raw: str) -> list:
+    if not raw:
+        return []
+    try:
+        return json.loads(raw)
+    except json.JSONDecodeError:
+        return []
+
+
+def describe_entry(entry: dict) -> str:
+    label = ORIGIN_LABELS.get(entry.get('origin') or ORIGIN_GENERATE, ORIGIN_LABELS[ORIGIN_GENERATE])
+    return f"{label}: {entry['delta']}" if entry.get('delta') else label
+
+
+def compact_prompt(prompt: str, max_chars: int = None) -> str:
+    """Обрезает промпт до max_chars по границе строки или предложения"""
+    max_chars = max_chars or REFINE_BASE_PROMPT_MAX_CHARS
+    if not prompt or len(prompt) <= max_chars:
+        return prompt or ""
+    cut = prompt[:max_chars - 1]
+    boundary = max(cut.rfind("\n"), cut.rfind(". "))
+    if boundary > max_chars // 2:
+        cut = cut[:boundary + 1]
+    return cut.rstrip() + "…"
+
+
+def compact_history(deltas: list, max_deltas: int = None, max_chars: int = None) -> str:
+    """Сжатая история правок: последние max_deltas — нумерованным списком, более ранние — одной строкой.
+    Итог не длиннее max_chars; при переполнении отбрасываются самые старые правки."""
+    if not deltas:
+        return ""
+    max_deltas = max_deltas or REFINE_HISTORY_MAX_DELTAS
+    max_chars = max_chars or REFINE_HISTORY_MAX_CHARS
+    earlier, recent = deltas[:-max_deltas], deltas[-max_deltas:]
+    lines = [f"{number}. {delta}" for number, delta in enumerate(recent, len(earlier) + 1)]
+    if earlier:
+        lines.insert(0, f"Ранее: {'; '.join(earlier)}")
+    text = "\n".join(lines)
+    if len(text) > max_chars:
+        text = "…" + text[len(text) - max_chars + 1:]
+    return text
+
+
+def refine_context(variant: dict) -> tuple:
+    """Базовый промпт и сжатая история правок для доработки варианта.
+
+    Вместо промпта самого варианта, который растёт с каждой доработкой, модель получает промпт ближайшего
+    предка, созданного с нуля (генерация или перегенерация по промпту), и список правок после него —
+    размер запроса не зависит от длины цепочки.
+    """
+    chain = list(variant.get('lineage') or []) + [lineage_entry(variant)]
+    base_index = max(
+        (index for index, entry in enumerate(chain) if (entry.get('origin') or ORIGIN_GENERATE) in BASE_ORIGINS),
+        default=0
+    )
+    deltas = [
+        entry['delta'] for entry in chain[base_index + 1:]
+        if entry.get('origin') == ORIGIN_REFINE and entry.get('delta')
+    ]
+    return compact_prompt(chain[base_index]['prompt']), compact_history(deltas)
@@ -0,0 +1,4 @@
+ALTER TABLE projects ADD COLUMN IF NOT EXISTS uploaded_image_hash VARCHAR(64);
+ALTER TABLE design_variants ADD COLUMN IF NOT EXISTS image_hash VARCHAR(64);
+ALTER TABLE design_variants ALTER COLUMN image_url DROP NOT NULL;
+CREATE INDEX IF NOT EXISTS ix_design_variants_image_hash ON design_variants (image_hash);
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS ix_projects_user_updated ON projects (user_id, updated_at, id);
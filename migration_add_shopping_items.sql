@@ -0,0 +1,17 @@
+CREATE TABLE IF NOT EXISTS shopping_items (
+    id SERIAL PRIMARY KEY,
+    project_id INTEGER NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL DEFAULT 0,
+    category VARCHAR NOT NULL,
+    name VARCHAR NOT NULL,
+    sku VARCHAR,
+    description TEXT,
+    quantity DOUBLE PRECISION NOT NULL DEFAULT 1,
+    unit VARCHAR,
+    price_rub DOUBLE PRECISION NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS ix_shopping_items_id ON shopping_items (id);
+CREATE INDEX IF NOT EXISTS ix_shopping_items_project_position ON shopping_items (project_id, position);
+CREATE INDEX IF NOT EXISTS ix_shopping_items_category_name ON shopping_items (category, name);
+CREATE INDEX IF NOT EXISTS ix_shopping_items_sku ON shopping_items (sku);
@@ -0,0 +1,18 @@
+CREATE TABLE IF NOT EXISTS images (
+    hash VARCHAR(64) PRIMARY KEY,
+    perceptual_hash VARCHAR(16),
+    mime_type VARCHAR,
+    width INTEGER,
+    height INTEGER,
+    size_bytes INTEGER,
+    ref_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT NOW(),
+    last_used_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS ix_images_perceptual_hash ON images (perceptual_hash);
+CREATE INDEX IF NOT EXISTS ix_projects_uploaded_image_hash ON projects (uploaded_image_hash);
+INSERT INTO images (hash, ref_count)
+SELECT uploaded_image_hash, COUNT(*) FROM projects
+WHERE uploaded_image_hash IS NOT NULL
+GROUP BY uploaded_image_hash
+ON CONFLICT (hash) DO UPDATE SET ref_count = EXCLUDED.ref_count;
@@ -0,0 +1,5 @@
+ALTER TABLE design_variants ADD COLUMN IF NOT EXISTS parent_id INTEGER REFERENCES design_variants(id) ON DELETE SET NULL;
+ALTER TABLE design_variants ADD COLUMN IF NOT EXISTS origin VARCHAR(16);
+ALTER TABLE design_variants ADD COLUMN IF NOT EXISTS delta TEXT;
+ALTER TABLE design_variants ADD COLUMN IF NOT EXISTS lineage TEXT;
+CREATE INDEX IF NOT EXISTS ix_design_variants_parent_id ON design_variants (parent_id);
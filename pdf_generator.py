@@ -0,0 +1,435 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+logger = logging.getLogger("ai_designer.pdf_generator")
+
+PDF_FONT_DIRS = os.getenv("PDF_FONT_DIRS", "/usr/share/fonts:/usr/local/share/fonts")
+PDF_CACHE_SIZE = int(os.getenv("PDF_CACHE_SIZE", "16"))
+PDF_MARKDOWN_CACHE_SIZE = int(os.getenv("PDF_MARKDOWN_CACHE_SIZE", "64"))
+
+_FONT_REGULAR = "DejaVuSans.ttf"
+_FONT_BOLD = "DejaVuSans-Bold.ttf"
+_DEFAULT_FONT_DIR = "/usr/share/fonts/truetype/dejavu"
+
+_EMOJI_RE = re.compile("["
+    u"\U0001F600-\U0001F64F"
+    u"\U0001F300-\U0001F5FF"
+    u"\U0001F680-\U0001F6FF"
+    u"\U0001F1E0-\U0001F1FF"
+    u"\U00002702-\U000027B0"
+    u"\U000024C2-\U0001F251"
+    u"\U0001f926-\U0001f937"
+    u"\U00010000-\U0010ffff"
+    u"\u2640-\u2642"
+    u"\u2600-\u2B55"
+    u"\u200d"
+    u"\u23cf"
+    u"\u23e9"
+    u"\u231a"
+    u"\ufe0f"
+    u"\u3030"
+    "]+", flags=re.UNICODE)
+_HEADING_RE = re.compile(r'^\s*(#{1,6})\s+(.*)$')
+_BULLET_RE = re.compile(r'^(\s*)[-*+•]\s+(.*)$')
+_ORDERED_RE = re.compile(r'^(\s*)(\d+)[.)]\s+(.*)$')
+_TABLE_ROW_RE = re.compile(r'^\s*\|.*\|\s*$')
+_TABLE_SEPARATOR_RE = re.compile(r'^\s*\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?\s*$')
+_HORIZONTAL_RULE_RE = re.compile(r'^\s*([-*_])(\s*\1){2,}\s*$')
+_BOLD_RE = re.compile(r'\*\*(.+?)\*\*')
+_ITALIC_RE = re.compile(r'(?<!\*)\*(?!\s)(.+?)(?<!\s)\*(?!\*)')
+_INLINE_TAG_RE = re.compile(r'<(/?)([bi])>')
+_EMPTY_TAG_RE = re.compile(r'<([bi])></\1>')
+
+_engine_lock = threading.Lock()
+_styles = None
+_pdf_cache = OrderedDict()
+_pdf_cache_lock = threading.Lock()
+
+
+def _find_font_files():
+    """Ищет шрифты DejaVu: сначала по стандартному пути, затем обходом PDF_FONT_DIRS (без внешних процессов)"""
+    regular = os.path.join(_DEFAULT_FONT_DIR, _FONT_REGULAR)
+    bold = os.path.join(_DEFAULT_FONT_DIR, _FONT_BOLD)
+    if os.path.exists(regular):
+        return regular, bold if os.path.exists(bold) else None
+
+    regular = bold = None
+    for font_dir in PDF_FONT_DIRS.split(":"):
+        for dirpath, _, filenames in os.walk(font_dir):
+            if regular is None and _FONT_REGULAR in filenames:
+                regular = os.path.join(dirpath, _FONT_REGULAR)
+            if bold is None and _FONT_BOLD in filenames:
+                bold = os.path.join(dirpath, _FONT_BOLD)
+            if regular and bold:
+                return regular, bold
+    return regular, bold
+
+
+def _build_styles() -> dict:
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER, TA_LEFT
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    font_name = 'Helvetica-Bold'
+    normal_font = 'Helvetica'
+    try:
+        regular_path, bold_path = _find_font_files()
+        if regular_path:
+            pdfmetrics.registerFont(TTFont('CustomFont', regular_path))
+            normal_font = 'CustomFont'
+            font_name = 'CustomFont'
+            if bold_path:
+                pdfmetrics.registerFont(TTFont('CustomFontBold', bold_path))
+                font_name = 'CustomFontBold'
+                pdfmetrics.registerFontFamily('CustomFont', normal='CustomFont', bold='CustomFontBold',
+                                              italic='CustomFont', boldItalic='CustomFontBold')
+    except Exception as e:
+        logger.warning("Не удалось зарегистрировать шрифты для PDF: %s", e)
+
+    base = getSampleStyleSheet()
+    accent = colors.HexColor('#1f77b4')
+    return {
+        'font_name': font_name,
+        'normal_font': normal_font,
+        'title': ParagraphStyle('CustomTitle', parent=base['Heading1'], fontSize=24, textColor=accent,
+                                spaceAfter=12, alignment=TA_CENTER, fontName=font_name),
+        'heading': ParagraphStyle('CustomHeading', parent=base['Heading2'], fontSize=14, textColor=accent,
+                                  spaceAfter=10, spaceBefore=10, fontName=font_name),
+        'subheading': ParagraphStyle('CustomSubheading', parent=base['Heading3'], fontSize=12, textColor=accent,
+                                     spaceAfter=6, spaceBefore=8, fontName=font_name),
+        'normal': ParagraphStyle('CustomNormal', parent=base['Normal'], fontSize=10, spaceAfter=6,
+                                 alignment=TA_LEFT, fontName=normal_font),
+        'list_item': ParagraphStyle('CustomListItem', parent=base['Normal'], fontSize=10, spaceAfter=2,
+                                    alignment=TA_LEFT, fontName=normal_font),
+        'table_cell': ParagraphStyle('CustomTableCell', parent=base['Normal'], fontSize=9, leading=11,
+                                     fontName=normal_font),
+        'table_header': ParagraphStyle('CustomTableHeader', parent=base['Normal'], fontSize=9, leading=11,
+                                       fontName=font_name),
+    }
+
+
+def get_styles() -> dict:
+    """Шрифты и стили PDF: регистрируются один раз на процесс"""
+    global _styles
+    if _styles is None:
+        with _engine_lock:
+            if _styles is None:
+                _styles = _build_styles()
+    return _styles
+
+
+def format_inline(text: str) -> str:
+    """Текст строки в разметку Paragraph: без эмодзи, с экранированием XML и **жирным**/*курсивом*"""
+    text = _EMOJI_RE.sub('', text).strip()
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    text = _BOLD_RE.sub(r'<b>\1</b>', text)
+    text = _ITALIC_RE.sub(r'<i>\1</i>', text)
+    return _balance_tags(text)
+
+
+def _balance_tags(text: str) -> str:
+    """Исправляет перекрывающиеся <b>/<i> (например, из **a *b** c*), которые Paragraph не разбирает:
+    закрывает вложенный тег перед внешним и открывает его снова после"""
+    parts = []
+    stack = []
+    position = 0
+    for match in _INLINE_TAG_RE.finditer(text):
+        parts.append(text[position:match.start()])
+        position = match.end()
+        closing, tag = match.groups()
+        if not closing:
+            stack.append(tag)
+            parts.append(match.group())
+            continue
+        if tag not in stack:
+            continue
+        reopen = []
+        while stack[-1] != tag:
+            reopen.append(stack.pop())
+            parts.append(f"</{reopen[-1]}>")
+        stack.pop()
+        parts.append(match.group())
+        for inner in reversed(reopen):
+            stack.append(inner)
+            parts.append(f"<{inner}>")
+    parts.append(text[position:])
+    parts.extend(f"</{tag}>" for tag in reversed(stack))
+    return _EMPTY_TAG_RE.sub('', "".join(parts))
+
+
+def _split_table_row(line: str) -> list:
+    return [format_inline(cell) for cell in line.strip().strip('|').split('|')]
+
+
+@lru_cache(maxsize=PDF_MARKDOWN_CACHE_SIZE)
+def parse_markdown(text: str) -> tuple:
+    """Разбирает Markdown ответа модели в дерево блоков.
+
+    Блоки: {'type': 'heading', 'level', 'text'}, {'type': 'paragraph', 'text'},
+    {'type': 'list', 'ordered', 'items': [{'text', 'children': [блоки списков]}]}, {'type': 'table', 'header', 'rows'}.
+    Текст блоков уже очищен и отформатирован для Paragraph. Результат кешируется, его нельзя изменять.
+    """
+    blocks = []
+    list_stack = []
+    lines = (text or "").split('\n')
+    i = 0
+
+    while i < len(lines):
+        line = lines[i]
+
+        if not line.strip() or _HORIZONTAL_RULE_RE.match(line):
+            i += 1
+            continue
+
+        if _TABLE_ROW_RE.match(line):
+            list_stack = []
+            rows = []
+            header = False
+            while i < len(lines) and _TABLE_ROW_RE.match(lines[i]):
+                if _TABLE_SEPARATOR_RE.match(lines[i]):
+                    header = len(rows) == 1
+                else:
+                    rows.append(_split_table_row(lines[i]))
+                i += 1
+            if rows:
+                width = max(len(row) for row in rows)
+                rows = [row + [''] * (width - len(row)) for row in rows]
+                blocks.append({'type': 'table', 'header': header, 'rows': rows})
+            continue
+
+        heading = _HEADING_RE.match(line)
+        if heading:
+            list_stack = []
+            text_value = format_inline(heading.group(2))
+            if text_value:
+                blocks.append({'type': 'heading', 'level': len(heading.group(1)), 'text': text_value})
+            i += 1
+            continue
+
+        bullet = _BULLET_RE.match(line)
+        ordered = _ORDERED_RE.match(line)
+        if bullet or ordered:
+            indent = len((bullet or ordered).group(1).expandtabs(4))
+            item = {'text': format_inline(bullet.group(2) if bullet else ordered.group(3)), 'children': []}
+
+            while list_stack and list_stack[-1][0] > indent:
+                list_stack.pop()
+            if list_stack and list_stack[-1][0] == indent and list_stack[-1][1]['ordered'] == bool(ordered):
+                list_stack[-1][1]['items'].append(item)
+            else:
+                node = {'type': 'list', 'ordered': bool(ordered), 'items': [item]}
+                if list_stack and list_stack[-1][0] < indent and list_stack[-1][1]['items']:
+                    list_stack[-1][1]['items'][-1]['children'].append(node)
+                else:
+                    list_stack = []
+                    blocks.append(node)
+                list_stack.append((indent, node))
+            i += 1
+            continue
+
+        text_value = format_inline(line)
+        if text_value:
+            if list_stack and line[:1].isspace() and list_stack[-1][1]['items']:
+                list_stack[-1][1]['items'][-1]['text'] += f" {text_value}"
+            else:
+                list_stack = []
+                blocks.append({'type': 'paragraph', 'text': text_value})
+        i += 1
+
+    return tuple(blocks)
+
+
+def _render_list(node: dict, styles: dict):
+    from reportlab.platypus import ListFlowable, ListItem, Paragraph
+
+    items = []
+    for item in node['items']:
+        flowables = [Paragraph(item['text'], styles['list_item'])]
+        flowables.extend(_render_list(child, styles) for child in item['children'])
+        items.append(ListItem(flowables))
+    return ListFlowable(
+        items,
+        bulletType='1' if node['ordered'] else 'bullet',
+        start=None if node['ordered'] else '•',
+        bulletFontName=styles['normal_font'],
+        bulletFontSize=9,
+        leftIndent=14,
+    )
+
+
+def _render_table(node: dict, styles: dict, width: float):
+    from reportlab.lib import colors
+    from reportlab.platypus import Paragraph, Table, TableStyle
+
+    rows = []
+    for row_index, row in enumerate(node['rows']):
+        style = styles['table_header'] if node['header'] and row_index == 0 else styles['table_cell']
+        rows.append([Paragraph(cell, style) for cell in row])
+
+    columns = len(node['rows'][0])
+    table = Table(rows, colWidths=[width / columns] * columns, repeatRows=1 if node['header'] else 0)
+    commands = [
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#c8d3e0')),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ]
+    if node['header']:
+        commands.append(('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#e8f1fa')))
+    table.setStyle(TableStyle(commands))
+    return table
+
+
+def render_markdown(blocks: tuple, styles: dict, width: float) -> list:
+    """Превращает дерево блоков из parse_markdown во flowables ReportLab"""
+    from reportlab.platypus import Paragraph, Spacer
+
+    story = []
+    for block in blocks:
+        if block['type'] == 'heading':
+            style = styles['heading'] if block['level'] <= 2 else styles['subheading']
+            story.append(Paragraph(block['text'], style))
+        elif block['type'] == 'paragraph':
+            story.append(Paragraph(block['text'], styles['normal']))
+        elif block['type'] == 'list':
+            story.append(_render_list(block, styles))
+            story.append(Spacer(1, 4))
+        elif block['type'] == 'table':
+            story.append(_render_table(block, styles, width))
+            story.append(Spacer(1, 8))
+    return story
+
+
+def _design_image_flowable(image_bytes: bytes):
+    from PIL import Image as PILImage
+    from reportlab.lib.units import inch
+    from reportlab.platypus import Image
+
+    with PILImage.open(io.BytesIO(image_bytes)) as img:
+        img = img.convert('RGB')
+        img.thumbnail((int(6 * inch), int(4 * inch)), PILImage.Resampling.LANCZOS)
+        img_buffer = io.BytesIO()
+        img.save(img_buffer, format='JPEG')
+    img_buffer.seek(0)
+    return Image(img_buffer, width=4 * inch, height=3 * inch)
+
+
+def _format_amount(value: float) -> str:
+    return f"{round(value):,}".replace(",", " ")
+
+
+def _format_quantity(value: float) -> str:
+    return f"{value:g}"
+
+
+def render_shopping_items(items: list, budget: dict, styles: dict, width: float) -> list:
+    """Список покупок из позиций: таблица на каждую категорию и итог бюджета"""
+    from reportlab.platypus import Paragraph, Spacer
+
+    categories = {}
+    for item in items:
+        categories.setdefault(item['category'], []).append(item)
+
+    story = []
+    for category, category_items in categories.items():
+        rows = [["Наименование", "Артикул", "Кол-во", "Цена за ед., руб", "Сумма, руб"]]
+        for item in category_items:
+            name = format_inline(item['name'])
+            if item['description']:
+                name += f"<br/>{format_inline(item['description'])}"
+            rows.append([
+                name,
+                format_inline(item['sku']),
+                f"{_format_quantity(item['quantity'])} {format_inline(item['unit'])}",
+                _format_amount(item['unit_price_rub']),
+                _format_amount(item['quantity'] * item['unit_price_rub']),
+            ])
+        story.append(Paragraph(format_inline(category), styles['subheading']))
+        story.append(_render_table({'header': True, 'rows': rows}, styles, width))
+        story.append(Spacer(1, 8))
+
+    if budget and budget.get('total_rub'):
+        story.append(Paragraph("Бюджет", styles['subheading']))
+        rows = [["Категория", "Сумма, руб"]]
+        rows.extend([format_inline(category), _format_amount(amount)] for category, amount in (budget.get('by_category') or {}).items())
+        rows.append(["<b>Итого</b>", f"<b>{_format_amount(budget['total_rub'])}</b>"])
+        story.append(_render_table({'header': True, 'rows': rows}, styles, width))
+    return story
+
+
+def _render_pdf(room_type: str, recommendations: str, shopping_list: str, design_image_bytes: bytes = None,
+                shopping_items: list = None, budget: dict = None) -> bytes:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import inch
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
+
+    styles = get_styles()
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=36, leftMargin=36, topMargin=36, bottomMargin=36)
+
+    story = [
+        Paragraph("Дизайн-проект", styles['title']),
+        Spacer(1, 0.2 * inch),
+        Paragraph(f"<b>Тип помещения:</b> {format_inline(room_type or '')}", styles['normal']),
+        Spacer(1, 0.1 * inch),
+    ]
+
+    if design_image_bytes:
+        try:
+            story.append(_design_image_flowable(design_image_bytes))
+            story.append(Spacer(1, 0.2 * inch))
+        except Exception:
+            logger.exception("Не удалось добавить изображение в PDF")
+
+    story.append(Paragraph("Финальные рекомендации", styles['heading']))
+    story.append(Spacer(1, 0.1 * inch))
+    if recommendations:
+        story.extend(render_markdown(parse_markdown(recommendations), styles, doc.width))
+        story.append(Spacer(1, 0.2 * inch))
+
+    story.append(PageBreak())
+
+    story.append(Paragraph("Список покупок", styles['heading']))
+    story.append(Spacer(1, 0.1 * inch))
+    if shopping_items:
+        story.extend(render_shopping_items(shopping_items, budget, styles, doc.width))
+    elif shopping_list:
+        story.extend(render_markdown(parse_markdown(shopping_list), styles, doc.width))
+
+    doc.build(story)
+    return buffer.getvalue()
+
+
+def build_design_project_pdf(room_type: str, recommendations: str, shopping_list: str, design_image_bytes: bytes = None,
+                             shopping_items: list = None, budget: dict = None) -> bytes:
+    """Собирает PDF дизайн-проекта. Если переданы позиции списка покупок (shopping_items), список и бюджет
+    строятся таблицами из них, иначе из Markdown shopping_list. Готовые файлы кешируются по хешу содержимого."""
+    digest = hashlib.sha256()
+    for part in (room_type, recommendations, shopping_list,
+                 json.dumps(shopping_items, sort_keys=True, ensure_ascii=False) if shopping_items else "",
+                 json.dumps(budget, sort_keys=True, ensure_ascii=False) if shopping_items and budget else ""):
+        digest.update((part or "").encode('utf-8'))
+        digest.update(b"\0")
+    digest.update(design_image_bytes or b"")
+    key = digest.hexdigest()
+
+    with _pdf_cache_lock:
+        cached = _pdf_cache.get(key)
+        if cached is not None:
+            _pdf_cache.move_to_end(key)
+            return cached
+
+    pdf_bytes = _render_pdf(room_type, recommendations, shopping_list, design_image_bytes, shopping_items, budget)
+
+    with _pdf_cache_lock:
+        _pdf_cache[key] = pdf_bytes
+        while len(_pdf_cache) > PDF_CACHE_SIZE:
+            _pdf_cache.popitem(last=False)
+    return pdf_bytes
@@ -0,0 +1,163 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from design_package import DESIGN_PACKAGE_MODE
+from image_memory import load_image_value
+from prompts import SYSTEM_PROMPT_DESIGN_PACKAGE, SYSTEM_PROMPT_RECOMMENDATIONS, SYSTEM_PROMPT_SHOPPING_LIST
+from telemetry import pipeline_stage
+from utils import stream_gemini_design_package, stream_gemini_vision_markdown
+
+logger = logging.getLogger("ai_designer.prefetch")
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+PREFETCH_MAX_WORKERS = int(os.getenv("PREFETCH_MAX_WORKERS", "4"))
+PREFETCH_WAIT_TIMEOUT = float(os.getenv("PREFETCH_WAIT_TIMEOUT", "180"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PREFETCH_MAX_WORKERS, thread_name_prefix="prefetch")
+    return _executor
+
+
+class PrefetchCancelled(Exception):
+    pass
+
+
+class PrefetchTask:
+    """Спекулятивная генерация для одного варианта: рекомендации, затем сразу список покупок по ним.
+
+    Задача не трогает st.session_state: тексты запросов собираются заранее, shopping_request(recommendations)
+    строит запрос списка покупок. Если рекомендации переданы готовыми, сразу строится список покупок.
+    В режиме DESIGN_PACKAGE_MODE=combined recommendations_request — запрос комбинированного пакета,
+    и рекомендации, список покупок и бюджет приходят одним вызовом.
+    """
+
+    def __init__(self, variant_hash: str, source_hash: str, recommendations_request: str, shopping_request,
+                 recommendations: str = None):
+        self.variant_hash = variant_hash
+        self.source_hash = source_hash
+        self.recommendations_request = recommendations_request
+        self.shopping_request = shopping_request
+        self.recommendations = recommendations
+        self.shopping_list = None
+        self.shopping_items = None
+        self.budget = None
+        self.error = None
+        self.recommendations_ready = threading.Event()
+        self.shopping_ready = threading.Event()
+        self._cancelled = threading.Event()
+        self._future = None
+        if recommendations is not None:
+            self.recommendations_ready.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def matches(self, variant_hash: str, source_hash: str, recommendations_request: str,
+                recommendations: str = None) -> bool:
+        """Подходит ли задача к текущему выбору; recommendations — уже сохранённые рекомендации, если есть"""
+        if self.cancelled or (self.variant_hash, self.source_hash, self.recommendations_request) != (
+                variant_hash, source_hash, recommendations_request):
+            return False
+        if recommendations is None or not self.recommendations_ready.is_set():
+            return True
+        return self.recommendations == recommendations
+
+    def start(self):
+        self._future = _get_executor().submit(self._run)
+        return self
+
+    def cancel(self):
+        """Останавливает задачу: ещё не начатая не запустится, идущий поток ответа закрывается на следующем фрагменте"""
+        self._cancelled.set()
+        if self._future is not None:
+            self._future.cancel()
+        self.recommendations_ready.set()
+        self.shopping_ready.set()
+
+    def wait_recommendations(self, timeout: float = None):
+        """Ждёт рекомендации; None, если задача отменена или завершилась ошибкой"""
+        self.recommendations_ready.wait(PREFETCH_WAIT_TIMEOUT if timeout is None else timeout)
+        return None if self.cancelled else self.recommendations
+
+    def wait_shopping_list(self, recommendations: str, timeout: float = None):
+        """Ждёт список покупок, построенный именно по этим рекомендациям; иначе None"""
+        if self.recommendations_ready.is_set() and self.recommendations != recommendations:
+            return None
+        self.shopping_ready.wait(PREFETCH_WAIT_TIMEOUT if timeout is None else timeout)
+        if self.cancelled or self.recommendations != recommendations:
+            return None
+        return self.shopping_list
+
+    def _collect(self, stream) -> str:
+        parts = []
+        try:
+            for text in stream:
+                if self.cancelled:
+                    raise PrefetchCancelled()
+                parts.append(text)
+        finally:
+            stream.close()
+        return "".join(parts)
+
+    def _run(self):
+        try:
+            design_image = load_image_value(self.variant_hash)
+            source_image = load_image_value(self.source_hash)
+            if self.recommendations is None and DESIGN_PACKAGE_MODE == "combined":
+                package = {}
+                with pipeline_stage("prefetch_design_package"):
+                    self._collect(stream_gemini_design_package(
+                        SYSTEM_PROMPT_DESIGN_PACKAGE, self.recommendations_request,
+                        design_image, source_image, package
+                    ))
+                self.shopping_list = package['shopping_list']
+                self.shopping_items = package['items']
+                self.budget = package['budget']
+                self.recommendations = package['recommendations']
+                return
+            if self.recommendations is None:
+                with pipeline_stage("prefetch_recommend"):
+                    self.recommendations = self._collect(stream_gemini_vision_markdown(
+                        SYSTEM_PROMPT_RECOMMENDATIONS, self.recommendations_request,
+                        design_image, source_image
+                    ))
+                self.recommendations_ready.set()
+            with pipeline_stage("prefetch_shopping_list"):
+                self.shopping_list = self._collect(stream_gemini_vision_markdown(
+                    SYSTEM_PROMPT_SHOPPING_LIST, self.shopping_request(self.recommendations),
+                    design_image, source_image
+                ))
+        except PrefetchCancelled:
+            pass
+        except Exception as e:
+            self.error = str(e)
+            logger.exception("Ошибка предварительной генерации рекомендаций")
+        finally:
+            self.recommendations_ready.set()
+            self.shopping_ready.set()
+
+
+def speculate(current: PrefetchTask, variant_hash: str, source_hash: str, recommendations_request: str,
+              shopping_request, recommendations: str = None) -> PrefetchTask:
+    """Возвращает задачу предвыборки для варианта: текущую, если она подходит, иначе отменяет её и запускает новую.
+
+    Задача с ошибкой не перезапускается для того же выбора, чтобы не повторять платные запросы на каждом
+    перезапуске скрипта; тогда приложение генерирует рекомендации как обычно.
+    """
+    if current is not None and current.matches(variant_hash, source_hash, recommendations_request, recommendations):
+        return current
+    if current is not None:
+        current.cancel()
+    if not PREFETCH_ENABLED:
+        return None
+    return PrefetchTask(variant_hash, source_hash, recommendations_request, shopping_request, recommendations).start()
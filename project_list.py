@@ -0,0 +1,99 @@
+import os
+import threading
+from collections import OrderedDict
+from sqlalchemy import and_, func, or_
+from database import Project
+
+PROJECT_LIST_PAGE_SIZE = int(os.getenv("PROJECT_LIST_PAGE_SIZE", "20"))
+PROJECT_LIST_CACHE_SIZE = int(os.getenv("PROJECT_LIST_CACHE_SIZE", "512"))
+
+_cache = OrderedDict()
+_versions = {}
+_lock = threading.Lock()
+
+
+def _summary(row) -> dict:
+    return {'id': row.id, 'name': row.name, 'room_type': row.room_type, 'updated_at': row.updated_at}
+
+
+def list_projects(db, user_id: str, limit: int = PROJECT_LIST_PAGE_SIZE, after: tuple = None, search: str = None):
+    """Страница проектов пользователя без тяжёлых колонок (анализ, изображения).
+
+    Сортировка по updated_at и id по убыванию; after — курсор (updated_at, id) последнего элемента предыдущей страницы.
+    Возвращает (список проектов, курсор следующей страницы или None).
+    """
+    query = db.query(Project.id, Project.name, Project.room_type, Project.updated_at).filter(Project.user_id == user_id)
+    if search:
+        escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        pattern = f"%{escaped}%"
+        query = query.filter(or_(Project.name.ilike(pattern, escape="\\"),
+                                 Project.room_type.ilike(pattern, escape="\\")))
+    if after:
+        updated_at, project_id = after
+        query = query.filter(or_(
+            Project.updated_at < updated_at,
+            and_(Project.updated_at == updated_at, Project.id < project_id)
+        ))
+    rows = query.order_by(Project.updated_at.desc(), Project.id.desc()).limit(limit + 1).all()
+
+    items = [_summary(row) for row in rows[:limit]]
+    next_cursor = (items[-1]['updated_at'], items[-1]['id']) if len(rows) > limit else None
+    return items, next_cursor
+
+
+def get_project_summary(db, user_id: str, project_id: int):
+    """Краткие данные одного проекта пользователя или None"""
+    row = db.query(Project.id, Project.name, Project.room_type, Project.updated_at).filter(
+        Project.id == project_id,
+        Project.user_id == user_id
+    ).first()
+    return _summary(row) if row else None
+
+
+def _list_stamp(db, user_id: str) -> tuple:
+    """Отпечаток списка проектов пользователя: число проектов и max(updated_at). Меняется при создании,
+    сохранении и удалении проекта, в том числе другим процессом; считается по индексу ix_projects_user_updated."""
+    return tuple(db.query(func.count(Project.id), func.max(Project.updated_at)).filter(
+        Project.user_id == user_id
+    ).one())
+
+
+def get_project_list(db, user_id: str, search: str = "", pages: int = 1):
+    """Первые pages страниц списка проектов пользователя с кешированием в памяти процесса.
+
+    Запросы идут в сессии db (db_session запуска скрипта). Возвращает (список проектов, есть ли ещё страницы).
+    Закешированный список отдаётся, только пока совпадает отпечаток _list_stamp, поэтому изменения из других
+    процессов (несколько реплик приложения, фоновые задания) видны при следующем обращении.
+    invalidate_project_list сбрасывает кеш этого процесса явно.
+    """
+    search = (search or "").strip()
+    stamp = _list_stamp(db, user_id)
+    with _lock:
+        key = (user_id, _versions.get(user_id, 0), search, pages)
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            _cache.move_to_end(key)
+            return cached[1]
+
+    items = []
+    cursor = None
+    for _ in range(pages):
+        page, cursor = list_projects(db, user_id, after=cursor, search=search or None)
+        items.extend(page)
+        if cursor is None:
+            break
+    result = (items, cursor is not None)
+
+    with _lock:
+        _cache[key] = (stamp, result)
+        while len(_cache) > PROJECT_LIST_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+
+def invalidate_project_list(user_id: str):
+    """Сбрасывает закешированные списки проектов пользователя (после сохранения или удаления)"""
+    with _lock:
+        _versions[user_id] = _versions.get(user_id, 0) + 1
+        for key in [key for key in _cache if key[0] == user_id]:
+            del _cache[key]
@@ -0,0 +1,340 @@
+import asyncio
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import httpx
+from telemetry import note_retry
+
+logger = logging.getLogger("ai_designer.rate_limiter")
+
+GEMINI_RATE_LIMITS = os.getenv("GEMINI_RATE_LIMITS", "gemini-2.5-pro=60,gemini-2.5-flash-image=10")
+GEMINI_DEFAULT_RPM = float(os.getenv("GEMINI_DEFAULT_RPM", "60"))
+GEMINI_RATE_BURST = int(os.getenv("GEMINI_RATE_BURST", "5"))
+GEMINI_RATE_MAX_WAIT = float(os.getenv("GEMINI_RATE_MAX_WAIT", "60"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1.0"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "30"))
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+
+def _parse_rate_limits(spec: str) -> dict:
+    limits = {}
+    for item in spec.split(","):
+        if "=" in item:
+            model, rpm = item.split("=", 1)
+            limits[model.strip()] = float(rpm)
+    return limits
+
+
+class TokenBucket:
+    """Token bucket на rate запросов в секунду с запасом capacity.
+
+    Токены резервируются в порядке вызова (баланс может уйти в минус), поэтому ожидающие
+    потоки проходят по очереди с равным интервалом, а не пачкой после паузы.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, max_wait: float):
+        """Резервирует токен и возвращает, сколько секунд нужно подождать, или None, если дольше max_wait"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self.blocked_until - now)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            if wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def block_for(self, seconds: float):
+        """Останавливает выдачу токенов (ответ 429 с Retry-After касается всех запросов к модели)"""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+    """Размыкается после threshold ошибок подряд и пропускает одну пробную попытку через cooldown секунд"""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == BREAKER_CLOSED:
+                return True
+            if self.state == BREAKER_OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = BREAKER_HALF_OPEN
+                return True
+            return False
+
+    def retry_in(self) -> float:
+        with self._lock:
+            return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.state = BREAKER_CLOSED
+            self.failures = 0
+
+    def release_probe(self):
+        """Результат пробной попытки ничего не говорит о сервисе (например, ошибка в самом запросе):
+        счётчик ошибок не меняется, следующий вызов снова пройдёт пробной попыткой"""
+        with self._lock:
+            if self.state == BREAKER_HALF_OPEN:
+                self.state = BREAKER_OPEN
+
+    def record_failure(self) -> bool:
+        """Учитывает ошибку; возвращает True, если предохранитель только что разомкнулся"""
+        with self._lock:
+            self.failures += 1
+            if self.state == BREAKER_HALF_OPEN or self.failures >= self.threshold:
+                tripped = self.state != BREAKER_OPEN
+                self.state = BREAKER_OPEN
+                self.opened_at = time.monotonic()
+                return tripped
+            return False
+
+
+class _ModelLimiter:
+    def __init__(self, model: str, rpm: float):
+        self.model = model
+        self.bucket = TokenBucket(rpm / 60.0, GEMINI_RATE_BURST)
+        self.breaker = CircuitBreaker(GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN)
+        self.stats = {
+            'calls': 0,
+            'attempts': 0,
+            'retries': 0,
+            'failures': 0,
+            'throttled': 0,
+            'throttle_wait_seconds': 0.0,
+            'rate_limited_responses': 0,
+            'server_errors': 0,
+            'breaker_rejections': 0,
+            'breaker_trips': 0,
+        }
+
+
+_rate_limits = _parse_rate_limits(GEMINI_RATE_LIMITS)
+_limiters = {}
+_lock = threading.Lock()
+
+
+def _get_limiter(model: str) -> _ModelLimiter:
+    limiter = _limiters.get(model)
+    if limiter is None:
+        with _lock:
+            limiter = _limiters.get(model)
+            if limiter is None:
+                limiter = _ModelLimiter(model, _rate_limits.get(model, GEMINI_DEFAULT_RPM))
+                _limiters[model] = limiter
+    return limiter
+
+
+def _count(limiter: _ModelLimiter, key: str, value=1):
+    with _lock:
+        limiter.stats[key] += value
+
+
+def _parse_retry_after(value) -> float:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_info(outcome):
+    """Разбирает результат попытки: (можно ли повторить, HTTP-статус, Retry-After в секундах)"""
+    if isinstance(outcome, httpx.Response):
+        status = outcome.status_code
+        return status in RETRYABLE_STATUSES, status, _parse_retry_after(outcome.headers.get("retry-after"))
+    if isinstance(outcome, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)):
+        return True, None, None
+
+    status = getattr(outcome, "code", None)
+    if isinstance(status, int):
+        headers = getattr(getattr(outcome, "response", None), "headers", None) or {}
+        return status in RETRYABLE_STATUSES, status, _parse_retry_after(headers.get("retry-after"))
+
+    try:
+        import requests
+        if isinstance(outcome, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True, None, None
+    except ImportError:
+        pass
+    return False, None, None
+
+
+def backoff_delay(attempt: int, retry_after: float = None) -> float:
+    """Экспоненциальная задержка с полным джиттером; Retry-After сервера задаёт нижнюю границу"""
+    delay = random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, GEMINI_RATE_MAX_WAIT))
+    return delay
+
+
+def _acquire_attempt(limiter: _ModelLimiter) -> float:
+    """Проверяет предохранитель и резервирует токен; возвращает, сколько секунд подождать перед попыткой"""
+    if not limiter.breaker.allow():
+        _count(limiter, 'breaker_rejections')
+        raise Exception(
+            f"Сервис {limiter.model} временно недоступен из-за серии ошибок. "
+            f"Повторите попытку через {int(limiter.breaker.retry_in()) + 1} с."
+        )
+
+    wait = limiter.bucket.reserve(GEMINI_RATE_MAX_WAIT)
+    if wait is None:
+        _count(limiter, 'throttled')
+        raise Exception(f"Слишком много запросов к {limiter.model}. Пожалуйста, повторите попытку позже.")
+    if wait > 0:
+        _count(limiter, 'throttled')
+        _count(limiter, 'throttle_wait_seconds', wait)
+    return wait
+
+
+def _settle_attempt(limiter: _ModelLimiter, attempt: int, outcome, error):
+    """Учитывает результат попытки: возвращает задержку до повтора или None, если результат окончательный
+    (тогда вызывающий возвращает outcome или бросает error)"""
+    retryable, status, retry_after = _retry_info(outcome)
+    if not retryable:
+        # предохранитель замыкает только настоящий успех; неповторяемые ошибки (400, 403, ошибки разбора)
+        # не говорят о состоянии сервиса и не сбрасывают серию сбоев
+        if error is None and (status is None or status < 400):
+            limiter.breaker.record_success()
+        else:
+            limiter.breaker.release_probe()
+        return None
+
+    _count(limiter, 'failures')
+    if status == 429:
+        _count(limiter, 'rate_limited_responses')
+        if retry_after:
+            limiter.bucket.block_for(retry_after)
+    elif status is not None:
+        _count(limiter, 'server_errors')
+    tripped = limiter.breaker.record_failure()
+    if tripped:
+        _count(limiter, 'breaker_trips')
+        logger.warning("Предохранитель %s разомкнут на %.0f с", limiter.model, GEMINI_BREAKER_COOLDOWN)
+
+    if tripped or attempt == GEMINI_MAX_RETRIES:
+        return None
+
+    _count(limiter, 'retries')
+    note_retry()
+    return backoff_delay(attempt, retry_after)
+
+
+def call_with_retry(model: str, call):
+    """Выполняет call() под лимитом запросов модели, с повторами при 429/5xx/сетевых ошибках и предохранителем.
+
+    call может вернуть httpx.Response: ответ с повторяемым статусом тоже повторяется, а после последней
+    попытки возвращается вызывающему как есть, чтобы он сформировал своё сообщение об ошибке.
+    """
+    limiter = _get_limiter(model)
+    _count(limiter, 'calls')
+
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        wait = _acquire_attempt(limiter)
+        if wait > 0:
+            time.sleep(wait)
+
+        _count(limiter, 'attempts')
+        try:
+            outcome = call()
+            error = None
+        except Exception as e:
+            outcome = e
+            error = e
+
+        delay = _settle_attempt(limiter, attempt, outcome, error)
+        if delay is None:
+            if error is not None:
+                raise error
+            return outcome
+        time.sleep(delay)
+
+
+async def async_call_with_retry(model: str, call):
+    """Асинхронный вариант call_with_retry: call() возвращает awaitable, ожидания не блокируют цикл событий.
+    Лимиты и предохранитель общие с синхронными вызовами. Отмена задачи (CancelledError) не повторяется."""
+    limiter = _get_limiter(model)
+    _count(limiter, 'calls')
+
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        wait = _acquire_attempt(limiter)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        _count(limiter, 'attempts')
+        try:
+            outcome = await call()
+            error = None
+        except Exception as e:
+            outcome = e
+            error = e
+
+        delay = _settle_attempt(limiter, attempt, outcome, error)
+        if delay is None:
+            if error is not None:
+                raise error
+            return outcome
+        await asyncio.sleep(delay)
+
+
+def open_stream(model: str, open_call):
+    """Открывает потоковый ответ через call_with_retry: повторяется только получение первого фрагмента,
+    после того как поток пошёл, ошибки передаются вызывающему."""
+    def first_chunk():
+        stream = iter(open_call())
+        try:
+            first = next(stream)
+        except StopIteration:
+            return iter(())
+        return itertools.chain([first], stream)
+
+    return call_with_retry(model, first_chunk)
+
+
+def get_rate_limit_stats() -> dict:
+    """Метрики лимитера по моделям: повторы, ожидания в очереди, ответы 429, состояние предохранителя"""
+    with _lock:
+        limiters = list(_limiters.values())
+        stats = {limiter.model: dict(limiter.stats) for limiter in limiters}
+    for limiter in limiters:
+        stats[limiter.model]['rpm'] = limiter.bucket.rate * 60
+        stats[limiter.model]['breaker_state'] = limiter.breaker.state
+    return stats
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+logger = logging.getLogger("ai_designer.response_cache")
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_MEMORY_ENTRIES = int(os.getenv("RESPONSE_CACHE_MEMORY_ENTRIES", "256"))
+RESPONSE_CACHE_DB_ENTRIES = int(os.getenv("RESPONSE_CACHE_DB_ENTRIES", "5000"))
+
+
+def make_cache_key(namespace: str, model: str, temperature: float, system_prompt: str, user_text: str, image_bytes: bytes = None,
+                   image_hash: str = None) -> str:
+    """Ключ кеша: хеш изображения, версия системного промпта, текст пользователя, модель и температура.
+    image_hash — уже посчитанный SHA-256 изображения вместо image_bytes."""
+    parts = {
+        'namespace': namespace,
+        'model': model,
+        'temperature': temperature,
+        'prompt_version': hashlib.sha256(system_prompt.encode('utf-8')).hexdigest(),
+        'user_text': user_text,
+        'image': image_hash or (hashlib.sha256(image_bytes).hexdigest() if image_bytes else None),
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class MemoryLRUCache:
+    """Потокобезопасный LRU-кеш в памяти процесса с TTL"""
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLResponseCache:
+    """Постоянный уровень кеша в таблице model_response_cache с TTL и вытеснением по давности обращения"""
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+
+    def get(self, key: str):
+        from database import SessionLocal, ModelResponseCache
+        db = SessionLocal()
+        try:
+            entry = db.query(ModelResponseCache).filter(ModelResponseCache.key == key).first()
+            if entry is None:
+                return None
+            now = datetime.utcnow()
+            if entry.expires_at and entry.expires_at < now:
+                db.delete(entry)
+                db.commit()
+                return None
+            entry.last_accessed_at = now
+            entry.hit_count = (entry.hit_count or 0) + 1
+            db.commit()
+            return entry.value
+        finally:
+            db.close()
+
+    def set(self, key: str, value: str, namespace: str, model: str = None):
+        from database import SessionLocal, ModelResponseCache
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            db.merge(ModelResponseCache(
+                key=key,
+                namespace=namespace,
+                model=model,
+                value=value,
+                hit_count=0,
+                created_at=now,
+                expires_at=now + timedelta(seconds=self.ttl),
+                last_accessed_at=now
+            ))
+            db.commit()
+            self._prune(db)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _prune(self, db):
+        from database import ModelResponseCache
+        db.query(ModelResponseCache).filter(ModelResponseCache.expires_at < datetime.utcnow()).delete(synchronize_session=False)
+        overflow = db.query(ModelResponseCache).count() - self.max_entries
+        if overflow > 0:
+            stale_keys = [
+                row.key for row in db.query(ModelResponseCache.key)
+                .order_by(ModelResponseCache.last_accessed_at.asc())
+                .limit(overflow)
+            ]
+            db.query(ModelResponseCache).filter(ModelResponseCache.key.in_(stale_keys)).delete(synchronize_session=False)
+            self.evictions += len(stale_keys)
+        db.commit()
+
+
+class TieredResponseCache:
+    """Двухуровневый кеш ответов модели: память процесса, затем БД"""
+
+    def __init__(self, namespace: str, memory: MemoryLRUCache, persistent: SQLResponseCache = None):
+        self.namespace = namespace
+        self.memory = memory
+        self.persistent = persistent
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'persistent_hits': 0, 'misses': 0, 'errors': 0}
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None:
+            self._count('memory_hits')
+            return value
+        if self.persistent is not None:
+            try:
+                value = self.persistent.get(key)
+            except Exception:
+                self._count('errors')
+                logger.exception("Ошибка чтения кеша ответов")
+                value = None
+            if value is not None:
+                self.memory.set(key, value)
+                self._count('persistent_hits')
+                return value
+        self._count('misses')
+        return None
+
+    def set(self, key: str, value: str, model: str = None):
+        self.memory.set(key, value)
+        if self.persistent is not None:
+            try:
+                self.persistent.set(key, value, self.namespace, model)
+            except Exception:
+                self._count('errors')
+                logger.exception("Ошибка записи кеша ответов")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        stats['memory_entries'] = len(self.memory)
+        stats['memory_evictions'] = self.memory.evictions
+        if self.persistent is not None:
+            stats['persistent_evictions'] = self.persistent.evictions
+        return stats
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(namespace: str) -> TieredResponseCache:
+    """Возвращает общий для процесса кеш ответов для указанного пространства имён"""
+    cache = _caches.get(namespace)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(namespace)
+            if cache is None:
+                persistent = SQLResponseCache(RESPONSE_CACHE_DB_ENTRIES, RESPONSE_CACHE_TTL) if os.getenv("DATABASE_URL") else None
+                cache = TieredResponseCache(
+                    namespace,
+                    MemoryLRUCache(RESPONSE_CACHE_MEMORY_ENTRIES, RESPONSE_CACHE_TTL),
+                    persistent
+                )
+                _caches[namespace] = cache
+    return cache
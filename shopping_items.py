@@ -0,0 +1,92 @@
+from sqlalchemy import func
+from database import Project, ShoppingItem
+from design_package import SHOPPING_CATEGORIES
+
+
+def _category_order(category: str) -> int:
+    return SHOPPING_CATEGORIES.index(category) if category in SHOPPING_CATEGORIES else len(SHOPPING_CATEGORIES)
+
+
+def replace_project_items(db, project_id: int, items: list):
+    """Заменяет позиции списка покупок проекта в транзакции db; items — из design_package.normalize_items"""
+    db.query(ShoppingItem).filter(ShoppingItem.project_id == project_id).delete(synchronize_session=False)
+    db.add_all([
+        ShoppingItem(
+            project_id=project_id,
+            position=position,
+            category=item['category'],
+            name=item['name'],
+            sku=item['sku'] or None,
+            description=item['description'] or None,
+            quantity=item['quantity'],
+            unit=item['unit'],
+            price_rub=item['unit_price_rub']
+        )
+        for position, item in enumerate(items)
+    ])
+
+
+def load_project_items(db, project_id: int) -> list:
+    """Позиции списка покупок проекта в порядке ответа модели, в формате design_package.normalize_items"""
+    rows = db.query(ShoppingItem).filter(ShoppingItem.project_id == project_id).order_by(ShoppingItem.position).all()
+    return [
+        {
+            'category': row.category,
+            'name': row.name,
+            'sku': row.sku or "",
+            'description': row.description or "",
+            'quantity': row.quantity,
+            'unit': row.unit or "",
+            'unit_price_rub': row.price_rub,
+        }
+        for row in rows
+    ]
+
+
+def get_project_budget(db, project_id: int) -> dict:
+    """Бюджет проекта агрегатом SQL по позициям: итог, суммы по категориям и число позиций.
+    Формат совпадает с design_package.build_budget."""
+    rows = db.query(
+        ShoppingItem.category,
+        func.sum(ShoppingItem.quantity * ShoppingItem.price_rub),
+        func.count(ShoppingItem.id)
+    ).filter(ShoppingItem.project_id == project_id).group_by(ShoppingItem.category).all()
+    rows = sorted(rows, key=lambda row: _category_order(row[0]))
+    by_category = {category: round(amount or 0) for category, amount, _ in rows}
+    return {
+        'total_rub': round(sum(amount or 0 for _, amount, _ in rows)),
+        'by_category': by_category,
+        'items_count': sum(count for _, _, count in rows),
+    }
+
+
+def get_material_report(db, user_id: str, category: str = None, limit: int = 50) -> list:
+    """Сводка материалов по всем проектам пользователя: позиции с одинаковыми категорией, названием и артикулом
+    складываются. Отсортировано по сумме, самые дорогие первыми."""
+    total = func.sum(ShoppingItem.quantity * ShoppingItem.price_rub)
+    query = db.query(
+        ShoppingItem.category,
+        ShoppingItem.name,
+        ShoppingItem.sku,
+        ShoppingItem.unit,
+        func.sum(ShoppingItem.quantity),
+        total,
+        func.count(func.distinct(ShoppingItem.project_id))
+    ).join(Project, Project.id == ShoppingItem.project_id).filter(Project.user_id == user_id)
+    if category:
+        query = query.filter(ShoppingItem.category == category)
+    rows = query.group_by(
+        ShoppingItem.category, ShoppingItem.name, ShoppingItem.sku, ShoppingItem.unit
+    ).order_by(total.desc()).limit(limit).all()
+    return [
+        {
+            'category': row[0],
+            'name': row[1],
+            'sku': row[2] or "",
+            'unit': row[3] or "",
+            'quantity': row[4],
+            'total_rub': round(row[5] or 0),
+            'projects': row[6],
+        }
+        for row in rows
+    ]
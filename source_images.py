@@ -0,0 +1,177 @@
+import io
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from PIL import Image
+from sqlalchemy.exc import IntegrityError
+from blob_store import content_hash, get_blob_store, put_bytes, sniff_mime
+from database import db_session, SourceImage, Project, DesignVariant
+from image_memory import get_image_memory, remember_image_value
+from image_pipeline import delete_derivatives
+from image_value import ImageValue
+
+SOURCE_IMAGE_PERCEPTUAL_DEDUP = os.getenv("SOURCE_IMAGE_PERCEPTUAL_DEDUP", "false").lower() == "true"
+SOURCE_IMAGE_GC_GRACE_HOURS = float(os.getenv("SOURCE_IMAGE_GC_GRACE_HOURS", "24"))
+SOURCE_IMAGE_GC_INTERVAL_HOURS = float(os.getenv("SOURCE_IMAGE_GC_INTERVAL_HOURS", "6"))
+
+logger = logging.getLogger("ai_designer.source_images")
+
+_gc_thread = None
+_gc_lock = threading.Lock()
+
+
+def perceptual_hash(img: Image.Image) -> str:
+    """dHash 64 бита: знаки разностей яркости соседних пикселей уменьшенной до 9x8 копии"""
+    small = img.convert("L").resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+def _describe(data: bytes) -> dict:
+    with Image.open(io.BytesIO(data)) as img:
+        return {
+            'perceptual_hash': perceptual_hash(img),
+            'mime_type': sniff_mime(data),
+            'width': img.width,
+            'height': img.height,
+            'size_bytes': len(data),
+        }
+
+
+def intern_image(db, data: bytes) -> str:
+    """Кладёт исходное фото в общую таблицу images и хранилище блобов; возвращает хеш-дескриптор.
+
+    Одинаковое содержимое хранится один раз. При SOURCE_IMAGE_PERCEPTUAL_DEDUP=true повторная загрузка
+    того же кадра в другом кодировании (тот же размер и dHash) возвращает уже сохранённое изображение.
+    Ссылки проектов учитываются отдельно через acquire_image / release_image.
+    Работает в сессии db (сессия запуска скрипта из db_session) и фиксирует её транзакцию.
+    """
+    image_hash = content_hash(data)
+    try:
+        row = db.get(SourceImage, image_hash)
+        if row is not None:
+            row.last_used_at = datetime.utcnow()
+            db.commit()
+            return image_hash
+
+        info = _describe(data)
+        if SOURCE_IMAGE_PERCEPTUAL_DEDUP:
+            twin = db.query(SourceImage).filter(
+                SourceImage.perceptual_hash == info['perceptual_hash'],
+                SourceImage.width == info['width'],
+                SourceImage.height == info['height']
+            ).first()
+            if twin is not None:
+                twin.last_used_at = datetime.utcnow()
+                db.commit()
+                return twin.hash
+
+        put_bytes(data)
+        db.add(SourceImage(hash=image_hash, ref_count=0, **info))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+    except Exception as e:
+        db.rollback()
+        raise Exception(f"Не удалось сохранить изображение: {str(e)}")
+
+    value = ImageValue(data)
+    value._hash = image_hash
+    remember_image_value(value)
+    return image_hash
+
+
+def acquire_image(db, image_hash: str):
+    """Учитывает новую ссылку проекта на изображение в транзакции db"""
+    if not image_hash:
+        return
+    updated = db.query(SourceImage).filter(SourceImage.hash == image_hash).update(
+        {SourceImage.ref_count: SourceImage.ref_count + 1, SourceImage.last_used_at: datetime.utcnow()},
+        synchronize_session=False
+    )
+    if not updated:
+        db.add(SourceImage(hash=image_hash, ref_count=1))
+
+
+def release_image(db, image_hash: str):
+    """Снимает ссылку проекта на изображение в транзакции db; удаление — в collect_unreferenced_images"""
+    if not image_hash:
+        return
+    db.query(SourceImage).filter(SourceImage.hash == image_hash, SourceImage.ref_count > 0).update(
+        {SourceImage.ref_count: SourceImage.ref_count - 1, SourceImage.last_used_at: datetime.utcnow()},
+        synchronize_session=False
+    )
+
+
+def collect_unreferenced_images(grace_hours: float = None) -> int:
+    """Удаляет изображения без ссылок, не использовавшиеся дольше grace_hours, вместе с блобами и их производными.
+
+    Запас по времени нужен, чтобы не удалить только что загруженное фото, которое ещё не сохранено в проект.
+    Возвращает число удалённых изображений.
+    """
+    cutoff = datetime.utcnow() - timedelta(hours=SOURCE_IMAGE_GC_GRACE_HOURS if grace_hours is None else grace_hours)
+    with db_session() as db:
+        candidates = [row.hash for row in db.query(SourceImage.hash).filter(
+            SourceImage.ref_count <= 0,
+            SourceImage.last_used_at < cutoff
+        ).all()]
+        if not candidates:
+            return 0
+
+        still_used = {row[0] for row in db.query(Project.uploaded_image_hash).filter(
+            Project.uploaded_image_hash.in_(candidates)
+        ).all()}
+        still_used |= {row[0] for row in db.query(DesignVariant.image_hash).filter(
+            DesignVariant.image_hash.in_(candidates)
+        ).all()}
+        orphans = [image_hash for image_hash in candidates if image_hash not in still_used]
+
+        # условия проверяются повторно при удалении: фото могли снова загрузить или сослаться на него
+        # из другого процесса, пока шла проверка
+        deleted = []
+        for image_hash in orphans:
+            if db.query(SourceImage).filter(
+                SourceImage.hash == image_hash,
+                SourceImage.ref_count <= 0,
+                SourceImage.last_used_at < cutoff
+            ).delete(synchronize_session=False):
+                deleted.append(image_hash)
+        db.commit()
+
+    store = get_blob_store()
+    for image_hash in deleted:
+        store.delete(image_hash)
+        delete_derivatives(image_hash)
+        get_image_memory().discard(image_hash)
+    return len(deleted)
+
+
+def _gc_loop():
+    while True:
+        try:
+            removed = collect_unreferenced_images()
+            if removed:
+                logger.info("Удалено неиспользуемых изображений: %s", removed)
+        except Exception:
+            logger.exception("Ошибка уборки неиспользуемых изображений")
+        time.sleep(SOURCE_IMAGE_GC_INTERVAL_HOURS * 3600)
+
+
+def start_image_gc():
+    """Запускает в фоне уборку collect_unreferenced_images: сразу и далее раз в SOURCE_IMAGE_GC_INTERVAL_HOURS
+    (0 — не запускать, тогда уборку нужно вызывать отдельно, например из cron). Повторные вызовы ничего не делают.
+    Уборка безопасна при нескольких процессах: каждое удаление заново проверяет ref_count и last_used_at."""
+    global _gc_thread
+    if SOURCE_IMAGE_GC_INTERVAL_HOURS <= 0:
+        return
+    with _gc_lock:
+        if _gc_thread is None:
+            _gc_thread = threading.Thread(target=_gc_loop, name="source-image-gc", daemon=True)
+            _gc_thread.start()
@@ -0,0 +1,354 @@
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TELEMETRY_EXPORTERS = os.getenv("TELEMETRY_EXPORTERS", "log,prometheus")
+TELEMETRY_PROMETHEUS_PORT = os.getenv("TELEMETRY_PROMETHEUS_PORT")
+TELEMETRY_LOGGER = os.getenv("TELEMETRY_LOGGER", "ai_designer.telemetry")
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+_current_stage = contextvars.ContextVar("telemetry_stage", default=None)
+_current_call = contextvars.ContextVar("telemetry_call", default=None)
+
+logger = logging.getLogger(TELEMETRY_LOGGER)
+
+
+def payload_size(*parts) -> int:
+    """Размер полезной нагрузки запроса в байтах (строки в UTF-8, байты как есть)"""
+    size = 0
+    for part in parts:
+        if isinstance(part, (bytes, bytearray)):
+            size += len(part)
+        elif part:
+            size += len(str(part).encode('utf-8'))
+    return size
+
+
+def _usage_value(usage, *names):
+    for name in names:
+        value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+        if value is not None:
+            return value
+    return None
+
+
+def record_usage(call: dict, usage):
+    """Переносит usage_metadata ответа (SDK-объект или словарь REST API) в запись вызова"""
+    if call is None or not usage:
+        return
+    call['prompt_tokens'] = _usage_value(usage, 'prompt_token_count', 'promptTokenCount')
+    call['candidate_tokens'] = _usage_value(usage, 'candidates_token_count', 'candidatesTokenCount')
+    call['total_tokens'] = _usage_value(usage, 'total_token_count', 'totalTokenCount')
+
+
+def record_response(call: dict, response, response_bytes: int = None):
+    """Заполняет размер ответа и расход токенов из ответа google-genai"""
+    if call is None or response is None:
+        return
+    if response_bytes is None:
+        try:
+            response_bytes = payload_size(response.text)
+        except Exception:
+            response_bytes = 0
+    call['response_bytes'] = response_bytes
+    record_usage(call, getattr(response, 'usage_metadata', None))
+
+
+def note_retry():
+    """Учитывает повтор запроса в текущем вызове модели (вызывается из rate_limiter)"""
+    call = _current_call.get()
+    if call is not None:
+        call['retries'] += 1
+
+
+class LogExporter:
+    """Пишет каждую запись одной JSON-строкой в логгер TELEMETRY_LOGGER"""
+
+    def export_call(self, record: dict):
+        logger.info(json.dumps({'event': 'model_call', **record}, ensure_ascii=False, default=str))
+
+    def export_stage(self, record: dict):
+        level = logging.WARNING if record['status'] == 'error' else logging.INFO
+        logger.log(level, json.dumps({'event': 'pipeline_stage', **record}, ensure_ascii=False, default=str))
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(DURATION_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(DURATION_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels.items())
+
+
+class PrometheusExporter:
+    """Агрегирует записи в счётчики и гистограммы и отдаёт их в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def _inc(self, name: str, labels: tuple, value: float = 1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def _observe(self, name: str, labels: tuple, value: float):
+        key = (name, labels)
+        if key not in self._histograms:
+            self._histograms[key] = _Histogram()
+        self._histograms[key].observe(value)
+
+    def export_call(self, record: dict):
+        model = (('model', record['model']), ('operation', record['operation']))
+        with self._lock:
+            self._inc('ai_designer_model_calls_total',
+                      model + (('stage', record['stage'] or ''), ('status', record['status'])))
+            if record['cache_hit']:
+                self._inc('ai_designer_model_cache_hits_total', model)
+                return
+            self._observe('ai_designer_model_call_duration_seconds', model, record['duration_ms'] / 1000)
+            self._inc('ai_designer_model_retries_total', model, record['retries'])
+            self._inc('ai_designer_model_bytes_total', model + (('direction', 'request'),), record['request_bytes'])
+            self._inc('ai_designer_model_bytes_total', model + (('direction', 'response'),), record['response_bytes'])
+            for token_type in ('prompt', 'candidate'):
+                if record.get(f'{token_type}_tokens'):
+                    self._inc('ai_designer_model_tokens_total', model + (('type', token_type),),
+                              record[f'{token_type}_tokens'])
+
+    def export_stage(self, record: dict):
+        with self._lock:
+            self._inc('ai_designer_stage_total', (('stage', record['stage']), ('status', record['status'])))
+            self._observe('ai_designer_stage_duration_seconds', (('stage', record['stage']),),
+                          record['duration_ms'] / 1000)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            histograms = [(key, (list(h.counts), h.sum, h.count)) for key, h in histograms]
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{{{_labels(**dict(labels))}}} {value}")
+
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(list(DURATION_BUCKETS) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{{{_labels(**dict(labels), le=bound)}}} {cumulative}")
+            lines.append(f"{name}_sum{{{_labels(**dict(labels))}}} {total}")
+            lines.append(f"{name}_count{{{_labels(**dict(labels))}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class OpenTelemetryExporter:
+    """Отправляет вызовы и этапы как спаны OpenTelemetry (нужен настроенный opentelemetry-sdk)"""
+
+    def __init__(self):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise Exception("Для экспорта в OpenTelemetry установите пакеты opentelemetry-api и opentelemetry-sdk")
+        self.tracer = trace.get_tracer("ai_designer")
+
+    def _span(self, name: str, record: dict):
+        end_ns = int(record['finished_at'] * 1e9)
+        start_ns = end_ns - int(record['duration_ms'] * 1e6)
+        span = self.tracer.start_span(name, start_time=start_ns)
+        for key, value in record.items():
+            if value is not None and isinstance(value, (str, bool, int, float)):
+                span.set_attribute(f"ai_designer.{key}", value)
+        if record['status'] == 'error':
+            from opentelemetry.trace import Status, StatusCode
+            span.set_status(Status(StatusCode.ERROR, record.get('error') or ""))
+        span.end(end_time=end_ns)
+
+    def export_call(self, record: dict):
+        self._span(f"gemini.{record['operation']}", record)
+
+    def export_stage(self, record: dict):
+        self._span(f"stage.{record['stage']}", record)
+
+
+_EXPORTER_TYPES = {
+    'log': LogExporter,
+    'prometheus': PrometheusExporter,
+    'otel': OpenTelemetryExporter,
+}
+
+_exporters = None
+_exporters_lock = threading.Lock()
+_prometheus_server = None
+
+
+def get_exporters() -> list:
+    """Экспортёры из TELEMETRY_EXPORTERS (log, prometheus, otel через запятую), создаются один раз"""
+    global _exporters
+    if _exporters is None:
+        with _exporters_lock:
+            if _exporters is None:
+                exporters = []
+                for name in filter(None, (item.strip() for item in TELEMETRY_EXPORTERS.split(","))):
+                    if name not in _EXPORTER_TYPES:
+                        logger.warning("Неизвестный экспортёр телеметрии: %s", name)
+                        continue
+                    try:
+                        exporters.append(_EXPORTER_TYPES[name]())
+                    except Exception as e:
+                        logger.warning("Экспортёр телеметрии %s отключён: %s", name, e)
+                _exporters = exporters
+                if TELEMETRY_PROMETHEUS_PORT:
+                    start_prometheus_server(int(TELEMETRY_PROMETHEUS_PORT))
+    return _exporters
+
+
+def add_exporter(exporter):
+    """Подключает дополнительный экспортёр (объект с методами export_call и export_stage)"""
+    get_exporters()
+    with _exporters_lock:
+        _exporters.append(exporter)
+
+
+def get_prometheus_exporter():
+    for exporter in get_exporters():
+        if isinstance(exporter, PrometheusExporter):
+            return exporter
+    return None
+
+
+def _export(method: str, record: dict):
+    for exporter in get_exporters():
+        try:
+            getattr(exporter, method)(record)
+        except Exception as e:
+            logger.warning("Ошибка экспорта телеметрии в %s: %s", type(exporter).__name__, e)
+
+
+def record_cache_hit(model: str, operation: str):
+    """Учитывает ответ, выданный из кеша без обращения к модели"""
+    with model_call(model, operation) as call:
+        call['cache_hit'] = True
+
+
+@contextmanager
+def model_call(model: str, operation: str, request_bytes: int = 0):
+    """Оборачивает один логический вызов модели; в записи можно дописать токены, размер ответа и cache_hit.
+
+    Внутри генератора сброс контекста может прийти из другого Context (поток бросили недочитанным) — это не ошибка.
+    """
+    record = {
+        'model': model,
+        'operation': operation,
+        'stage': _current_stage.get(),
+        'request_bytes': request_bytes,
+        'response_bytes': 0,
+        'prompt_tokens': None,
+        'candidate_tokens': None,
+        'total_tokens': None,
+        'retries': 0,
+        'cache_hit': False,
+        'status': 'ok',
+        'error': None,
+    }
+    token = _current_call.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['status'] = 'error'
+        record['error'] = str(e)
+        raise
+    finally:
+        try:
+            _current_call.reset(token)
+        except ValueError:
+            pass
+        record['duration_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        record['finished_at'] = time.time()
+        _export('export_call', record)
+
+
+@contextmanager
+def pipeline_stage(name: str):
+    """Этап конвейера (analyze, prompt_engineer, image_gen, refine, recommend, shopping_list, autosave).
+
+    Вызовы модели внутри этапа помечаются его именем. Ошибку, перехваченную внутри этапа,
+    можно отметить через stage['status'] = 'error' и stage['error'].
+    """
+    record = {'stage': name, 'status': 'ok', 'error': None}
+    token = _current_stage.set(name)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['status'] = 'error'
+        record['error'] = str(e)
+        raise
+    finally:
+        try:
+            _current_stage.reset(token)
+        except ValueError:
+            pass
+        record['duration_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        record['finished_at'] = time.time()
+        _export('export_stage', record)
+
+
+def start_prometheus_server(port: int, host: str = "0.0.0.0"):
+    """Поднимает в фоне HTTP-эндпоинт /metrics с метриками PrometheusExporter"""
+    global _prometheus_server
+    if _prometheus_server is not None:
+        return _prometheus_server
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            exporter = get_prometheus_exporter()
+            if self.path.split("?")[0] != "/metrics" or exporter is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = exporter.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logger.warning("Не удалось открыть порт %s для метрик Prometheus: %s", port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="prometheus-metrics", daemon=True).start()
+    _prometheus_server = server
+    return server
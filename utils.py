@@ -1,26 +1,28 @@
-import base64
 import json
+import logging
 import os
-from google import genai
+import re
 from google.genai import types
+from gemini_client import get_genai_client, post_json, track_request
+from rate_limiter import call_with_retry, open_stream
+from pdf_generator import build_design_project_pdf
+from telemetry import model_call, payload_size, record_cache_hit, record_response, record_usage
+from image_value import ImageValue, as_image
+from compositor import create_comparison
+from design_package import DESIGN_PACKAGE_SCHEMA, parse_design_package
+from response_cache import RESPONSE_CACHE_ENABLED, get_response_cache, make_cache_key
+
+logger = logging.getLogger("ai_designer.utils")
 
 def encode_image(uploaded_file):
     """Конвертирует загруженный файл в base64"""
-    return base64.b64encode(uploaded_file.getvalue()).decode('utf-8')
+    return ImageValue(uploaded_file.getvalue()).b64
 
-def call_gemini_vision(system_prompt: str, user_text: str, image_bytes: bytes) -> str:
-    """Вызов Gemini Pro Vision для анализа изображения. Возвращает только поле 'analysis' из JSON-ответа."""
-    try:
-        api_key = os.environ.get("GEMINI_API_KEY")
-        if not api_key:
-            raise Exception("GEMINI_API_KEY не найден. Пожалуйста, добавьте API ключ в настройки.")
-        
-        if not image_bytes:
-            raise Exception("Изображение не загружено. Пожалуйста, загрузите фото помещения.")
-        
-        client = genai.Client(api_key=api_key)
-        
-        full_prompt = f"""{system_prompt}
+def _image_part(image: ImageValue) -> types.Part:
+    return types.Part.from_bytes(data=image.bytes, mime_type=image.mime)
+
+def _analysis_prompt(system_prompt: str, user_text: str) -> str:
+    return f"""{system_prompt}
 
 {user_text}
 
@@ -29,35 +31,94 @@ def call_gemini_vision(system_prompt: str, user_text: str, image_bytes: bytes) -
   "reasoning": "твои внутренние рассуждения и анализ",
   "analysis": "финальный анализ в формате Markdown для пользователя"
 }}"""
-        
-        response = client.models.generate_content(
-            model="gemini-2.5-pro",
-            contents=[
-                types.Part.from_bytes(
-                    data=image_bytes,
-                    mime_type="image/jpeg",
-                ),
-                full_prompt
-            ],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-                temperature=0.7,
-            )
-        )
+
+def _analysis_contents(system_prompt: str, user_text: str, image: ImageValue) -> list:
+    full_prompt = _analysis_prompt(system_prompt, user_text)
+    return [_image_part(image), full_prompt]
+
+def _extract_analysis(raw_content: str) -> str:
+    try:
+        parsed_json = json.loads(raw_content)
+        return parsed_json["analysis"] if "analysis" in parsed_json else raw_content
+    except json.JSONDecodeError:
+        return raw_content
+
+def _vision_markdown_contents(system_prompt: str, user_text: str, image: ImageValue, second_image: ImageValue = None) -> list:
+    full_prompt = f"""{system_prompt}
+
+{user_text}"""
+    
+    contents = [full_prompt, _image_part(image)]
+    
+    if second_image:
+        contents.append(_image_part(second_image))
+    return contents
+
+def _response_text(response) -> str:
+    """Текст ответа SDK: response.text или склейка текстовых частей первого кандидата"""
+    if hasattr(response, 'text') and response.text and response.text.strip():
+        return response.text.strip()
+    if hasattr(response, 'candidates') and response.candidates:
+        candidate = response.candidates[0]
+        if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
+            text_parts = [part.text for part in candidate.content.parts if hasattr(part, 'text') and part.text]
+            if text_parts:
+                return ''.join(text_parts).strip()
+    return None
+
+def _json_field(content: str, key: str):
+    """Значение ключа из JSON-ответа модели (режим return_json_key в call_gemini)"""
+    try:
+        parsed_json = json.loads(content)
+        if key in parsed_json:
+            return parsed_json[key]
+        else:
+            raise Exception(f"Ключ '{key}' не найден в JSON ответе. Получен ответ: {content}")
+    except json.JSONDecodeError as e:
+        raise Exception(f"Не удалось распарсить JSON ответ: {e}. Получен ответ: {content}")
+
+def call_gemini_vision(system_prompt: str, user_text: str, image_bytes: bytes, model: str = "gemini-2.5-pro", temperature: float = 0.7, use_cache: bool = True) -> str:
+    """Вызов Gemini Pro Vision для анализа изображения. Возвращает только поле 'analysis' из JSON-ответа.
+    
+    Ответы кешируются по хешу изображения, версии системного промпта, тексту пользователя, модели и температуре.
+    """
+    try:
+        if not image_bytes:
+            raise Exception("Изображение не загружено. Пожалуйста, загрузите фото помещения.")
+        image = as_image(image_bytes)
+        
+        cache = None
+        if use_cache and RESPONSE_CACHE_ENABLED:
+            cache = get_response_cache("vision_analysis")
+            cache_key = make_cache_key("vision_analysis", model, temperature, system_prompt, user_text, image_hash=image.hash)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                record_cache_hit(model, "vision_analysis")
+                return cached
+        
+        client = get_genai_client()
+        
+        with model_call(model, "vision_analysis", payload_size(system_prompt, user_text, image.bytes)) as call, track_request():
+            response = call_with_retry(model, lambda: client.models.generate_content(
+                model=model,
+                contents=_analysis_contents(system_prompt, user_text, image),
+                config=types.GenerateContentConfig(
+                    response_mime_type="application/json",
+                    temperature=temperature,
+                )
+            ))
+            record_response(call, response)
         
         raw_content = response.text
         
         if not raw_content:
             raise Exception("Пустой ответ от Gemini Vision")
         
-        try:
-            parsed_json = json.loads(raw_content)
-            if "analysis" in parsed_json:
-                return parsed_json["analysis"]
-            else:
-                return raw_content
-        except json.JSONDecodeError:
-            return raw_content
+        result = _extract_analysis(raw_content)
+        
+        if cache is not None:
+            cache.set(cache_key, result, model)
+        return result
             
     except Exception as e:
         raise Exception(f"Ошибка Gemini Vision: {str(e)}")
@@ -68,63 +129,31 @@ def call_gemini_vision_markdown(system_prompt: str, user_text: str, image_bytes:
     Args:
         system_prompt: Системный промпт
         user_text: Текст пользователя
-        image_bytes: Байты основного изображения
-        second_image_bytes: (опционально) Байты второго изображения для сравнения
+        image_bytes: Основное изображение (байты или ImageValue)
+        second_image_bytes: (опционально) Второе изображение для сравнения
     """
     try:
-        api_key = os.environ.get("GEMINI_API_KEY")
-        if not api_key:
-            raise Exception("GEMINI_API_KEY не найден. Пожалуйста, добавьте API ключ в настройки.")
-        
         if not image_bytes:
             raise Exception("Изображение не загружено. Пожалуйста, загрузите фото помещения.")
-        
-        client = genai.Client(api_key=api_key)
-        
-        full_prompt = f"""{system_prompt}
-
-{user_text}"""
-        
-        contents = [
-            full_prompt,
-            types.Part.from_bytes(
-                data=image_bytes,
-                mime_type="image/jpeg",
-            )
-        ]
-        
-        if second_image_bytes:
-            contents.append(types.Part.from_bytes(
-                data=second_image_bytes,
-                mime_type="image/jpeg",
+        image, second_image = as_image(image_bytes), as_image(second_image_bytes)
+        
+        client = get_genai_client()
+        
+        with model_call("gemini-2.5-pro", "vision_markdown", payload_size(system_prompt, user_text, image.bytes, second_image and second_image.bytes)) as call, track_request():
+            response = call_with_retry("gemini-2.5-pro", lambda: client.models.generate_content(
+                model="gemini-2.5-pro",
+                contents=_vision_markdown_contents(system_prompt, user_text, image, second_image),
+                config=types.GenerateContentConfig(
+                    temperature=0.7,
+                    max_output_tokens=8000,
+                )
             ))
-        
-        response = client.models.generate_content(
-            model="gemini-2.5-pro",
-            contents=contents,
-            config=types.GenerateContentConfig(
-                temperature=0.7,
-                max_output_tokens=8000,
-            )
-        )
+            record_response(call, response)
         
         if not response:
             raise Exception("Не получен ответ от Gemini Vision API")
         
-        content = None
-        
-        if hasattr(response, 'text') and response.text and response.text.strip():
-            content = response.text.strip()
-        elif hasattr(response, 'candidates') and response.candidates:
-            candidate = response.candidates[0]
-            if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
-                parts = candidate.content.parts
-                text_parts = []
-                for part in parts:
-                    if hasattr(part, 'text') and part.text:
-                        text_parts.append(part.text)
-                if text_parts:
-                    content = ''.join(text_parts).strip()
+        content = _response_text(response)
         
         if not content:
             raise Exception("Пустой ответ от Gemini Vision")
@@ -134,6 +163,198 @@ def call_gemini_vision_markdown(system_prompt: str, user_text: str, image_bytes:
     except Exception as e:
         raise Exception(f"Ошибка Gemini Vision: {str(e)}")
 
+class _JsonStringFieldStream:
+    """Инкрементально извлекает значение строкового поля из JSON, приходящего частями"""
+    
+    _ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', '\\': '\\', '/': '/'}
+    
+    def __init__(self, field: str):
+        self.pattern = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self.buffer = ""
+        self.pos = None
+        self.done = False
+    
+    def feed(self, chunk: str) -> str:
+        self.buffer += chunk
+        if self.pos is None:
+            match = self.pattern.search(self.buffer)
+            if not match:
+                return ""
+            self.pos = match.end()
+        
+        decoded = []
+        buffer = self.buffer
+        while self.pos < len(buffer) and not self.done:
+            char = buffer[self.pos]
+            if char == '"':
+                self.done = True
+                break
+            if char != '\\':
+                decoded.append(char)
+                self.pos += 1
+                continue
+            if self.pos + 1 >= len(buffer):
+                break
+            escape = buffer[self.pos + 1]
+            if escape != 'u':
+                decoded.append(self._ESCAPES.get(escape, escape))
+                self.pos += 2
+                continue
+            if self.pos + 6 > len(buffer):
+                break
+            code = int(buffer[self.pos + 2:self.pos + 6], 16)
+            if 0xD800 <= code < 0xDC00:
+                if self.pos + 12 > len(buffer):
+                    break
+                low = int(buffer[self.pos + 8:self.pos + 12], 16)
+                decoded.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                self.pos += 12
+            else:
+                decoded.append(chr(code))
+                self.pos += 6
+        return ''.join(decoded)
+    
+    @property
+    def found(self) -> bool:
+        return self.pos is not None
+
+def stream_gemini_vision(system_prompt: str, user_text: str, image_bytes: bytes, model: str = "gemini-2.5-pro", temperature: float = 0.7, use_cache: bool = True):
+    """Потоковый вариант call_gemini_vision: по мере генерации выдаёт фрагменты Markdown из поля 'analysis'.
+    
+    Склейка выданных фрагментов равна результату call_gemini_vision; итог кешируется после завершения потока.
+    """
+    try:
+        if not image_bytes:
+            raise Exception("Изображение не загружено. Пожалуйста, загрузите фото помещения.")
+        image = as_image(image_bytes)
+        
+        cache = None
+        if use_cache and RESPONSE_CACHE_ENABLED:
+            cache = get_response_cache("vision_analysis")
+            cache_key = make_cache_key("vision_analysis", model, temperature, system_prompt, user_text, image_hash=image.hash)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                record_cache_hit(model, "vision_analysis")
+                yield cached
+                return
+        
+        client = get_genai_client()
+        field_stream = _JsonStringFieldStream("analysis")
+        raw_parts = []
+        streamed_parts = []
+        
+        with model_call(model, "vision_analysis", payload_size(system_prompt, user_text, image.bytes)) as call, track_request():
+            for chunk in open_stream(model, lambda: client.models.generate_content_stream(
+                model=model,
+                contents=_analysis_contents(system_prompt, user_text, image),
+                config=types.GenerateContentConfig(
+                    response_mime_type="application/json",
+                    temperature=temperature,
+                )
+            )):
+                record_usage(call, getattr(chunk, 'usage_metadata', None))
+                text = chunk.text if chunk and chunk.text else ""
+                if not text:
+                    continue
+                raw_parts.append(text)
+                decoded = field_stream.feed(text)
+                if decoded:
+                    streamed_parts.append(decoded)
+                    yield decoded
+            call['response_bytes'] = payload_size(*raw_parts)
+        
+        raw_content = ''.join(raw_parts)
+        if not raw_content:
+            raise Exception("Пустой ответ от Gemini Vision")
+        
+        result = _extract_analysis(raw_content)
+        if not field_stream.found:
+            yield result
+        elif ''.join(streamed_parts) != result:
+            result = ''.join(streamed_parts)
+        
+        if cache is not None:
+            cache.set(cache_key, result, model)
+    except Exception as e:
+        raise Exception(f"Ошибка Gemini Vision: {str(e)}")
+
+def stream_gemini_vision_markdown(system_prompt: str, user_text: str, image_bytes: bytes, second_image_bytes: bytes = None):
+    """Потоковый вариант call_gemini_vision_markdown: выдаёт фрагменты Markdown по мере генерации"""
+    try:
+        if not image_bytes:
+            raise Exception("Изображение не загружено. Пожалуйста, загрузите фото помещения.")
+        image, second_image = as_image(image_bytes), as_image(second_image_bytes)
+        
+        client = get_genai_client()
+        received = False
+        
+        with model_call("gemini-2.5-pro", "vision_markdown", payload_size(system_prompt, user_text, image.bytes, second_image and second_image.bytes)) as call, track_request():
+            for chunk in open_stream("gemini-2.5-pro", lambda: client.models.generate_content_stream(
+                model="gemini-2.5-pro",
+                contents=_vision_markdown_contents(system_prompt, user_text, image, second_image),
+                config=types.GenerateContentConfig(
+                    temperature=0.7,
+                    max_output_tokens=8000,
+                )
+            )):
+                record_usage(call, getattr(chunk, 'usage_metadata', None))
+                text = chunk.text if chunk and chunk.text else ""
+                if text:
+                    received = True
+                    call['response_bytes'] += payload_size(text)
+                    yield text
+        
+        if not received:
+            raise Exception("Пустой ответ от Gemini Vision")
+    except Exception as e:
+        raise Exception(f"Ошибка Gemini Vision: {str(e)}")
+
+def stream_gemini_design_package(system_prompt: str, user_text: str, image_bytes: bytes, second_image_bytes: bytes, result: dict):
+    """Один запрос со схемой ответа вместо двух: рекомендации, позиции списка покупок и бюджет.
+    
+    Выдаёт фрагменты Markdown поля 'recommendations' по мере генерации; после завершения потока
+    в result записывается разобранный пакет (см. design_package.parse_design_package).
+    """
+    try:
+        if not image_bytes:
+            raise Exception("Изображение не загружено. Пожалуйста, загрузите фото помещения.")
+        image, second_image = as_image(image_bytes), as_image(second_image_bytes)
+        
+        client = get_genai_client()
+        field_stream = _JsonStringFieldStream("recommendations")
+        raw_parts = []
+        
+        with model_call("gemini-2.5-pro", "design_package", payload_size(system_prompt, user_text, image.bytes, second_image and second_image.bytes)) as call, track_request():
+            for chunk in open_stream("gemini-2.5-pro", lambda: client.models.generate_content_stream(
+                model="gemini-2.5-pro",
+                contents=_vision_markdown_contents(system_prompt, user_text, image, second_image),
+                config=types.GenerateContentConfig(
+                    response_mime_type="application/json",
+                    response_schema=DESIGN_PACKAGE_SCHEMA,
+                    temperature=0.7,
+                    max_output_tokens=12000,
+                )
+            )):
+                record_usage(call, getattr(chunk, 'usage_metadata', None))
+                text = chunk.text if chunk and chunk.text else ""
+                if not text:
+                    continue
+                raw_parts.append(text)
+                decoded = field_stream.feed(text)
+                if decoded:
+                    yield decoded
+            call['response_bytes'] = payload_size(*raw_parts)
+        
+        if not raw_parts:
+            raise Exception("Пустой ответ от Gemini Vision")
+        
+        package = parse_design_package(''.join(raw_parts))
+        if not field_stream.found:
+            yield package['recommendations']
+        result.update(package)
+    except Exception as e:
+        raise Exception(f"Ошибка Gemini Vision: {str(e)}")
+
 def call_gemini(system_prompt: str, user_prompt: str, return_json_key: str = None) -> str:
     """Обычный вызов Gemini для текста. 
     
@@ -146,11 +367,7 @@ def call_gemini(system_prompt: str, user_prompt: str, return_json_key: str = Non
         Текстовый ответ или значение указанного ключа из JSON
     """
     try:
-        api_key = os.environ.get("GEMINI_API_KEY")
-        if not api_key:
-            raise Exception("GEMINI_API_KEY не найден. Пожалуйста, добавьте API ключ в настройки.")
-        
-        client = genai.Client(api_key=api_key)
+        client = get_genai_client()
         
         full_prompt = f"""{system_prompt}
 
@@ -164,409 +381,199 @@ def call_gemini(system_prompt: str, user_prompt: str, return_json_key: str = Non
         if return_json_key:
             config_params["response_mime_type"] = "application/json"
         
-        response = client.models.generate_content(
-            model="gemini-2.5-pro",
-            contents=full_prompt,
-            config=types.GenerateContentConfig(**config_params)
-        )
+        with model_call("gemini-2.5-pro", "text", payload_size(full_prompt)) as call, track_request():
+            response = call_with_retry("gemini-2.5-pro", lambda: client.models.generate_content(
+                model="gemini-2.5-pro",
+                contents=full_prompt,
+                config=types.GenerateContentConfig(**config_params)
+            ))
+            record_response(call, response)
         
         if not response:
             raise Exception("Не получен ответ от Gemini API")
         
-        content = None
-        
-        if hasattr(response, 'text') and response.text and response.text.strip():
-            content = response.text.strip()
-        elif hasattr(response, 'candidates') and response.candidates:
-            candidate = response.candidates[0]
-            if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
-                parts = candidate.content.parts
-                text_parts = []
-                for part in parts:
-                    if hasattr(part, 'text') and part.text:
-                        text_parts.append(part.text)
-                if text_parts:
-                    content = ''.join(text_parts).strip()
+        content = _response_text(response)
         
         if not content:
             raise Exception("Пустой ответ от Gemini")
         
         if return_json_key:
-            try:
-                parsed_json = json.loads(content)
-                if return_json_key in parsed_json:
-                    return parsed_json[return_json_key]
-                else:
-                    raise Exception(f"Ключ '{return_json_key}' не найден в JSON ответе. Получен ответ: {content}")
-            except json.JSONDecodeError as e:
-                raise Exception(f"Не удалось распарсить JSON ответ: {e}. Получен ответ: {content}")
+            return _json_field(content, return_json_key)
         
         return content
     except Exception as e:
         raise Exception(f"Ошибка Gemini: {str(e)}")
 
-def generate_image(source_image_bytes: bytes, prompt: str) -> str:
-    """Генерация изображения через Google Gemini API (gemini-2.5-flash-image)"""
-    try:
-        import requests
-        from PIL import Image
-        import io
-        
-        api_key = os.environ.get("GEMINI_API_KEY")
-        if not api_key:
-            raise Exception("GEMINI_API_KEY не найден. Пожалуйста, добавьте API ключ в настройки.")
-        
-        img = Image.open(io.BytesIO(source_image_bytes))
-        img_format = img.format.lower() if img.format else 'jpeg'
-        mime_type = f"image/{img_format}" if img_format in ['jpeg', 'png', 'jpg'] else "image/jpeg"
-        
-        base64_image = base64.b64encode(source_image_bytes).decode('utf-8')
-        
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image:generateContent?key={api_key}"
-        
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        request_body = {
-            "contents": [
-                {
-                    "parts": [
-                        {
-                            "text": f"Instruction: {prompt}. Keep geometry and structural elements unchanged. Output ONLY the modified image."
-                        },
-                        {
-                            "inline_data": {
-                                "mime_type": mime_type,
-                                "data": base64_image
-                            }
+def _image_request_body(prompt: str, mime_type: str, base64_image: str) -> dict:
+    return {
+        "contents": [
+            {
+                "parts": [
+                    {
+                        "text": f"Instruction: {prompt}. Keep geometry and structural elements unchanged. Output ONLY the modified image."
+                    },
+                    {
+                        "inline_data": {
+                            "mime_type": mime_type,
+                            "data": base64_image
                         }
-                    ]
-                }
-            ],
-            "generationConfig": {
-                "response_modalities": ["IMAGE"]
+                    }
+                ]
             }
+        ],
+        "generationConfig": {
+            "response_modalities": ["IMAGE"]
         }
+    }
+
+def _image_response(response_data: dict) -> ImageValue:
+    """Разбирает ответ generateContent модели изображений; base64 из ответа декодируется только при обращении к байтам"""
+    if "candidates" not in response_data:
+        raise Exception(f"Неожиданный формат ответа: {response_data}")
+    
+    if len(response_data["candidates"]) == 0:
+        raise Exception("API не вернул результатов генерации")
+    
+    candidate = response_data["candidates"][0]
+    
+    if "content" not in candidate:
+        raise Exception(f"Отсутствует 'content' в ответе: {candidate}")
+    
+    if "parts" not in candidate["content"]:
+        raise Exception(f"Отсутствует 'parts' в content: {candidate['content']}")
+    
+    parts = candidate["content"]["parts"]
+    if len(parts) == 0:
+        raise Exception("Parts пустой")
+    
+    part = parts[0]
+    
+    inline_data = part.get("inlineData") or part.get("inline_data")
+    if not inline_data:
+        raise Exception(f"Отсутствует 'inlineData' или 'inline_data' в part: {part}")
+    
+    base64_response = inline_data.get("data")
+    if not base64_response:
+        raise Exception(f"Отсутствует 'data' в inline_data: {inline_data}")
+    response_mime_type = inline_data.get("mimeType") or inline_data.get("mime_type") or "image/jpeg"
+    return ImageValue.from_b64(base64_response, response_mime_type)
+
+def generate_image(source_image_bytes: bytes, prompt: str) -> ImageValue:
+    """Генерация изображения через Google Gemini API (gemini-2.5-flash-image).
+    
+    source_image_bytes — байты или ImageValue; base64 исходника берётся из ImageValue, поэтому при генерации
+    нескольких вариантов из одного значения кодируется один раз."""
+    try:
+        source_image = as_image(source_image_bytes)
         
-        response = requests.post(url, headers=headers, json=request_body, timeout=120)
-        
-        if response.status_code != 200:
-            error_detail = response.text
-            raise Exception(f"API вернул ошибку {response.status_code}: {error_detail}")
-        
-        response_data = response.json()
-        
-        if "candidates" not in response_data:
-            raise Exception(f"Неожиданный формат ответа: {response_data}")
-        
-        if len(response_data["candidates"]) == 0:
-            raise Exception("API не вернул результатов генерации")
-        
-        candidate = response_data["candidates"][0]
-        
-        if "content" not in candidate:
-            raise Exception(f"Отсутствует 'content' в ответе: {candidate}")
-        
-        if "parts" not in candidate["content"]:
-            raise Exception(f"Отсутствует 'parts' в content: {candidate['content']}")
-        
-        parts = candidate["content"]["parts"]
-        if len(parts) == 0:
-            raise Exception("Parts пустой")
-        
-        part = parts[0]
-        
-        inline_data = part.get("inlineData") or part.get("inline_data")
-        if not inline_data:
-            raise Exception(f"Отсутствует 'inlineData' или 'inline_data' в part: {part}")
+        request_body = _image_request_body(prompt, source_image.mime, source_image.b64)
         
-        base64_response = inline_data.get("data")
-        if not base64_response:
-            raise Exception(f"Отсутствует 'data' в inline_data: {inline_data}")
-        data_url = f"data:image/jpeg;base64,{base64_response}"
+        with model_call("gemini-2.5-flash-image", "image_generation", payload_size(prompt, source_image.b64)) as call:
+            response = call_with_retry(
+                "gemini-2.5-flash-image",
+                lambda: post_json("/v1beta/models/gemini-2.5-flash-image:generateContent", request_body, timeout=120)
+            )
+            call['response_bytes'] = len(response.content)
+            
+            if response.status_code != 200:
+                error_detail = response.text
+                raise Exception(f"API вернул ошибку {response.status_code}: {error_detail}")
+            
+            response_data = response.json()
+            record_usage(call, response_data.get("usageMetadata"))
         
-        return data_url
+        return _image_response(response_data)
         
     except Exception as e:
         raise Exception(f"Ошибка Gemini Image Generation: {str(e)}")
 
-def refine_design_with_vision(design_image_url: str, original_prompt: str, user_feedback: str, refine_system_prompt: str) -> str:
-    """Доработка дизайна с помощью Gemini Vision - анализирует изображение дизайна и создаёт новый промпт с минимальными изменениями"""
-    try:
-        import requests
-        from io import BytesIO
-        
-        api_key = os.environ.get("GEMINI_API_KEY")
-        if not api_key:
-            raise Exception("GEMINI_API_KEY не найден")
-        
-        if design_image_url.startswith('data:image'):
-            header, encoded = design_image_url.split(',', 1)
-            image_bytes = base64.b64decode(encoded)
-        else:
-            response = requests.get(design_image_url, timeout=10)
-            image_bytes = response.content
-        
-        client = genai.Client(api_key=api_key)
-        
-        user_text = f"""ИСХОДНЫЙ ПРОМПТ, который создал этот дизайн:
-{original_prompt}
+def _refine_user_text(original_prompt: str, user_feedback: str, history: str = None) -> str:
+    history_text = f"""
+
+ПРАВКИ, УЖЕ ВНЕСЁННЫЕ В ЭТОТ ДИЗАЙН (они видны на изображении, сохрани их):
+{history}""" if history else ""
+    return f"""ИСХОДНЫЙ ПРОМПТ, который создал этот дизайн:
+{original_prompt}{history_text}
 
 ПОЖЕЛАНИЯ ПОЛЬЗОВАТЕЛЯ (внеси ТОЛЬКО эти изменения):
 {user_feedback}
 
 Проанализируй изображение текущего дизайна и создай промпт для точечной корректировки."""
-        
-        response = client.models.generate_content(
-            model="gemini-2.5-pro",
-            contents=[
-                types.Part.from_bytes(
-                    data=image_bytes,
-                    mime_type="image/jpeg",
-                ),
-                f"{refine_system_prompt}\n\n{user_text}"
-            ],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-                temperature=0.7,
-            )
-        )
+
+def _refined_prompt(raw_content: str) -> str:
+    try:
+        parsed_json = json.loads(raw_content)
+        if "prompt" in parsed_json:
+            return parsed_json["prompt"]
+        else:
+            raise Exception(f"Ключ 'prompt' не найден в JSON ответе. Получен ответ: {raw_content}")
+    except json.JSONDecodeError as e:
+        raise Exception(f"Не удалось распарсить JSON ответ при доработке: {e}. Получен ответ: {raw_content}")
+
+def refine_design_with_vision(design_image, original_prompt: str, user_feedback: str, refine_system_prompt: str,
+                              history: str = None) -> str:
+    """Доработка дизайна с помощью Gemini Vision - анализирует изображение дизайна и создаёт новый промпт с минимальными изменениями.
+    
+    design_image — ImageValue, байты, data URL или ссылка на изображение. history — сжатый список уже
+    внесённых правок (lineage.refine_context), original_prompt тогда — промпт, от которого они отсчитываются."""
+    try:
+        image = as_image(design_image)
+        
+        client = get_genai_client()
+        
+        user_text = _refine_user_text(original_prompt, user_feedback, history)
+        
+        with model_call("gemini-2.5-pro", "refine", payload_size(refine_system_prompt, user_text, image.bytes)) as call, track_request():
+            response = call_with_retry("gemini-2.5-pro", lambda: client.models.generate_content(
+                model="gemini-2.5-pro",
+                contents=[
+                    _image_part(image),
+                    f"{refine_system_prompt}\n\n{user_text}"
+                ],
+                config=types.GenerateContentConfig(
+                    response_mime_type="application/json",
+                    temperature=0.7,
+                )
+            ))
+            record_response(call, response)
         
         raw_content = response.text
         
         if not raw_content:
             raise Exception("Пустой ответ от Gemini Vision при доработке дизайна")
         
-        try:
-            parsed_json = json.loads(raw_content)
-            if "prompt" in parsed_json:
-                return parsed_json["prompt"]
-            else:
-                raise Exception(f"Ключ 'prompt' не найден в JSON ответе. Получен ответ: {raw_content}")
-        except json.JSONDecodeError as e:
-            raise Exception(f"Не удалось распарсить JSON ответ при доработке: {e}. Получен ответ: {raw_content}")
+        return _refined_prompt(raw_content)
             
     except Exception as e:
         raise Exception(f"Ошибка при доработке дизайна с Gemini Vision: {str(e)}")
 
-def create_before_after_comparison(original_image_bytes: bytes, result_image_url: str) -> bytes:
-    """Создает композитное изображение с половиной исходного изображения слева и половиной результата справа, 
-    разделенные вертикальной линией в центре"""
+def create_before_after_comparison(original_image, result_image, position: float = 0.5,
+                                   output_format: str = None) -> bytes:
+    """Создает композитное изображение с исходным фото слева и результатом справа от разделителя
+    (position — доля ширины). Изображения — ImageValue, байты, data URL или ссылки.
+    Компоновка и кеширование — в compositor, по умолчанию результат в JPEG."""
     try:
-        from PIL import Image as PILImage, ImageDraw
-        from io import BytesIO
-        import requests
-        
-        original_img = PILImage.open(BytesIO(original_image_bytes)).convert('RGB')
-        
-        if result_image_url.startswith('data:image'):
-            header, encoded = result_image_url.split(',', 1)
-            result_bytes = base64.b64decode(encoded)
-            result_img = PILImage.open(BytesIO(result_bytes)).convert('RGB')
-        else:
-            resp = requests.get(result_image_url, timeout=10)
-            result_img = PILImage.open(BytesIO(resp.content)).convert('RGB')
-        
-        width = 500
-        height = 350
-        half_width = width // 2
-        
-        original_img = original_img.resize((width, height), PILImage.Resampling.LANCZOS)
-        result_img = result_img.resize((width, height), PILImage.Resampling.LANCZOS)
-        
-        composite = PILImage.new('RGB', (width, height), 'white')
-        
-        original_half = original_img.crop((0, 0, half_width, height))
-        result_half = result_img.crop((half_width, 0, width, height))
-        
-        composite.paste(original_half, (0, 0))
-        composite.paste(result_half, (half_width, 0))
-        
-        draw = ImageDraw.Draw(composite)
-        line_color = (200, 200, 200)
-        draw.line([(half_width, 0), (half_width, height)], fill=line_color, width=2)
-        
-        output_buffer = BytesIO()
-        composite.save(output_buffer, format='PNG')
-        output_buffer.seek(0)
-        
-        return output_buffer.getvalue()
+        original, result = as_image(original_image), as_image(result_image)
+        return create_comparison(original.hash, result.hash, (position,), output_format,
+                                 before_data=original.bytes, after_data=result.bytes)[0]
         
     except Exception as e:
         raise Exception(f"Ошибка при создании композитного изображения: {str(e)}")
 
-def generate_design_project_pdf(room_type: str, recommendations: str, shopping_list: str, design_image_url: str = None) -> bytes:
-    """Генерирует PDF файл с рекомендациями и списком покупок"""
+def generate_design_project_pdf(room_type: str, recommendations: str, shopping_list: str, design_image=None,
+                                shopping_items: list = None, budget: dict = None) -> bytes:
+    """Генерирует PDF файл с рекомендациями и списком покупок (см. pdf_generator).
+    design_image — ImageValue, байты, data URL или ссылка на изображение дизайна."""
     try:
-        import re
-        from reportlab.lib.pagesizes import A4
-        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, PageBreak, Table, TableStyle
-        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-        from reportlab.lib.units import inch
-        from reportlab.lib import colors
-        from reportlab.lib.enums import TA_CENTER, TA_LEFT
-        from reportlab.pdfbase import pdfmetrics
-        from reportlab.pdfbase.ttfonts import TTFont
-        from io import BytesIO
-        import requests
-        import subprocess
-        
-        def clean_text_for_pdf(text: str) -> str:
-            """Удаляет эмодзи и markdown форматирование из текста"""
-            if not text:
-                return ""
-            
-            emoji_pattern = re.compile("["
-                u"\U0001F600-\U0001F64F"
-                u"\U0001F300-\U0001F5FF"
-                u"\U0001F680-\U0001F6FF"
-                u"\U0001F1E0-\U0001F1FF"
-                u"\U00002702-\U000027B0"
-                u"\U000024C2-\U0001F251"
-                u"\U0001f926-\U0001f937"
-                u"\U00010000-\U0010ffff"
-                u"\u2640-\u2642"
-                u"\u2600-\u2B55"
-                u"\u200d"
-                u"\u23cf"
-                u"\u23e9"
-                u"\u231a"
-                u"\ufe0f"
-                u"\u3030"
-                "]+", flags=re.UNICODE)
-            
-            text = emoji_pattern.sub('', text)
-            
-            text = re.sub(r'^\s*#+\s+', '', text, flags=re.MULTILINE)
-            
-            text = re.sub(r'\*\*(.+?)\*\*', r'<b>\1</b>', text)
-            text = re.sub(r'\*(.+?)\*', r'<i>\1</i>', text)
-            
-            text = re.sub(r'^[\s\-\*]+', '', text, flags=re.MULTILINE)
-            
-            return text.strip()
-        
-        try:
-            font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
-            font_bold_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
-            
-            if not os.path.exists(font_path):
-                result = subprocess.run(['find', '/usr/share/fonts', '-name', '*DejaVu*Sans*.ttf'], 
-                                       capture_output=True, text=True, timeout=5)
-                if result.stdout:
-                    font_path = result.stdout.strip().split('\n')[0]
-                    font_bold_path = [f for f in result.stdout.strip().split('\n') if 'Bold' in f]
-                    if font_bold_path:
-                        font_bold_path = font_bold_path[0]
-            
-            if os.path.exists(font_path):
-                pdfmetrics.registerFont(TTFont('CustomFont', font_path))
-                if os.path.exists(font_bold_path):
-                    pdfmetrics.registerFont(TTFont('CustomFontBold', font_bold_path))
-                    font_name = 'CustomFontBold'
-                    normal_font = 'CustomFont'
-                else:
-                    font_name = 'CustomFont'
-                    normal_font = 'CustomFont'
-            else:
-                font_name = 'Helvetica-Bold'
-                normal_font = 'Helvetica'
-        except:
-            font_name = 'Helvetica-Bold'
-            normal_font = 'Helvetica'
-        
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=36, leftMargin=36, topMargin=36, bottomMargin=36)
-        
-        story = []
-        styles = getSampleStyleSheet()
-        
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=24,
-            textColor=colors.HexColor('#1f77b4'),
-            spaceAfter=12,
-            alignment=TA_CENTER,
-            fontName=font_name
-        )
-        
-        heading_style = ParagraphStyle(
-            'CustomHeading',
-            parent=styles['Heading2'],
-            fontSize=14,
-            textColor=colors.HexColor('#1f77b4'),
-            spaceAfter=10,
-            spaceBefore=10,
-            fontName=font_name
-        )
-        
-        normal_style = ParagraphStyle(
-            'CustomNormal',
-            parent=styles['Normal'],
-            fontSize=10,
-            spaceAfter=6,
-            alignment=TA_LEFT,
-            fontName=normal_font
-        )
-        
-        story.append(Paragraph("Дизайн-проект", title_style))
-        story.append(Spacer(1, 0.2*inch))
-        
-        story.append(Paragraph(f"<b>Тип помещения:</b> {room_type}", normal_style))
-        story.append(Spacer(1, 0.1*inch))
-        
-        if design_image_url:
+        design_image_bytes = None
+        if design_image:
             try:
-                if design_image_url.startswith('data:image'):
-                    header, encoded = design_image_url.split(',', 1)
-                    image_bytes = base64.b64decode(encoded)
-                    temp_image = BytesIO(image_bytes)
-                else:
-                    resp = requests.get(design_image_url, timeout=10)
-                    temp_image = BytesIO(resp.content)
-                
-                from PIL import Image as PILImage
-                img = PILImage.open(temp_image)
-                max_width = 6*inch
-                max_height = 4*inch
-                img.thumbnail((int(max_width), int(max_height)), PILImage.Resampling.LANCZOS)
-                
-                img_buffer = BytesIO()
-                img.save(img_buffer, format='JPEG')
-                img_buffer.seek(0)
-                
-                img_obj = Image(img_buffer, width=4*inch, height=3*inch)
-                story.append(img_obj)
-                story.append(Spacer(1, 0.2*inch))
-            except Exception as e:
-                pass
-        
-        story.append(Paragraph("Финальные рекомендации", heading_style))
-        story.append(Spacer(1, 0.1*inch))
-        
-        if recommendations:
-            for line in recommendations.split('\n'):
-                cleaned_line = clean_text_for_pdf(line)
-                if cleaned_line:
-                    story.append(Paragraph(cleaned_line, normal_style))
-            story.append(Spacer(1, 0.2*inch))
-        
-        story.append(PageBreak())
-        
-        story.append(Paragraph("Список покупок", heading_style))
-        story.append(Spacer(1, 0.1*inch))
-        
-        if shopping_list:
-            for line in shopping_list.split('\n'):
-                cleaned_line = clean_text_for_pdf(line)
-                if cleaned_line:
-                    story.append(Paragraph(cleaned_line, normal_style))
-        
-        doc.build(story)
-        buffer.seek(0)
-        return buffer.getvalue()
+                design_image_bytes = as_image(design_image).bytes
+            except Exception:
+                logger.exception("Не удалось загрузить изображение дизайна для PDF")
+        
+        return build_design_project_pdf(room_type, recommendations, shopping_list, design_image_bytes,
+                                        shopping_items, budget)
         
     except Exception as e:
         raise Exception(f"Ошибка при генерации PDF: {str(e)}")